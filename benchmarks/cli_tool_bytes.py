@@ -0,0 +1,68 @@
+"""Benchmark the throughput of CliTool.run() vs CliTool.run_bytes().
+
+The text mode decodes the output and splits it into lines, the bytes mode
+passes raw chunks along. Compares capturing the output in memory and writing
+it to a file (/dev/null, to measure the overhead of the reading, not the disk).
+
+Usage:
+
+    python benchmarks/cli_tool_bytes.py [--megabytes N]
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import time
+from typing import TYPE_CHECKING
+
+from konfusion.lib.tools import CliTool, Discard
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+# Writes N MiB of text (100 character lines) to stdout
+WRITE_SCRIPT = """
+import sys
+chunk = (("x" * 99 + "\\n") * 10486).encode()[: 1024 * 1024]
+for _ in range(int(sys.argv[1])):
+    sys.stdout.buffer.write(chunk)
+"""
+
+
+def benchmark(name: str, run: Callable[[list[str]], object], megabytes: int) -> None:
+    args = ["-c", WRITE_SCRIPT, str(megabytes)]
+    start = time.perf_counter()
+    run(args)
+    elapsed = time.perf_counter() - start
+    print(f"{name:>22}: {megabytes / elapsed:>8,.0f} MB/s, {elapsed:6.2f}s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--megabytes", type=int, default=1024)
+    args = parser.parse_args()
+
+    python = CliTool(sys.executable)
+    with open(os.devnull, "wb") as devnull:  # noqa: PTH123
+
+        def write_line(line: str) -> None:
+            devnull.write(line.encode())
+
+        def text_to_devnull(args: list[str]) -> None:
+            python.run(args, stdout_callback=write_line, stdout_capture=Discard())
+
+        print(f"{args.megabytes:,} MiB of output")
+        benchmark("text, capture", python.run, args.megabytes)
+        benchmark("bytes, capture", python.run_bytes, args.megabytes)
+        benchmark("text, write to file", text_to_devnull, args.megabytes)
+        benchmark(
+            "bytes, write to file",
+            lambda args: python.run_bytes(args, stdout_to=devnull),
+            args.megabytes,
+        )
+
+
+if __name__ == "__main__":
+    main()
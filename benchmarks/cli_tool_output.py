@@ -0,0 +1,113 @@
+"""Benchmark reading subprocess output with CliTool.
+
+Compares the selector-based CliTool.run() with the previous implementation,
+which read stdout and stderr using two threads per process.
+
+Usage:
+
+    python benchmarks/cli_tool_output.py [--lines N] [--processes N]
+"""
+
+from __future__ import annotations
+
+import argparse
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, TYPE_CHECKING
+
+from konfusion.lib.tools import CliTool
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Sequence
+
+# Prints N lines to stdout and N / 10 lines to stderr
+CHATTY_SCRIPT = """
+import sys
+for i in range(int(sys.argv[1])):
+    print(f"Copying blob sha256:{i:064x}")
+    if i % 10 == 0:
+        print(f"warning: line {i}", file=sys.stderr)
+"""
+
+
+def run_with_threads(
+    args: Sequence[str], stdout_callback: Callable[[str], None]
+) -> subprocess.CompletedProcess[str]:
+    """The previous CliTool.run() implementation, simplified."""
+    process = subprocess.Popen(  # noqa: S603
+        args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+    )
+    outputs: dict[str, list[str]] = {"stdout": [], "stderr": []}
+
+    def read(pipe: IO[str] | None, lines: list[str], callback: bool) -> None:
+        assert pipe is not None  # noqa: S101
+        with pipe:
+            for line in pipe:
+                lines.append(line)
+                if callback:
+                    stdout_callback(line)
+
+    threads = [
+        threading.Thread(target=read, args=[process.stdout, outputs["stdout"], True]),
+        threading.Thread(target=read, args=[process.stderr, outputs["stderr"], False]),
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    returncode = process.wait()
+    stdout, stderr = "".join(outputs["stdout"]), "".join(outputs["stderr"])
+    return subprocess.CompletedProcess(args, returncode, stdout, stderr)
+
+
+def run_with_selector(
+    args: Sequence[str], stdout_callback: Callable[[str], None]
+) -> subprocess.CompletedProcess[str]:
+    return CliTool(args[0]).run(args[1:], stdout_callback=stdout_callback)
+
+
+def benchmark(
+    name: str,
+    run: Callable[[Sequence[str], Callable[[str], None]], object],
+    lines: int,
+    processes: int,
+) -> None:
+    args = [sys.executable, "-c", CHATTY_SCRIPT, str(lines)]
+    peak_threads = threading.active_count()
+    lock = threading.Lock()
+
+    def count_threads(_: str) -> None:
+        nonlocal peak_threads
+        with lock:
+            peak_threads = max(peak_threads, threading.active_count())
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=processes) as pool:
+        for _ in range(processes):
+            pool.submit(run, args, count_threads)
+    elapsed = time.perf_counter() - start
+
+    total_lines = lines * processes * 11 // 10
+    print(
+        f"{name:>10}: {total_lines / elapsed:>12,.0f} lines/s, "
+        f"{elapsed:6.2f}s, peak threads: {peak_threads}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=200_000)
+    parser.add_argument("--processes", type=int, default=8)
+    args = parser.parse_args()
+
+    print(f"{args.processes} concurrent processes, {args.lines:,} stdout lines each")
+    benchmark("threads", run_with_threads, args.lines, args.processes)
+    benchmark("selector", run_with_selector, args.lines, args.processes)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,7 @@ import re
 from dataclasses import dataclass
 from typing import TYPE_CHECKING
 
+from konfusion import context
 from konfusion.cli import CliCommand
 from konfusion.lib.imageref import ImageRef
 from konfusion.lib.tools.skopeo import Skopeo
@@ -32,6 +33,8 @@ class ApplyTags(CliCommand):
          LABEL konflux.additional-tags="v1, v1.0"
     """
 
+    cacheable = True
+
     tags: list[str]
     image: ImageRef
 
@@ -44,7 +47,7 @@ class ApplyTags(CliCommand):
         )
 
     def run(self) -> None:
-        skopeo = Skopeo.find_in_path()
+        skopeo = self._skopeo()
 
         def apply_tag(tag: str) -> None:
             dest_image = self.image.replace(tag=tag, digest=None)
@@ -70,6 +73,15 @@ class ApplyTags(CliCommand):
         else:
             log.info("konflux.additional-tags label not found or empty")
 
+    @staticmethod
+    def _skopeo() -> Skopeo:
+        """Get the Skopeo shared by the commands in this konfusion process."""
+        ctx = context.current_or_none()
+        if ctx is None:
+            # Not run by konfusion (e.g. ApplyTags(...).run() from Python code)
+            return Skopeo.find_in_path()
+        return ctx.resource(Skopeo, Skopeo.find_in_path)
+
     @staticmethod
     def _parse_additional_tags_label(label: str) -> list[str]:
         """Parse the konflux.additional-tags label.
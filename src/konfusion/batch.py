@@ -0,0 +1,240 @@
+from __future__ import annotations
+
+import argparse
+import concurrent.futures
+import contextvars
+import dataclasses
+import graphlib
+import json
+import logging
+import sys
+import time
+from pathlib import Path
+from typing import Any, TypeGuard, cast
+
+from konfusion.cli import CliCommand, run_command
+from konfusion.command_index import CommandIndex
+from konfusion.lib import tracing
+from konfusion.logs import setup_logging
+from konfusion.main import load_commands
+
+log = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass(frozen=True, kw_only=True)
+class BatchStep:
+    """One subcommand invocation in a batch."""
+
+    name: str
+    argv: list[str]
+    needs: list[str]
+
+    @classmethod
+    def from_json(cls, data: Any, index: int) -> BatchStep:  # noqa: ANN401
+        """Parse a step from the batch file.
+
+        >>> BatchStep.from_json({"argv": ["apply-tags", "--tags", "v1"]}, 0)
+        BatchStep(name='0', argv=['apply-tags', '--tags', 'v1'], needs=[])
+
+        >>> BatchStep.from_json({"name": "a", "argv": ["foo"], "needs": ["b"]}, 1)
+        BatchStep(name='a', argv=['foo'], needs=['b'])
+        """
+        if not isinstance(data, dict):
+            raise ValueError(f"Step #{index}: expected an object, got {data!r}")
+
+        defaults: dict[str, Any] = {"name": str(index), "needs": []}
+        step = defaults | cast("dict[str, Any]", data)
+        unknown_keys = step.keys() - {"name", "argv", "needs"}
+        if unknown_keys:
+            raise ValueError(f"Step #{index}: unknown keys: {sorted(unknown_keys)}")
+
+        argv, needs = step.get("argv"), step["needs"]
+        if not _is_list_of_strings(argv) or not argv:
+            raise ValueError(
+                f"Step #{index}: 'argv' must be a non-empty list of strings"
+            )
+        if not _is_list_of_strings(needs):
+            raise ValueError(f"Step #{index}: 'needs' must be a list of strings")
+
+        return cls(name=str(step["name"]), argv=argv, needs=needs)
+
+
+def _positive_int(value: str) -> int:
+    """Parse a positive integer argument.
+
+    >>> _positive_int("4")
+    4
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer: {value!r}")
+    return number
+
+
+def _is_list_of_strings(obj: object) -> TypeGuard[list[str]]:
+    return isinstance(obj, list) and all(
+        isinstance(item, str) for item in cast("list[object]", obj)
+    )
+
+
+@dataclasses.dataclass(frozen=True, kw_only=True)
+class Batch(CliCommand):
+    """Run many subcommands in one process.
+
+    Reads a JSON list of subcommand invocations, for example:
+
+      [
+        {"name": "tags", "argv": ["apply-tags", "--to-image", "...", "--tags", "v1"]},
+        {"name": "containerfile", "argv": ["push-containerfile", "--for-image", "..."]},
+        {"argv": ["some-command"], "needs": ["tags", "containerfile"]}
+      ]
+
+    Steps run concurrently, unless a step 'needs' other steps. Such a step runs
+    only after all the steps it needs finished successfully. The name of a step
+    defaults to its position in the list (starting from 0).
+
+    All the steps get validated (parsed) before running any of them. If a step fails,
+    the steps that need it get skipped, but other steps still run to completion.
+    """
+
+    file: Path
+    workers: int
+
+    @classmethod
+    def setup_parser(cls, parser: argparse.ArgumentParser) -> None:
+        super().setup_parser(parser)
+        parser.add_argument("file", type=Path, help="the JSON file with the steps")
+        parser.add_argument(
+            "--workers",
+            type=_positive_int,
+            default=4,
+            help="the maximum number of steps to run concurrently (default: 4)",
+        )
+
+    def run(self) -> None:
+        steps = self._read_steps()
+        commands = self._parse_steps(steps)
+        needs = {step.name: step.needs for step in steps}
+
+        sorter = graphlib.TopologicalSorter(needs)
+        try:
+            sorter.prepare()
+        except graphlib.CycleError as e:
+            sys.exit(f"Steps have a circular dependency: {e.args[1]}")
+
+        failed: list[str] = []
+        skipped: list[str] = []
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            running: dict[concurrent.futures.Future[None], str] = {}
+
+            while sorter.is_active():
+                for name in sorter.get_ready():
+                    if any(dep in failed or dep in skipped for dep in needs[name]):
+                        log.warning(
+                            "[%s] Skipping, a step it needs did not succeed", name
+                        )
+                        skipped.append(name)
+                        sorter.done(name)
+                    else:
+                        context = contextvars.copy_context()
+                        future = pool.submit(
+                            context.run, self._run_step, name, commands[name]
+                        )
+                        running[future] = name
+
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    name = running.pop(future)
+                    if e := future.exception():
+                        log.error("[%s] Failed: %s: %s", name, type(e).__name__, e)
+                        failed.append(name)
+                    sorter.done(name)
+
+        if failed or skipped:
+            sys.exit(
+                f"Batch did not succeed. Failed steps: {failed}. Skipped steps: {skipped}."
+            )
+
+    def _read_steps(self) -> list[BatchStep]:
+        try:
+            data = json.loads(self.file.read_text())
+        except OSError as e:
+            sys.exit(f"Failed to read the steps: {e}")
+        except ValueError as e:
+            sys.exit(f"{self.file}: invalid JSON: {e}")
+        if not isinstance(data, list):
+            sys.exit(f"{self.file}: expected a list of steps")
+
+        try:
+            steps = [
+                BatchStep.from_json(step, i)
+                for i, step in enumerate(cast("list[Any]", data))
+            ]
+        except ValueError as e:
+            sys.exit(f"{self.file}: {e}")
+
+        names = [step.name for step in steps]
+        if duplicates := sorted({name for name in names if names.count(name) > 1}):
+            sys.exit(f"{self.file}: duplicate step names: {duplicates}")
+
+        for step in steps:
+            if unknown := sorted(set(step.needs) - set(names)):
+                sys.exit(f"[{step.name}] Needs unknown steps: {unknown}")
+
+        return steps
+
+    def _parse_steps(self, steps: list[BatchStep]) -> dict[str, CliCommand]:
+        """Load the subcommands used in the steps and parse the arguments of each step."""
+        available_commands = CommandIndex.load().commands
+        command_names = {step.argv[0] for step in steps}
+
+        if unknown := sorted(command_names - available_commands.keys()):
+            sys.exit(f"Unknown subcommands: {unknown}")
+
+        loaded_commands = load_commands(
+            {name: available_commands[name] for name in command_names}
+        )
+        if not_loaded := sorted(command_names - loaded_commands.keys()):
+            sys.exit(f"Failed to load subcommands: {not_loaded}")
+
+        konfusion_logger = logging.getLogger("konfusion")
+        setup_logging(
+            konfusion_logger.getEffectiveLevel(),
+            (cmd.__module__ for cmd in loaded_commands.values()),
+        )
+
+        commands: dict[str, CliCommand] = {}
+        for step in steps:
+            cmd_name, *args = step.argv
+            cmd_type = loaded_commands[cmd_name]
+
+            parser = argparse.ArgumentParser(prog=f"konfusion {cmd_name}")
+            cmd_type.setup_parser(parser)
+            try:
+                parsed_args = parser.parse_args(args)
+            except SystemExit:
+                log.error("[%s] Invalid arguments: %s", step.name, step.argv)
+                raise
+
+            commands[step.name] = cmd_type.from_parsed_args(parsed_args)
+
+        return commands
+
+    @staticmethod
+    def _run_step(name: str, cmd: CliCommand) -> None:
+        log.info("[%s] Starting", name)
+        start = time.monotonic()
+        with tracing.span("batch.step", step=name, command=type(cmd).__name__):
+            try:
+                run_command(cmd)
+            except SystemExit as e:
+                # E.g. sys.exit(0) to stop early, that's a success
+                if e.code not in (None, 0):
+                    raise
+        log.info("[%s] Finished in %.1fs", name, time.monotonic() - start)
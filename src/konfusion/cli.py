@@ -3,8 +3,12 @@ from __future__ import annotations
 import abc
 import argparse
 import dataclasses
+import logging
 import textwrap
-from typing import Self
+from collections.abc import Coroutine
+from typing import Any, ClassVar, Self
+
+log = logging.getLogger(__name__)
 
 
 @dataclasses.dataclass(frozen=True, kw_only=True)
@@ -56,6 +60,11 @@ class CliCommand(abc.ABC):
         self.a_list = [1, 2]
     """
 
+    # Set to True if re-running the command with the same arguments would achieve
+    # nothing new, provided all the images in the arguments are pinned by digest.
+    # Enables skipping the command with --result-cache, see konfusion.result_cache.
+    cacheable: ClassVar[bool] = False
+
     @classmethod
     def help(cls) -> str | None:
         """Return the help text for this command. Should be a short sentence.
@@ -98,8 +107,70 @@ class CliCommand(abc.ABC):
         return cls(**kwargs)
 
     @abc.abstractmethod
-    def run(self) -> None:
-        """Run this command."""
+    def run(self) -> Coroutine[Any, Any, None] | None:
+        """Run this command.
+
+        Can also be an 'async def' method, see run_command().
+        """
+
+
+def run_command(cmd: CliCommand) -> None:
+    """Run a command. If its run() method is async, run it on a new event loop.
+
+    When running in the main thread, SIGTERM (e.g. from a Tekton timeout) cancels
+    the async run() and exits with status 143. SIGINT (Ctrl-C) cancels it too,
+    and raises KeyboardInterrupt afterwards, as usual.
+
+    >>> import asyncio
+
+    >>> @dataclasses.dataclass(frozen=True, kw_only=True)
+    ... class AsyncCommand(CliCommand):
+    ...     async def run(self) -> None:
+    ...         await asyncio.sleep(0)
+    ...         print("Ran on an event loop")
+
+    >>> run_command(AsyncCommand())
+    Ran on an event loop
+    """
+    result = cmd.run()
+    if isinstance(result, Coroutine):
+        _run_coroutine(result)
+
+
+def _run_coroutine(coro: Coroutine[Any, Any, None]) -> None:
+    # Imported lazily, only async commands should pay for importing asyncio
+    import asyncio
+    import signal
+    import threading
+
+    handle_sigterm = threading.current_thread() is threading.main_thread()
+    got_sigterm = False
+
+    async def main() -> None:
+        task = asyncio.current_task()
+        loop = asyncio.get_running_loop()
+
+        def on_sigterm() -> None:
+            nonlocal got_sigterm
+            got_sigterm = True
+            log.warning("Received SIGTERM, cancelling")
+            if task:
+                task.cancel()
+
+        if handle_sigterm:
+            loop.add_signal_handler(signal.SIGTERM, on_sigterm)
+        await coro
+
+    original_sigterm_handler = signal.getsignal(signal.SIGTERM)
+    try:
+        asyncio.run(main())
+    except asyncio.CancelledError:
+        if got_sigterm:
+            raise SystemExit(128 + signal.SIGTERM) from None
+        raise
+    finally:
+        if handle_sigterm and original_sigterm_handler is not None:
+            signal.signal(signal.SIGTERM, original_sigterm_handler)
 
 
 def _dedent_docstring(docstring: str) -> str:
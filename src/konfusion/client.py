@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+# Don't import anything heavy here (including the rest of konfusion), the whole point
+# of the client is to start faster than 'konfusion' itself
+import json
+import os
+import socket
+import sys
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Sequence
+    from pathlib import Path
+
+SOCKET_ENV_VAR = "KONFUSION_SOCKET"
+
+
+def request(socket_path: str | Path, argv: Sequence[str]) -> int:
+    """Run a konfusion subcommand on the server, return the exit status.
+
+    Writes the output of the subcommand to sys.stdout and sys.stderr.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(socket_path))
+        sock.sendall(json.dumps({"argv": list(argv)}).encode() + b"\n")
+
+        with sock.makefile("rb") as responses:
+            for line in responses:
+                response = json.loads(line)
+                if "exit" in response:
+                    return response["exit"]
+
+                stream = sys.stdout if response["stream"] == "stdout" else sys.stderr
+                stream.write(response["data"])
+                stream.flush()
+
+    print("konfusion-client: the server closed the connection", file=sys.stderr)
+    return 1
+
+
+def main(argv: Sequence[str] | None = None) -> None:
+    """Run konfusion-client, a thin client for 'konfusion serve'.
+
+    Takes the same arguments as konfusion. Connects to the socket at $KONFUSION_SOCKET.
+    """
+    socket_path = os.environ.get(SOCKET_ENV_VAR)
+    if not socket_path:
+        sys.exit(f"konfusion-client: ${SOCKET_ENV_VAR} is not set")
+
+    sys.exit(request(socket_path, sys.argv[1:] if argv is None else argv))
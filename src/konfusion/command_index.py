@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+import dataclasses
+import importlib
+import json
+import logging
+import re
+import site
+import sys
+import zlib
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Self
+
+from konfusion.lib.cache import cache_dir, write_atomically
+
+if TYPE_CHECKING:
+    from collections.abc import Sequence
+
+log = logging.getLogger(__name__)
+
+ENTRYPOINT_GROUP = "konfusion.commands"
+
+# Bump when the format of the index file changes
+_INDEX_FORMAT_VERSION = 1
+
+# Same as importlib.metadata.EntryPoint.pattern
+_ENTRYPOINT_VALUE_RE = re.compile(
+    r"(?P<module>[\w.]+)\s*(:\s*(?P<attr>[\w.]+)\s*)?((?P<extras>\[.*\])\s*)?$"
+)
+
+type _Fingerprint = list[tuple[str, int | None]]
+
+
+@dataclasses.dataclass(frozen=True, kw_only=True)
+class IndexedCommand:
+    """A 'konfusion.commands' entrypoint and the distribution that provides it."""
+
+    name: str
+    value: str
+    dist_name: str
+    dist_version: str
+
+    @property
+    def module(self) -> str:
+        """The name of the module that the entrypoint references."""
+        return self._parse_value()[0]
+
+    def load(self) -> Any:  # noqa: ANN401
+        """Load the object referenced by the entrypoint.
+
+        Same as importlib.metadata.EntryPoint.load(), but doesn't need any metadata.
+
+        >>> import json
+        >>> cmd = IndexedCommand(
+        ...     name="x", value="json : dumps", dist_name="x", dist_version="1"
+        ... )
+        >>> assert cmd.load() is json.dumps
+        """
+        module_name, attr = self._parse_value()
+        obj: Any = importlib.import_module(module_name)
+        for name in filter(None, attr.split(".")):
+            obj = getattr(obj, name)
+        return obj
+
+    def _parse_value(self) -> tuple[str, str]:
+        match = _ENTRYPOINT_VALUE_RE.match(self.value)
+        if not match:
+            raise ValueError(f"Invalid entrypoint value: {self.value!r}")
+        return match.group("module"), match.group("attr") or ""
+
+
+@dataclasses.dataclass(frozen=True, kw_only=True)
+class CommandIndex:
+    """Index of available Konfusion commands.
+
+    Scanning the installed distributions for entrypoints requires reading the metadata
+    of every single distribution in the environment (and importing importlib.metadata,
+    which is itself fairly expensive). To keep startup fast, the index gets cached
+    on disk and only rebuilt when the installed distributions change.
+    """
+
+    konfusion_version: str
+    commands: dict[str, IndexedCommand]
+
+    @classmethod
+    def from_metadata(cls) -> Self:
+        """Build the index by scanning the metadata of installed distributions."""
+        # Expensive to import, only do it when needed
+        import importlib.metadata
+
+        commands: dict[str, IndexedCommand] = {}
+        for entrypoint in importlib.metadata.entry_points(group=ENTRYPOINT_GROUP):
+            if entrypoint.dist:
+                dist_name = entrypoint.dist.name
+                dist_version = entrypoint.dist.version
+            else:
+                dist_name = entrypoint.module.partition(".")[0]
+                dist_version = importlib.metadata.version(dist_name)
+
+            commands[entrypoint.name] = IndexedCommand(
+                name=entrypoint.name,
+                value=entrypoint.value,
+                dist_name=dist_name,
+                dist_version=dist_version,
+            )
+
+        return cls(
+            konfusion_version=importlib.metadata.version("konfusion"),
+            commands=commands,
+        )
+
+    @classmethod
+    def load(cls, index_dir: Path | None = None) -> Self:
+        """Load the cached index, rebuild it first if it's missing or outdated.
+
+        The index is considered outdated if any of the sys.path entries changed
+        (installing or uninstalling a distribution modifies the directory it's
+        installed in). Failure to read or write the cache is not fatal.
+        """
+        index_path = _index_path(index_dir or cache_dir())
+        fingerprint = _fingerprint(_install_paths())
+
+        try:
+            with index_path.open() as f:
+                data = json.load(f)
+            if data["format_version"] == _INDEX_FORMAT_VERSION and (
+                _fingerprint_from_json(data["fingerprint"]) == fingerprint
+            ):
+                log.debug("Using cached command index: %s", index_path)
+                return cls._from_json(data)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.debug("Failed to read command index %s: %r", index_path, e)
+
+        log.debug("Scanning installed distributions for commands")
+        index = cls.from_metadata()
+
+        try:
+            write_atomically(index_path, json.dumps(index._to_json(fingerprint)))
+        except OSError as e:
+            log.debug("Failed to write command index %s: %r", index_path, e)
+
+        return index
+
+    def _to_json(self, fingerprint: _Fingerprint) -> dict[str, Any]:
+        return {
+            "format_version": _INDEX_FORMAT_VERSION,
+            "fingerprint": fingerprint,
+            "konfusion_version": self.konfusion_version,
+            "commands": [dataclasses.asdict(cmd) for cmd in self.commands.values()],
+        }
+
+    @classmethod
+    def _from_json(cls, data: dict[str, Any]) -> Self:
+        commands = [IndexedCommand(**cmd) for cmd in data["commands"]]
+        return cls(
+            konfusion_version=data["konfusion_version"],
+            commands={cmd.name: cmd for cmd in commands},
+        )
+
+
+def _index_path(index_dir: Path) -> Path:
+    # One index per Python environment
+    env_id = zlib.crc32(sys.prefix.encode())
+    return index_dir / f"command-index-{env_id:08x}.json"
+
+
+def _install_paths() -> list[str]:
+    """Get the sys.path entries where distributions can be installed.
+
+    Leaves out the script directory (or the current directory) that Python puts
+    first in sys.path, unless it's a site-packages directory. Otherwise running
+    konfusion from another directory would rebuild the index.
+    """
+    if sys.path and not sys.flags.safe_path:
+        site_dirs = {*site.getsitepackages(), site.getusersitepackages()}
+        if sys.path[0] not in site_dirs:
+            return sys.path[1:]
+    return sys.path
+
+
+def _fingerprint(paths: Sequence[str]) -> _Fingerprint:
+    def mtime(path: str) -> int | None:
+        try:
+            return Path(path).stat().st_mtime_ns
+        except OSError:
+            return None
+
+    return [(path, mtime(path)) for path in paths]
+
+
+def _fingerprint_from_json(data: list[list[Any]]) -> _Fingerprint:
+    return [(path, mtime) for path, mtime in data]
@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import contextlib
+import threading
+from typing import TYPE_CHECKING, Any, cast
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Generator, Hashable
+    from concurrent.futures import ThreadPoolExecutor
+    from contextlib import AbstractContextManager
+
+
+class Context:
+    """Resources shared by the commands that run in one konfusion process.
+
+    Holds lazily created, reusable resources (e.g. CLI tools, thread pools, caches).
+    Each resource gets created on first use and then reused by all the commands that
+    run in the same process (e.g. the steps of 'konfusion batch' or the requests
+    of 'konfusion serve'). Resources that need cleanup get closed, in reverse order
+    of creation, when the context closes.
+
+    Konfusion creates the context before running a command, get it with current().
+
+    >>> with Context() as context:
+    ...     numbers = context.resource("numbers", list)
+    ...     numbers.append(1)
+    ...     context.resource("numbers", list)
+    [1]
+
+    The resources must be safe to use from multiple threads at once.
+    """
+
+    def __init__(self) -> None:
+        self._resources: dict[Hashable, Any] = {}
+        # Reentrant, so that a factory can depend on other resources
+        self._lock = threading.RLock()
+        self._exit_stack = contextlib.ExitStack()
+
+    def resource[T](self, key: Hashable, factory: Callable[[], T]) -> T:
+        """Get the resource identified by key, call factory() to create it if needed."""
+        with self._lock:
+            if key not in self._resources:
+                self._resources[key] = factory()
+            return cast("T", self._resources[key])
+
+    def managed_resource[T](
+        self, key: Hashable, factory: Callable[[], AbstractContextManager[T]]
+    ) -> T:
+        """Like resource(), but the factory returns a context manager.
+
+        The context manager gets entered on creation and exited when this context closes.
+
+        >>> @contextlib.contextmanager
+        ... def connection():
+        ...     print("connect")
+        ...     yield "connection"
+        ...     print("disconnect")
+
+        >>> with Context() as context:
+        ...     context.managed_resource("conn", connection)
+        ...     context.managed_resource("conn", connection)
+        connect
+        'connection'
+        'connection'
+        disconnect
+        """
+        with self._lock:
+            if key not in self._resources:
+                self._resources[key] = self._exit_stack.enter_context(factory())
+            return cast("T", self._resources[key])
+
+    def executor(self) -> ThreadPoolExecutor:
+        """Get a thread pool shared by all the commands in this context."""
+        from concurrent.futures import ThreadPoolExecutor
+
+        return self.managed_resource(
+            (Context, "executor"),
+            lambda: ThreadPoolExecutor(thread_name_prefix="konfusion"),
+        )
+
+    def close(self) -> None:
+        """Close the resources created in this context."""
+        with self._lock:
+            self._resources.clear()
+            self._exit_stack.close()
+
+    def __enter__(self) -> Context:
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        self.close()
+
+
+_context: Context | None = None
+
+
+def current() -> Context:
+    """Get the context of the running konfusion process."""
+    if _context is None:
+        raise RuntimeError("No active konfusion context, see konfusion.context.new()")
+    return _context
+
+
+def current_or_none() -> Context | None:
+    """Get the context of the running konfusion process, None if there is none.
+
+    For code that also runs outside of konfusion commands (e.g. called from Python).
+    """
+    return _context
+
+
+@contextlib.contextmanager
+def new() -> Generator[Context]:
+    """Create a new context and make it the current one. Close it on exit."""
+    global _context  # noqa: PLW0603
+
+    previous = _context
+    with Context() as context:
+        _context = context
+        try:
+            yield context
+        finally:
+            _context = previous
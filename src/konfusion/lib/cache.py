@@ -0,0 +1,31 @@
+from __future__ import annotations
+
+import os
+from pathlib import Path
+
+
+def cache_dir() -> Path:
+    """Return the directory for Konfusion's on-disk caches.
+
+    Uses $KONFUSION_CACHE_DIR if set, otherwise $XDG_CACHE_HOME/konfusion
+    (defaults to ~/.cache/konfusion). The directory may not exist yet.
+    """
+    if konfusion_cache_dir := os.getenv("KONFUSION_CACHE_DIR"):
+        return Path(konfusion_cache_dir)
+
+    xdg_cache_home = os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(xdg_cache_home, "konfusion")
+
+
+def write_atomically(path: Path, content: str) -> None:
+    """Write content to a file so that readers never see a partially written file.
+
+    Creates the parent directories if needed.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        tmp_path.write_text(content)
+        tmp_path.replace(path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
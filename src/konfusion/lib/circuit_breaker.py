@@ -0,0 +1,246 @@
+from __future__ import annotations
+
+import collections
+import contextlib
+import dataclasses
+import logging
+import threading
+import time
+from typing import TYPE_CHECKING
+
+from konfusion.lib.deadline import DeadlineExceededError
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Generator, Iterable
+
+log = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """Not calling a service (e.g. a registry), it has been failing too often.
+
+    The retry_after is the number of seconds until the circuit lets calls through
+    again, shared by all the callers.
+    """
+
+    def __init__(self, key: str, retry_after: float) -> None:
+        super().__init__(
+            f"{key} has been failing too often, not calling it for {retry_after:.1f}s"
+        )
+        self.key = key
+        self.retry_after = retry_after
+
+
+@dataclasses.dataclass(kw_only=True)
+class _Circuit:
+    # (time.monotonic(), ok) of the recent calls
+    outcomes: collections.deque[tuple[float, bool]]
+    retry_tokens: float
+    tokens_updated_at: float
+    open_until: float = 0.0
+    times_opened: int = 0
+    # While half-open, only one call at a time gets through to probe the service
+    probe_until: float = 0.0
+
+
+class CircuitBreaker:
+    """Circuit breakers and retry budgets shared by all the callers of each service.
+
+    When a service (keyed e.g. by the registry host) degrades, independent retries
+    in every concurrent operation make things worse. Instead:
+
+    * Once at least min_calls calls in the last window seconds were made and
+      failure_ratio of them failed, the circuit opens: calls fail fast with
+      CircuitOpenError for open_for seconds (doubling each time the circuit opens
+      again right away, up to max_open_for). All the callers share that backoff.
+      When it passes, one call at a time goes through to probe the service,
+      the first success closes the circuit.
+    * Each retry takes a token from the retry budget of the service. The budget holds
+      up to retry_budget tokens and refills at refill_per_second. When it runs out,
+      failures are not retried.
+
+    >>> breaker = CircuitBreaker(min_calls=3, failure_ratio=0.5)
+    >>> for ok in [True, False, False]:
+    ...     breaker.record("quay.io", ok=ok)
+    >>> try:
+    ...     breaker.check("quay.io")
+    ... except CircuitOpenError as e:
+    ...     print(e)
+    quay.io has been failing too often, not calling it for 5.0s
+    """
+
+    def __init__(
+        self,
+        *,
+        window: float = 60.0,
+        min_calls: int = 5,
+        failure_ratio: float = 0.5,
+        open_for: float = 5.0,
+        max_open_for: float = 120.0,
+        retry_budget: int = 20,
+        refill_per_second: float = 0.5,
+    ) -> None:
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.open_for = open_for
+        self.max_open_for = max_open_for
+        self.retry_budget = retry_budget
+        self.refill_per_second = refill_per_second
+        self._lock = threading.Lock()
+        self._circuits: dict[str, _Circuit] = {}
+
+    def check(self, key: str) -> None:
+        """Raise CircuitOpenError if the circuit for the key is open."""
+        now = time.monotonic()
+        with self._lock:
+            circuit = self._circuit(key)
+            left = max(circuit.open_until, circuit.probe_until) - now
+            if left <= 0 and circuit.times_opened:
+                # Half-open, let this call probe the service. If it never records
+                # the outcome, let another one through after a while.
+                circuit.probe_until = now + self.open_for
+        if left > 0:
+            raise CircuitOpenError(key, left)
+
+    def release(self, key: str) -> None:
+        """Give up the call that passed check() without an outcome to record.
+
+        If the call was probing a half-open circuit, lets the next one probe.
+        """
+        with self._lock:
+            self._circuit(key).probe_until = 0.0
+
+    def record(self, key: str, *, ok: bool) -> None:
+        """Record the outcome of a call, open or close the circuit as needed."""
+        now = time.monotonic()
+        with self._lock:
+            circuit = self._circuit(key)
+            circuit.probe_until = 0.0
+            half_open = circuit.times_opened > 0 and now >= circuit.open_until
+            if ok and half_open:
+                log.info("%s is working again", key)
+                circuit.outcomes.clear()
+                circuit.times_opened = 0
+
+            circuit.outcomes.append((now, ok))
+            while circuit.outcomes and circuit.outcomes[0][0] < now - self.window:
+                circuit.outcomes.popleft()
+
+            if ok or now < circuit.open_until:
+                return
+
+            failures = sum(1 for _, outcome_ok in circuit.outcomes if not outcome_ok)
+            if half_open or (
+                len(circuit.outcomes) >= self.min_calls
+                and failures >= self.failure_ratio * len(circuit.outcomes)
+            ):
+                open_for = min(
+                    self.max_open_for, self.open_for * 2**circuit.times_opened
+                )
+                circuit.open_until = now + open_for
+                circuit.times_opened += 1
+                log.warning(
+                    "%s: %d of the last %d calls failed, not calling it for %.1fs",
+                    key,
+                    failures,
+                    len(circuit.outcomes),
+                    open_for,
+                )
+
+    def try_retry(self, keys: Iterable[str]) -> bool:
+        """Take a token from the retry budget of each key, if all of them have one."""
+        now = time.monotonic()
+        with self._lock:
+            circuits = {key: self._circuit(key) for key in keys}
+            for circuit in circuits.values():
+                refill = (now - circuit.tokens_updated_at) * self.refill_per_second
+                circuit.retry_tokens = min(
+                    self.retry_budget, circuit.retry_tokens + refill
+                )
+                circuit.tokens_updated_at = now
+
+            exhausted = [key for key, c in circuits.items() if c.retry_tokens < 1]
+            if exhausted:
+                log.warning(
+                    "Not retrying, the retry budget is exhausted for %s",
+                    ", ".join(exhausted),
+                )
+                return False
+
+            for circuit in circuits.values():
+                circuit.retry_tokens -= 1
+            return True
+
+    @contextlib.contextmanager
+    def guard(
+        self, keys: Iterable[str], failed_keys: Callable[[Exception], Iterable[str]]
+    ) -> Generator[None]:
+        """Check the circuits before a call to the services, record the outcome after.
+
+        If the call raises an exception, failed_keys tells which of the services
+        failed (none if the exception doesn't mean that a service is failing).
+        If it runs out of time (DeadlineExceededError), records nothing, that says
+        nothing about the services. Works around awaits too, the checking and
+        recording don't block.
+        """
+        keys = list(keys)
+        checked: list[str] = []
+        try:
+            for key in keys:
+                self.check(key)
+                checked.append(key)
+        except CircuitOpenError:
+            for key in checked:
+                self.release(key)
+            raise
+
+        try:
+            yield
+        except DeadlineExceededError:
+            for key in keys:
+                self.release(key)
+            raise
+        except Exception as e:
+            failed = set(failed_keys(e))
+            for key in keys:
+                self.record(key, ok=key not in failed)
+            raise
+
+        for key in keys:
+            self.record(key, ok=True)
+
+    def _circuit(self, key: str) -> _Circuit:
+        """Get the circuit for the key. Call with the lock."""
+        if key not in self._circuits:
+            self._circuits[key] = _Circuit(
+                outcomes=collections.deque(),
+                retry_tokens=self.retry_budget,
+                tokens_updated_at=time.monotonic(),
+            )
+        return self._circuits[key]
+
+
+_breaker: CircuitBreaker | None = None
+_breaker_lock = threading.Lock()
+
+
+def get_circuit_breaker() -> CircuitBreaker:
+    """Get the circuit breaker shared by everything in this process."""
+    global _breaker  # noqa: PLW0603
+
+    with _breaker_lock:
+        if _breaker is None:
+            _breaker = CircuitBreaker()
+        return _breaker
+
+
+def set_circuit_breaker(breaker: CircuitBreaker | None) -> None:
+    """Replace the shared circuit breaker (e.g. to change the thresholds).
+
+    Set to None to go back to the default, created on first use.
+    """
+    global _breaker  # noqa: PLW0603
+
+    with _breaker_lock:
+        _breaker = breaker
@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import contextlib
+import contextvars
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Generator
+
+# The deadline in time.monotonic() terms, None if there is no deadline
+_deadline: contextvars.ContextVar[float | None] = contextvars.ContextVar(
+    "_deadline", default=None
+)
+
+
+class DeadlineExceededError(TimeoutError):
+    """The deadline passed before the operation could finish."""
+
+
+@contextlib.contextmanager
+def within(seconds: float | None) -> Generator[None]:
+    """Set a deadline, seconds from now, for the code inside this context.
+
+    The retries (konfusion.lib.retry) and the CLI tools (konfusion.lib.tools)
+    honor the deadline. A nested deadline can only make the current one sooner.
+    If seconds is None, keeps the current deadline (if any).
+
+    >>> with within(60):
+    ...     with within(3600):
+    ...         remaining() <= 60
+    True
+    """
+    if seconds is None:
+        yield
+        return
+
+    new_deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    if current is not None:
+        new_deadline = min(new_deadline, current)
+
+    token = _deadline.set(new_deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> float | None:
+    """Get the number of seconds until the deadline (can be negative).
+
+    None if there is no deadline.
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def check(operation: str) -> None:
+    """Raise DeadlineExceededError if the deadline has passed."""
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceededError(
+            f"Deadline exceeded {-left:.1f}s ago, not starting {operation}"
+        )
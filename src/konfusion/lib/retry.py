@@ -1,13 +1,24 @@
 from __future__ import annotations
 
+import contextvars
+import dataclasses
+import datetime as dt
+import functools
+import inspect
 import logging
+import time
 from collections.abc import Callable
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Any, cast
 
 import stamina
 
+from konfusion.lib import deadline, tracing
+from konfusion.lib.circuit_breaker import get_circuit_breaker
+from konfusion.lib.deadline import DeadlineExceededError
+
 if TYPE_CHECKING:
-    import datetime as dt
+    from collections.abc import Iterable
+    from contextlib import AbstractContextManager
 
     from stamina.typing import RetryDetails
 
@@ -15,17 +26,39 @@ log = logging.getLogger(__name__)
 
 
 def _log_retries(details: RetryDetails) -> None:
+    # Stamina doesn't know about the immediate retries, use our own attempt count
+    state = _attempts.get(None)
     log.warning(
         "%s: attempt %d failed, retrying in %f seconds: %s: %s",
         details.name,
-        details.retry_num,
+        state.num if state else details.retry_num,
         details.wait_for,
         type(details.caused_by).__name__,
         str(details.caused_by),
     )
 
 
-stamina.instrumentation.set_on_retry_hooks([_log_retries])
+def _trace_retries(details: RetryDetails) -> None:
+    if tracer := tracing.get_tracer():
+        tracer.add_span(
+            "retry.wait",
+            tracer.now_ns(),
+            int(details.wait_for * 1e9),
+            {"function": details.name, "retry_num": details.retry_num},
+        )
+
+
+stamina.instrumentation.set_on_retry_hooks([_log_retries, _trace_retries])
+
+
+@dataclasses.dataclass(kw_only=True)
+class _Attempts:
+    num: int = 0
+    started_at: float = 0.0
+
+
+# The attempts of the innermost retried function call
+_attempts: contextvars.ContextVar[_Attempts] = contextvars.ContextVar("_attempts")
 
 
 type ExcOrPredicate = (
@@ -42,6 +75,9 @@ def retry[**P, T](
     wait_max: float | dt.timedelta = 120.0,
     wait_jitter: float | dt.timedelta = 1.0,
     wait_exp_base: float = 2.0,
+    immediately_on: ExcOrPredicate | None = None,
+    retry_after: Callable[[Exception], float | None] | None = None,
+    budget_keys: Callable[[Exception], Iterable[str]] | None = None,
 ) -> Callable[[Callable[P, T]], Callable[P, T]]:
     """Wrapper around stamina.retry with different defaults.
 
@@ -60,9 +96,25 @@ def retry[**P, T](
 
         [1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 64.0, 120.0, 120.0]
         sum(above) = 367.0 = 6m7s
+
+    Honors the deadline set by konfusion.lib.deadline.within(). Doesn't retry
+    if the deadline would pass before the next attempt finishes (estimating that
+    it takes as long as the last one) and doesn't start attempts after the deadline.
+
+    Retries the immediately_on exceptions right away, without waiting (e.g. when
+    the operation failed in a way that waiting won't help with). If retry_after
+    returns a number of seconds for an 'on' exception (e.g. the Retry-After
+    of an HTTP 429), waits that long (at most wait_max) instead of the exponential
+    backoff. These retries count towards the attempts too.
+
+    If budget_keys returns keys for an exception (e.g. the registry hosts that failed),
+    each retry takes a token from the shared retry budgets of those keys, see
+    konfusion.lib.circuit_breaker. Doesn't retry when a budget is exhausted.
     """
-    return stamina.retry(
-        on=on,
+    stamina_retry = stamina.retry(
+        on=_deadline_aware(
+            on, attempts, budget_keys, wait_initial, wait_max, wait_exp_base
+        ),
         attempts=attempts,
         timeout=timeout,
         wait_initial=wait_initial,
@@ -70,3 +122,208 @@ def retry[**P, T](
         wait_jitter=wait_jitter,
         wait_exp_base=wait_exp_base,
     )
+
+    def decorator(fn: Callable[P, T]) -> Callable[P, T]:
+        return _with_attempt_spans(
+            fn,
+            stamina_retry,
+            _without_backoff(
+                on, immediately_on, retry_after, attempts, budget_keys, wait_max
+            ),
+        )
+
+    return decorator
+
+
+def _matches(on: ExcOrPredicate, exc: Exception) -> bool:
+    if isinstance(on, type | tuple):
+        return isinstance(exc, on)
+    return on(exc)
+
+
+def _within_budget(
+    budget_keys: Callable[[Exception], Iterable[str]] | None, exc: Exception
+) -> bool:
+    if budget_keys is None:
+        return True
+    keys = list(budget_keys(exc))
+    return not keys or get_circuit_breaker().try_retry(keys)
+
+
+def _deadline_aware(
+    on: ExcOrPredicate,
+    attempts: int | None,
+    budget_keys: Callable[[Exception], Iterable[str]] | None,
+    wait_initial: float | dt.timedelta,
+    wait_max: float | dt.timedelta,
+    wait_exp_base: float,
+) -> Callable[[Exception], bool]:
+    """Turn the 'on' argument into a predicate that also checks the deadline.
+
+    And the attempts and the retry budgets, which stamina doesn't know about.
+    """
+    if isinstance(wait_initial, dt.timedelta):
+        wait_initial = wait_initial.total_seconds()
+    if isinstance(wait_max, dt.timedelta):
+        wait_max = wait_max.total_seconds()
+
+    def should_retry(exc: Exception) -> bool:
+        if isinstance(exc, DeadlineExceededError) or not _matches(on, exc):
+            return False
+
+        # The immediate retries count towards the attempts, stamina doesn't see them
+        state = _attempts.get()
+        if attempts is not None and state.num >= attempts:
+            return False
+
+        left = deadline.remaining()
+        if left is None:
+            return _within_budget(budget_keys, exc)
+
+        # Same as the stamina backoff, without the jitter
+        wait = min(wait_max, wait_initial * wait_exp_base ** (state.num - 1))
+        needed = wait + time.monotonic() - state.started_at
+        if left < needed:
+            log.warning(
+                "Not retrying, %.1fs left until the deadline, the next attempt "
+                "would need about %.1fs: %s: %s",
+                left,
+                needed,
+                type(exc).__name__,
+                str(exc),
+            )
+            return False
+
+        return _within_budget(budget_keys, exc)
+
+    return should_retry
+
+
+def _without_backoff(
+    on: ExcOrPredicate,
+    immediately_on: ExcOrPredicate | None,
+    retry_after: Callable[[Exception], float | None] | None,
+    attempts: int | None,
+    budget_keys: Callable[[Exception], Iterable[str]] | None,
+    wait_max: float | dt.timedelta,
+) -> Callable[[str, Exception], float | None]:
+    """Make a function that decides whether to retry without the stamina backoff.
+
+    It returns the number of seconds to wait before the next attempt, or None
+    to leave the exception to stamina.
+    """
+    if isinstance(wait_max, dt.timedelta):
+        wait_max = wait_max.total_seconds()
+
+    def wait_before_retry(name: str, exc: Exception) -> float | None:
+        if isinstance(exc, DeadlineExceededError):
+            return None
+        if immediately_on is not None and _matches(immediately_on, exc):
+            wait = 0.0
+        elif (
+            retry_after is not None
+            and (advertised := retry_after(exc)) is not None
+            and _matches(on, exc)
+        ):
+            wait = min(max(advertised, 0.0), wait_max)
+        else:
+            return None
+
+        state = _attempts.get()
+        if attempts is not None and state.num >= attempts:
+            return None
+        left = deadline.remaining()
+        if left is not None and left < wait + time.monotonic() - state.started_at:
+            return None
+        if not _within_budget(budget_keys, exc):
+            return None
+
+        log.warning(
+            "%s: attempt %d failed, retrying %s: %s: %s",
+            name,
+            state.num,
+            f"in {wait:f} seconds (as advised)" if wait else "immediately",
+            type(exc).__name__,
+            str(exc),
+        )
+        return wait
+
+    return wait_before_retry
+
+
+def _with_attempt_spans[**P, T](
+    fn: Callable[P, T],
+    stamina_retry: Callable[[Callable[P, Any]], Callable[P, Any]],
+    wait_before_retry: Callable[[str, Exception], float | None],
+) -> Callable[P, T]:
+    """Retry fn, record a tracing span for each attempt."""
+    name = f"{fn.__module__}.{fn.__qualname__}"
+
+    def attempt_span() -> AbstractContextManager[dict[str, Any]]:
+        deadline.check(name)
+        attempts = _attempts.get()
+        attempts.num += 1
+        attempts.started_at = time.monotonic()
+        return tracing.span("retry.attempt", function=name, attempt=attempts.num)
+
+    def retry_wait_span() -> AbstractContextManager[dict[str, Any]]:
+        return tracing.span("retry.wait", function=name, retry_num=_attempts.get().num)
+
+    if inspect.iscoroutinefunction(fn):
+        async_fn = cast("Callable[P, Any]", fn)
+
+        @functools.wraps(fn)
+        async def async_attempt(*args: P.args, **kwargs: P.kwargs) -> Any:  # noqa: ANN401
+            while True:
+                try:
+                    with attempt_span():
+                        return await async_fn(*args, **kwargs)
+                except Exception as e:
+                    wait = wait_before_retry(name, e)
+                    if wait is None:
+                        raise
+                if wait:
+                    # Imported lazily, decorating a coroutine function at import
+                    # time shouldn't import asyncio (e.g. for --help)
+                    import asyncio
+
+                    with retry_wait_span():
+                        await asyncio.sleep(wait)
+
+        async_retrying = stamina_retry(async_attempt)
+
+        @functools.wraps(fn)
+        async def async_wrapper(*args: P.args, **kwargs: P.kwargs) -> Any:  # noqa: ANN401
+            token = _attempts.set(_Attempts())
+            try:
+                return await async_retrying(*args, **kwargs)
+            finally:
+                _attempts.reset(token)
+
+        return cast("Callable[P, T]", async_wrapper)
+
+    @functools.wraps(fn)
+    def attempt(*args: P.args, **kwargs: P.kwargs) -> T:
+        while True:
+            try:
+                with attempt_span():
+                    return fn(*args, **kwargs)
+            except Exception as e:
+                wait = wait_before_retry(name, e)
+                if wait is None:
+                    raise
+            if wait:
+                with retry_wait_span():
+                    time.sleep(wait)
+
+    retrying = stamina_retry(attempt)
+
+    @functools.wraps(fn)
+    def wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
+        token = _attempts.set(_Attempts())
+        try:
+            return retrying(*args, **kwargs)
+        finally:
+            _attempts.reset(token)
+
+    return wrapper
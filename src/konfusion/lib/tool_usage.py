@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import contextlib
+import contextvars
+import dataclasses
+import logging
+import threading
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Generator
+
+    from konfusion.lib.tools import ResourceUsage
+
+log = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass(kw_only=True)
+class UsageTotals:
+    """Resources used by all the processes of one CLI tool."""
+
+    processes: int = 0
+    wall_time: float = 0.0
+    user_time: float = 0.0
+    system_time: float = 0.0
+    max_rss: int = 0
+    block_reads: int = 0
+    block_writes: int = 0
+
+    def add(self, usage: ResourceUsage) -> None:
+        self.processes += 1
+        self.wall_time += usage.wall_time
+        self.user_time += usage.user_time
+        self.system_time += usage.system_time
+        self.max_rss = max(self.max_rss, usage.max_rss)
+        self.block_reads += usage.block_reads
+        self.block_writes += usage.block_writes
+
+
+# The totals of the current tracking() scope, None outside of any
+_scoped_totals: contextvars.ContextVar[dict[str, UsageTotals] | None] = (
+    contextvars.ContextVar("_scoped_totals", default=None)
+)
+_process_totals: dict[str, UsageTotals] = {}
+_totals_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def tracking() -> Generator[None]:
+    """Track the resources used by the CLI tools in this context separately.
+
+    E.g. for each command that runs in one konfusion process (see 'konfusion serve').
+    Starts from zero. Threads that run in a copy of this context share the totals.
+
+    >>> from konfusion.lib.tools import ResourceUsage
+    >>> usage = ResourceUsage(
+    ...     wall_time=1.0,
+    ...     user_time=0.5,
+    ...     system_time=0.1,
+    ...     max_rss=1024,
+    ...     block_reads=0,
+    ...     block_writes=0,
+    ... )
+    >>> with tracking():
+    ...     record_usage("skopeo", usage)
+    ...     with tracking():
+    ...         record_usage("skopeo", usage)
+    ...         usage_totals()["skopeo"].processes
+    ...     usage_totals()["skopeo"].processes
+    1
+    1
+    """
+    token = _scoped_totals.set({})
+    try:
+        yield
+    finally:
+        _scoped_totals.reset(token)
+
+
+def record_usage(tool: str, usage: ResourceUsage) -> None:
+    """Add the resources used by a process of the tool to the current totals."""
+    totals = _current_totals()
+    with _totals_lock:
+        totals.setdefault(tool, UsageTotals()).add(usage)
+
+
+def usage_totals() -> dict[str, UsageTotals]:
+    """Get the resources used by the processes of each tool in the current scope.
+
+    See tracking(). Outside of any scope, the totals for the whole konfusion process.
+    """
+    totals = _current_totals()
+    with _totals_lock:
+        return {
+            tool: dataclasses.replace(tool_totals)
+            for tool, tool_totals in totals.items()
+        }
+
+
+def log_usage_summary() -> None:
+    """Log the resources used by the processes of each tool, if any."""
+    for tool, totals in sorted(usage_totals().items()):
+        log.info(
+            "%s: %d processes, %.2fs wall, %.2fs user, %.2fs sys, max RSS %.1f MiB, "
+            "%d/%d blocks read/written",
+            tool,
+            totals.processes,
+            totals.wall_time,
+            totals.user_time,
+            totals.system_time,
+            totals.max_rss / 1024 / 1024,
+            totals.block_reads,
+            totals.block_writes,
+        )
+
+
+def _current_totals() -> dict[str, UsageTotals]:
+    totals = _scoped_totals.get()
+    return _process_totals if totals is None else totals
@@ -1,5 +1,49 @@
 from __future__ import annotations
 
-from konfusion.lib.tools._cli_tool import CliTool
+from konfusion.lib.tools._capture import (
+    Capture,
+    CaptureAll,
+    CapturedProcess,
+    Discard,
+    HeadTail,
+    SpillToDisk,
+)
+from konfusion.lib.tools._cli_tool import CliTool, ToolStalledError
+from konfusion.lib.tools._registry import (
+    ToolInfo,
+    ToolRegistry,
+    get_tool_registry,
+    set_tool_registry,
+)
+from konfusion.lib.tools._repeated_lines import RepeatedLinesCollapser
+from konfusion.lib.tools._rusage import MeasuredProcess, ResourceUsage
+from konfusion.lib.tools._scheduler import (
+    QueueStats,
+    Scheduler,
+    get_scheduler,
+    scheduling_priority,
+    set_scheduler,
+)
 
-__all__ = ["CliTool"]
+__all__ = [
+    "Capture",
+    "CaptureAll",
+    "CapturedProcess",
+    "CliTool",
+    "Discard",
+    "HeadTail",
+    "MeasuredProcess",
+    "QueueStats",
+    "RepeatedLinesCollapser",
+    "ResourceUsage",
+    "Scheduler",
+    "SpillToDisk",
+    "ToolInfo",
+    "ToolRegistry",
+    "ToolStalledError",
+    "get_scheduler",
+    "get_tool_registry",
+    "scheduling_priority",
+    "set_scheduler",
+    "set_tool_registry",
+]
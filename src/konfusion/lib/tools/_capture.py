@@ -0,0 +1,252 @@
+from __future__ import annotations
+
+import abc
+import collections
+import subprocess
+import tempfile
+from typing import IO, TYPE_CHECKING, Any, Self
+
+from konfusion.lib.tools._rusage import MeasuredProcess
+
+if TYPE_CHECKING:
+    from collections.abc import Sequence
+
+    from konfusion.lib.tools._rusage import ResourceUsage
+
+
+class Capture(abc.ABC):
+    """A policy for capturing the output (stdout or stderr) of a CLI tool.
+
+    Each instance captures one output of one process, don't reuse them.
+    """
+
+    @abc.abstractmethod
+    def add(self, line: str) -> None:
+        """Capture a line of output."""
+
+    @abc.abstractmethod
+    def output(self) -> str:
+        """Get the captured output."""
+
+    def excerpt(self) -> str:
+        """Get the captured output, or only its end if the capture can be big.
+
+        For attaching to errors (see CapturedProcess.check_returncode()).
+        """
+        return self.output()
+
+    def close(self) -> None:  # noqa: B027 # optional, most captures hold only memory
+        """Release the resources held by the capture (e.g. a temporary file)."""
+
+
+class CaptureAll(Capture):
+    """Keep all the output in memory.
+
+    >>> capture = CaptureAll()
+    >>> capture.add("foo\\n")
+    >>> capture.add("bar\\n")
+    >>> capture.output()
+    'foo\\nbar\\n'
+    """
+
+    def __init__(self) -> None:
+        self._lines: list[str] = []
+
+    def add(self, line: str) -> None:
+        self._lines.append(line)
+
+    def output(self) -> str:
+        return "".join(self._lines)
+
+
+class Discard(Capture):
+    """Don't keep any output.
+
+    >>> capture = Discard()
+    >>> capture.add("foo\\n")
+    >>> capture.output()
+    ''
+    """
+
+    def add(self, line: str) -> None:
+        pass
+
+    def output(self) -> str:
+        return ""
+
+
+class HeadTail(Capture):
+    """Keep only the first head_lines and the last tail_lines lines of output.
+
+    >>> capture = HeadTail(head_lines=1, tail_lines=2)
+    >>> for i in range(5):
+    ...     capture.add(f"line {i}\\n")
+    >>> print(capture.output(), end="")
+    line 0
+    [... 2 lines omitted ...]
+    line 3
+    line 4
+    """
+
+    def __init__(self, *, head_lines: int = 100, tail_lines: int = 100) -> None:
+        self._head_lines = head_lines
+        self._head: list[str] = []
+        self._tail: collections.deque[str] = collections.deque(maxlen=tail_lines)
+        self._total = 0
+
+    def add(self, line: str) -> None:
+        self._total += 1
+        if len(self._head) < self._head_lines:
+            self._head.append(line)
+        else:
+            self._tail.append(line)
+
+    def output(self) -> str:
+        omitted = self._total - len(self._head) - len(self._tail)
+        if omitted:
+            omitted_line = [f"[... {omitted} lines omitted ...]\n"]
+        else:
+            omitted_line = []
+        return "".join([*self._head, *omitted_line, *self._tail])
+
+
+class SpillToDisk(Capture):
+    """Keep the output in memory, move it to a temporary file if it grows too big.
+
+    The threshold is in characters (roughly bytes for mostly-ASCII output).
+
+    >>> capture = SpillToDisk(threshold=5)
+    >>> capture.add("foo\\n")
+    >>> capture.spilled
+    False
+    >>> capture.add("bar\\n")
+    >>> capture.spilled
+    True
+    >>> capture.output()
+    'foo\\nbar\\n'
+    >>> capture.close()
+
+    The temporary file stays open until close() (see also CapturedProcess.close()).
+    Once spilled, also keeps the last tail_lines lines in memory for excerpt(), so
+    that errors don't need to read the whole file:
+
+    >>> capture = SpillToDisk(threshold=5, tail_lines=1)
+    >>> for line in ["foo\\n", "bar\\n", "baz\\n"]:
+    ...     capture.add(line)
+    >>> print(capture.excerpt(), end="")
+    [... 2 lines omitted ...]
+    baz
+    >>> capture.close()
+    """
+
+    def __init__(self, *, threshold: int = 1024 * 1024, tail_lines: int = 100) -> None:
+        self._threshold = threshold
+        self._lines: list[str] = []
+        self._size = 0
+        self._file: IO[str] | None = None
+        self._tail: collections.deque[str] = collections.deque(maxlen=tail_lines)
+        self._total = 0
+
+    @property
+    def spilled(self) -> bool:
+        return self._file is not None
+
+    def add(self, line: str) -> None:
+        self._total += 1
+        if self._file:
+            self._file.write(line)
+            self._tail.append(line)
+            return
+
+        self._lines.append(line)
+        self._size += len(line)
+        if self._size > self._threshold:
+            self._file = tempfile.TemporaryFile("w+", encoding="utf-8", newline="")
+            self._file.writelines(self._lines)
+            self._tail.extend(self._lines)
+            self._lines.clear()
+
+    def output(self) -> str:
+        if not self._file:
+            return "".join(self._lines)
+
+        position = self._file.tell()
+        self._file.seek(0)
+        try:
+            return self._file.read()
+        finally:
+            self._file.seek(position)
+
+    def excerpt(self) -> str:
+        if not self._file:
+            return "".join(self._lines)
+
+        omitted = self._total - len(self._tail)
+        omitted_line = [f"[... {omitted} lines omitted ...]\n"] if omitted else []
+        return "".join([*omitted_line, *self._tail])
+
+    def close(self) -> None:
+        if self._file:
+            self._file.close()
+
+
+class CapturedProcess(MeasuredProcess[str]):
+    """A CompletedProcess that gets the stdout and stderr from captures on access.
+
+    Close it (or use it as a context manager) when done with the output, to release
+    what the captures hold, e.g. the temporary files of SpillToDisk:
+
+    >>> with CapturedProcess(["true"], 0, SpillToDisk(), SpillToDisk()) as proc:
+    ...     proc.stdout
+    ''
+    """
+
+    def __init__(
+        self,
+        args: Sequence[Any],
+        returncode: int,
+        stdout_capture: Capture,
+        stderr_capture: Capture,
+        *,
+        resource_usage: ResourceUsage | None = None,
+    ) -> None:
+        super().__init__(args, returncode, resource_usage=resource_usage)
+        # Let __getattr__ handle them
+        del self.stdout, self.stderr
+        self._stdout_capture = stdout_capture
+        self._stderr_capture = stderr_capture
+
+    def close(self) -> None:
+        """Close the captures, the stdout and stderr are not available after that."""
+        self._stdout_capture.close()
+        self._stderr_capture.close()
+
+    def check_returncode(self) -> None:
+        """Raise CalledProcessError if the returncode is non-zero.
+
+        The error gets a copy of the output (only the end of it, if the capture can
+        be big, see Capture.excerpt()), the captures get closed.
+        """
+        if self.returncode:
+            error = subprocess.CalledProcessError(
+                self.returncode,
+                self.args,
+                self._stdout_capture.excerpt(),
+                self._stderr_capture.excerpt(),
+            )
+            self.close()
+            raise error
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        self.close()
+
+    def __getattr__(self, name: str) -> str:
+        if name == "stdout":
+            return self._stdout_capture.output()
+        elif name == "stderr":
+            return self._stderr_capture.output()
+        else:
+            raise AttributeError(name)
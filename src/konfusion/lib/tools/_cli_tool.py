@@ -1,33 +1,114 @@
 from __future__ import annotations
 
+import collections
+import contextlib
+import dataclasses
+import functools
 import logging
-import shutil
+import os
+import signal
 import subprocess
-import threading
+import time
 from pathlib import Path
-from typing import IO, TYPE_CHECKING, Self
+from typing import IO, TYPE_CHECKING, Any, ClassVar, Self
+
+from konfusion.lib import deadline, tracing
+from konfusion.lib.deadline import DeadlineExceededError
+from konfusion.lib.tool_usage import record_usage
+from konfusion.lib.tools._capture import (
+    Capture,
+    CaptureAll,
+    CapturedProcess,
+    Discard,
+)
+from konfusion.lib.tools._pipes import (
+    ChunkPipe,
+    LinePipe,
+    PipesIdleError,
+    PipesTimeoutError,
+    drain_iter,
+    read_lines_async,
+    write_all,
+)
+from konfusion.lib.tools._registry import ToolInfo, get_tool_registry
+from konfusion.lib.tools._repeated_lines import (
+    RepeatedLinesCollapser,
+    flushing_periodically,
+)
+from konfusion.lib.tools._rusage import (
+    MeasuredProcess,
+    ResourceUsage,
+    await_with_rusage,
+    wait_with_rusage,
+)
+from konfusion.lib.tools._scheduler import get_scheduler
 
 if TYPE_CHECKING:
-    from collections.abc import Callable, Iterable, Sequence
+    from collections.abc import Callable, Generator, Iterable, Sequence
     from os import PathLike
 
+    from konfusion.lib.tools._pipes import Pipe
+
 log = logging.getLogger(__name__)
 
 
+class ToolStalledError(subprocess.TimeoutExpired):
+    """A CLI tool stopped producing output and got killed, see stall_timeout."""
+
+    def __str__(self) -> str:
+        return f"Command {self.cmd!r} produced no output for {self.timeout} seconds"
+
+
 class CliTool:
-    """Wrapper for calling CLI tools in a subprocess."""
+    """Wrapper for calling CLI tools in a subprocess.
+
+    All the processes go through the shared Scheduler (see get_scheduler()), which
+    limits how many run at once. Subclasses can set max_concurrent to limit the number
+    of processes of the specific tool.
+
+    To check what the installed tool supports, see info and supports(). Subclasses
+    can set probe_help_for to the subcommands whose flags they want to check.
+    """
+
+    max_concurrent: ClassVar[int | None] = None
+
+    version_args: ClassVar[Sequence[str]] = ("--version",)
+    probe_help_for: ClassVar[Sequence[str]] = ()
 
     def __init__(self, executable_path: str | PathLike[str]) -> None:
         self._executable_path = executable_path
+        self._tool_name = Path(executable_path).name
 
     @classmethod
     def find_by_name(cls, name: str) -> Self:
-        """Find an executable in PATH and return a CliTool."""
-        executable_path = shutil.which(name)
+        """Find an executable in PATH and return a CliTool.
+
+        Looks up each name only once, see ToolRegistry.
+        """
+        executable_path = get_tool_registry().which(name)
         if not executable_path:
             raise ValueError(f"Executable {name!r} not found in PATH")
         return cls(executable_path)
 
+    @property
+    def executable_path(self) -> str | PathLike[str]:
+        return self._executable_path
+
+    @functools.cached_property
+    def info(self) -> ToolInfo:
+        """The version and the flags of the tool, probed once per binary.
+
+        See ToolRegistry for the caching.
+        """
+        return get_tool_registry().info(self)
+
+    def supports(self, flag: str, *, subcommand: str = "") -> bool:
+        """Check if the installed tool (or its subcommand) accepts the flag.
+
+        The subcommand has to be one of probe_help_for.
+        """
+        return self.info.supports(flag, subcommand=subcommand)
+
     def run(
         self,
         args: Sequence[str | PathLike[str]],
@@ -35,7 +116,10 @@ class CliTool:
         check: bool = True,
         stdout_callback: Callable[[str], None] | None = None,
         stderr_callback: Callable[[str], None] | None = None,
-    ) -> subprocess.CompletedProcess[str]:
+        stdout_capture: Capture | None = None,
+        stderr_capture: Capture | None = None,
+        stall_timeout: float | None = None,
+    ) -> CapturedProcess:
         """Run a command while capturing the stdout and stderr.
 
         By default, behaves the same as
@@ -45,27 +129,255 @@ class CliTool:
         lines in real time. The callbacks, if specified, should be functions that
         take a line as input (includes the trailing newline) and perform some side effect
         (e.g. logging the line).
+
+        By default, captures all the output in memory. To limit the memory usage
+        for tools that may print a lot, pass a different Capture policy, e.g.
+        stdout_capture=HeadTail() or stdout_capture=SpillToDisk(). The stdout and
+        stderr of the returned CompletedProcess come from the captures, the result
+        only builds the output strings when accessed.
+
+        If stall_timeout is set and the process doesn't print anything (to stdout
+        or stderr) for that many seconds, kills the process and raises ToolStalledError.
+        For tools that can hang forever, e.g. on a dead network connection.
         """
         cmd = [self._executable_path, *args]
         log.debug("Running %s", cmd)
 
-        process = subprocess.Popen(  # noqa: S603
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+        with (
+            tracing.span("cli_tool.run", argv=[str(arg) for arg in cmd]) as attrs,
+            get_scheduler().slot(self._tool_name, self.max_concurrent),
+        ):
+            child = _Child(cmd)
+            process = child.process
+            attrs["pid"] = process.pid
+
+            stdout_capture = stdout_capture or CaptureAll()
+            stderr_capture = stderr_capture or CaptureAll()
+            pipes = [
+                LinePipe(
+                    _cannot_be_none(process.stdout),
+                    _line_handler(stdout_capture, stdout_callback),
+                ),
+                LinePipe(
+                    _cannot_be_none(process.stderr),
+                    _line_handler(stderr_capture, stderr_callback),
+                ),
+            ]
+
+            # Read both pipes in the current thread, no need for extra threads
+            try:
+                with tracing.span("cli_tool.read_output"):
+                    _drain(pipes, [child], idle_timeout=stall_timeout)
+            except PipesIdleError:
+                child.kill()
+                self._wait(child, attrs)
+                child.check_deadline()
+                raise ToolStalledError(
+                    cmd,
+                    _cannot_be_none(stall_timeout),
+                    stdout_capture.output(),
+                    stderr_capture.output(),
+                ) from None
+            except BaseException:
+                # A callback failed or e.g. KeyboardInterrupt. With a deadline, the
+                # process has its own group and Ctrl-C wouldn't reach it, kill it.
+                child.kill()
+                self._wait(child, attrs)
+                raise
+
+            returncode, usage = self._wait(child, attrs)
+            child.check_deadline()
+
+        completed_process = CapturedProcess(
+            cmd, returncode, stdout_capture, stderr_capture, resource_usage=usage
         )
-        stdout_pipe = _cannot_be_none(process.stdout)
-        stderr_pipe = _cannot_be_none(process.stderr)
 
-        stdout_handler = _PipeHandler(stdout_pipe, stdout_callback)
-        stderr_handler = _PipeHandler(stderr_pipe, stderr_callback)
+        if check:
+            completed_process.check_returncode()
+
+        return completed_process
+
+    def stream(
+        self,
+        args: Sequence[str | PathLike[str]],
+        *,
+        check: bool = True,
+        stderr_callback: Callable[[str], None] | None = None,
+        stderr_capture: Capture | None = None,
+    ) -> Generator[str]:
+        """Run a command and yield the lines of its stdout as they arrive.
+
+        Unlike run(), doesn't keep the stdout in memory, so the memory usage stays
+        constant regardless of the size of the output. Still captures the stderr
+        (see run() for the stderr_* arguments).
+
+        After the last line, waits for the process to exit. If check is True and
+        the process failed, raises CalledProcessError (with stdout=None). If the caller
+        stops iterating early (e.g. breaks out of the loop), kills the process.
 
-        # Thread-based approach, inspired by:
-        #   * a suggestion from Gemini
-        #   * the CPython stdlib: https://github.com/python/cpython/blob/cb99d992774b67761441e122965ed056bac09241/Lib/subprocess.py#L1617
-        _run_handlers([stdout_handler, stderr_handler])
+        The process keeps its scheduler slot (see Scheduler) until the generator
+        finishes, including while the caller handles the lines. Don't run other
+        tools from inside the loop: with no free slots (e.g. the same tool with
+        max_concurrent = 1), that deadlocks. Collect what you need first.
 
-        returncode = process.wait()
-        completed_process = subprocess.CompletedProcess(
-            cmd, returncode, stdout_handler.output, stderr_handler.output
+        >>> for line in CliTool("seq").stream(["3"]):
+        ...     print(line, end="")
+        1
+        2
+        3
+        """
+        cmd = [self._executable_path, *args]
+        log.debug("Streaming %s", cmd)
+
+        with (
+            tracing.span("cli_tool.stream", argv=[str(arg) for arg in cmd]) as attrs,
+            get_scheduler().slot(self._tool_name, self.max_concurrent),
+        ):
+            child = _Child(cmd)
+            process = child.process
+            attrs["pid"] = process.pid
+
+            stdout_lines: collections.deque[str] = collections.deque()
+            stderr_capture = stderr_capture or CaptureAll()
+            pipes = [
+                LinePipe(_cannot_be_none(process.stdout), stdout_lines.append),
+                LinePipe(
+                    _cannot_be_none(process.stderr),
+                    _line_handler(stderr_capture, stderr_callback),
+                ),
+            ]
+
+            finished = False
+            try:
+                with contextlib.closing(_drain_iter(pipes, [child])) as reads:
+                    for _ in reads:
+                        while stdout_lines:
+                            yield stdout_lines.popleft()
+                finished = True
+            finally:
+                if not finished:
+                    child.kill()
+                returncode, _ = self._wait(child, attrs)
+            child.check_deadline()
+
+        if check and returncode != 0:
+            raise subprocess.CalledProcessError(
+                returncode, cmd, None, stderr_capture.output()
+            )
+
+    async def arun(
+        self,
+        args: Sequence[str | PathLike[str]],
+        *,
+        check: bool = True,
+        stdout_callback: Callable[[str], None] | None = None,
+        stderr_callback: Callable[[str], None] | None = None,
+        stdout_capture: Capture | None = None,
+        stderr_capture: Capture | None = None,
+        stall_timeout: float | None = None,
+    ) -> CapturedProcess:
+        """Async version of run(), for running many tools concurrently.
+
+        Reads the output in the event loop, without any threads. The callbacks,
+        captures and stall_timeout work the same as in run(). If the calling task gets
+        cancelled, kills the process (and waits for it to exit) before propagating
+        the cancellation.
+        """
+        # Imported lazily, only async code should pay for importing asyncio
+        import asyncio
+
+        cmd = [self._executable_path, *args]
+        log.debug("Running %s", cmd)
+
+        with tracing.span("cli_tool.arun", argv=[str(arg) for arg in cmd]) as attrs:
+            async with get_scheduler().aslot(self._tool_name, self.max_concurrent):
+                deadline.check(str(cmd[0]))
+                left = deadline.remaining()
+                # Not asyncio.create_subprocess_exec(), the asyncio child watcher
+                # would reap the process and the resource usage would get lost
+                process = subprocess.Popen(  # noqa: S603
+                    cmd,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    # See _Child
+                    process_group=None if left is None else 0,
+                )
+                started_at = time.monotonic()
+                attrs["pid"] = process.pid
+
+                stdout_capture = stdout_capture or CaptureAll()
+                stderr_capture = stderr_capture or CaptureAll()
+                loop = asyncio.get_running_loop()
+                stall = asyncio.timeout(stall_timeout)
+                transports: list[asyncio.BaseTransport] = []
+
+                async def stream_reader(pipe: IO[bytes] | None) -> asyncio.StreamReader:
+                    reader = asyncio.StreamReader()
+                    transport, _ = await loop.connect_read_pipe(
+                        lambda: asyncio.StreamReaderProtocol(reader),
+                        _cannot_be_none(pipe),
+                    )
+                    transports.append(transport)
+                    return reader
+
+                def on_data() -> None:
+                    if stall_timeout is not None:
+                        stall.reschedule(loop.time() + stall_timeout)
+
+                try:
+                    async with asyncio.timeout(left):
+                        with tracing.span("cli_tool.read_output"):
+                            async with stall:
+                                await asyncio.gather(
+                                    read_lines_async(
+                                        await stream_reader(process.stdout),
+                                        _line_handler(stdout_capture, stdout_callback),
+                                        on_data,
+                                    ),
+                                    read_lines_async(
+                                        await stream_reader(process.stderr),
+                                        _line_handler(stderr_capture, stderr_callback),
+                                        on_data,
+                                    ),
+                                )
+
+                        with tracing.span("cli_tool.wait"):
+                            returncode, usage = await await_with_rusage(
+                                process, started_at
+                            )
+                except BaseException as e:
+                    # Cancelled, stalled, reached the deadline or a callback failed,
+                    # don't leave the process behind
+                    if process.returncode is None:
+                        _kill(process, process_group=left is not None)
+                        self._record_usage(
+                            *(await await_with_rusage(process, started_at)), attrs
+                        )
+                    if isinstance(e, TimeoutError) and stall.expired():
+                        raise ToolStalledError(
+                            cmd,
+                            _cannot_be_none(stall_timeout),
+                            stdout_capture.output(),
+                            stderr_capture.output(),
+                        ) from None
+                    time_left = deadline.remaining()
+                    if (
+                        isinstance(e, TimeoutError)
+                        and time_left is not None
+                        and time_left <= 0
+                    ):
+                        log.warning("Deadline exceeded, killed %s", cmd)
+                        raise DeadlineExceededError(
+                            f"Killed {cmd} at the deadline"
+                        ) from e
+                    raise
+                finally:
+                    for transport in transports:
+                        transport.close()
+                self._record_usage(returncode, usage, attrs)
+
+        completed_process = CapturedProcess(
+            cmd, returncode, stdout_capture, stderr_capture, resource_usage=usage
         )
 
         if check:
@@ -73,6 +385,208 @@ class CliTool:
 
         return completed_process
 
+    def run_bytes(
+        self,
+        args: Sequence[str | PathLike[str]],
+        *,
+        check: bool = True,
+        stdout_callback: Callable[[memoryview], None] | None = None,
+        stdout_to: int | IO[bytes] | None = None,
+    ) -> MeasuredProcess[bytes]:
+        """Run a command and process its stdout as raw bytes, in chunks.
+
+        For outputs that are not text, or where splitting into lines is wasted
+        effort (e.g. raw manifests, blobs, tarballs). Reads the output into a reusable
+        buffer and passes it along without intermediate copies:
+
+        * stdout_callback gets each chunk as a memoryview, which is only valid until
+          the callback returns (copy it with bytes(chunk) to keep it)
+        * stdout_to is a file descriptor or a binary file to write the output to
+
+        If neither is specified, captures the stdout in memory. Otherwise,
+        the stdout of the returned CompletedProcess is empty. Always captures
+        the stderr (as bytes).
+        """
+        cmd = [self._executable_path, *args]
+        log.debug("Running %s", cmd)
+
+        with (
+            tracing.span("cli_tool.run_bytes", argv=[str(arg) for arg in cmd]) as attrs,
+            get_scheduler().slot(self._tool_name, self.max_concurrent),
+        ):
+            child = _Child(cmd)
+            process = child.process
+            attrs["pid"] = process.pid
+
+            stdout = bytearray()
+            stderr = bytearray()
+            on_stdout_chunks: list[Callable[[memoryview], None]] = []
+            if stdout_callback:
+                on_stdout_chunks.append(stdout_callback)
+            if stdout_to is not None:
+                fd = stdout_to if isinstance(stdout_to, int) else stdout_to.fileno()
+                on_stdout_chunks.append(functools.partial(write_all, fd))
+            if not on_stdout_chunks:
+                on_stdout_chunks.append(stdout.extend)
+
+            def on_stdout_chunk(chunk: memoryview) -> None:
+                for on_chunk in on_stdout_chunks:
+                    on_chunk(chunk)
+
+            pipes = [
+                ChunkPipe(_cannot_be_none(process.stdout), on_stdout_chunk),
+                ChunkPipe(_cannot_be_none(process.stderr), stderr.extend),
+            ]
+            try:
+                with tracing.span("cli_tool.read_output"):
+                    _drain(pipes, [child])
+            except BaseException:
+                # See run()
+                child.kill()
+                self._wait(child, attrs)
+                raise
+
+            returncode, usage = self._wait(child, attrs)
+            child.check_deadline()
+
+        completed_process = MeasuredProcess(
+            cmd, returncode, bytes(stdout), bytes(stderr), resource_usage=usage
+        )
+
+        if check:
+            completed_process.check_returncode()
+
+        return completed_process
+
+    @staticmethod
+    def run_pipeline(
+        stages: Sequence[tuple[CliTool, Sequence[str | PathLike[str]]]],
+        *,
+        check: bool = True,
+        stdout_at_level: int | None = logging.DEBUG,
+        stderr_at_level: int | None = logging.ERROR,
+        collapse_repeated_lines: bool = True,
+        stdout_capture: Capture | None = None,
+    ) -> list[CapturedProcess]:
+        """Run tools connected by pipes, like a shell pipeline: tool1 | tool2 | ...
+
+        The stdout of each stage goes straight to the stdin of the next one through
+        an OS pipe, the data never passes through Python. Captures the stdout of
+        the last stage (see run() for stdout_capture). Logs the stderr of all
+        the stages, and the stdout of the last one, like run_with_logging().
+
+        Returns the results of the stages, with their returncodes and stderr (only
+        the last one has stdout). If check is True and any of the stages failed,
+        raises CalledProcessError for the last stage that failed (like a shell
+        with 'set -o pipefail').
+
+        >>> stages = [(CliTool("printf"), ["hello\\n"]), (CliTool("tr"), ["a-z", "A-Z"])]
+        >>> [printf, tr] = CliTool.run_pipeline(stages)
+        >>> tr.stdout
+        'HELLO\\n'
+        """
+        if not stages:
+            raise ValueError("A pipeline needs at least one stage")
+
+        cmds = [[tool._executable_path, *args] for tool, args in stages]
+        log.debug("Running %s", " | ".join(str(cmd) for cmd in cmds))
+
+        stdout_capture = stdout_capture or CaptureAll()
+        stderr_captures = [CaptureAll() for _ in stages]
+
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(tracing.span("cli_tool.pipeline", stages=len(stages)))
+            stack.enter_context(
+                get_scheduler().slots(
+                    [(tool._tool_name, tool.max_concurrent) for tool, _ in stages]
+                )
+            )
+            stage_attrs = [
+                stack.enter_context(
+                    tracing.span(
+                        "cli_tool.pipeline_stage", argv=[str(arg) for arg in cmd]
+                    )
+                )
+                for cmd in cmds
+            ]
+            loggers = [
+                stack.enter_context(
+                    tool._line_loggers(
+                        stdout_at_level if i == len(stages) - 1 else None,
+                        stderr_at_level,
+                        collapse_repeated_lines,
+                    )
+                )
+                for i, (tool, _) in enumerate(stages)
+            ]
+
+            children: list[_Child] = []
+            processes: list[subprocess.Popen[bytes]] = []
+            try:
+                stdin: IO[bytes] | None = None
+                for cmd, attrs in zip(cmds, stage_attrs, strict=True):
+                    child = _Child(cmd, stdin=stdin)
+                    children.append(child)
+                    process = child.process
+                    processes.append(process)
+                    attrs["pid"] = process.pid
+                    if stdin is not None:
+                        # The next stage has its own copy of the read end. Close ours,
+                        # so that the writer gets SIGPIPE if the reader exits early.
+                        stdin.close()
+                    stdin = process.stdout
+
+                last_stdout_callback, _ = loggers[-1]
+                pipes = [
+                    LinePipe(
+                        _cannot_be_none(processes[-1].stdout),
+                        _line_handler(stdout_capture, last_stdout_callback),
+                    ),
+                    *(
+                        LinePipe(
+                            _cannot_be_none(process.stderr),
+                            _line_handler(stderr_capture, stderr_callback),
+                        )
+                        for process, stderr_capture, (_, stderr_callback) in zip(
+                            processes, stderr_captures, loggers, strict=True
+                        )
+                    ),
+                ]
+                with tracing.span("cli_tool.read_output"):
+                    _drain(pipes, children)
+            except BaseException:
+                for child in children:
+                    process = child.process
+                    child.kill()
+                    process.wait()
+                    for pipe in [process.stdout, process.stderr]:
+                        if pipe:
+                            pipe.close()
+                raise
+
+            results: list[CapturedProcess] = []
+            for i, ((tool, _), child) in enumerate(zip(stages, children, strict=True)):
+                returncode, usage = tool._wait(child, stage_attrs[i])
+                is_last = i == len(stages) - 1
+                results.append(
+                    CapturedProcess(
+                        cmds[i],
+                        returncode,
+                        stdout_capture if is_last else Discard(),
+                        stderr_captures[i],
+                        resource_usage=usage,
+                    )
+                )
+
+        for child in children:
+            child.check_deadline()
+
+        if check:
+            for result in reversed(results):
+                result.check_returncode()
+
+        return results
+
     def run_with_logging(
         self,
         args: Sequence[str | PathLike[str]],
@@ -80,28 +594,223 @@ class CliTool:
         check: bool = True,
         stdout_at_level: int | None = logging.DEBUG,
         stderr_at_level: int | None = logging.ERROR,
-    ) -> subprocess.CompletedProcess[str]:
+        collapse_repeated_lines: bool = True,
+        stdout_capture: Capture | None = None,
+        stderr_capture: Capture | None = None,
+        stall_timeout: float | None = None,
+    ) -> CapturedProcess:
         """Same as run() but special-cased for the common use case of log+collect.
 
         Logs each line of stdout and stderr in real time while also collecting them
         for later use.
 
         To disable the logging for stdout or stderr, set <stdout|stderr>_at_level=None.
+
+        Repetitive lines (e.g. progress output) get rate-limited in the logs,
+        see RepeatedLinesCollapser. Unless logged at the DEBUG level or
+        collapse_repeated_lines=False. The collapsing doesn't affect the captured output
+        (see run() for the *_capture arguments and stall_timeout).
         """
-        tool_name = Path(self._executable_path).name
-        stdout_format = f"{tool_name} stdout> %s"
-        stderr_format = f"{tool_name} stderr> %s"
+        with self._line_loggers(
+            stdout_at_level, stderr_at_level, collapse_repeated_lines
+        ) as (stdout_callback, stderr_callback):
+            return self.run(
+                args,
+                check=check,
+                stdout_callback=stdout_callback,
+                stderr_callback=stderr_callback,
+                stdout_capture=stdout_capture,
+                stderr_capture=stderr_capture,
+                stall_timeout=stall_timeout,
+            )
+
+    async def arun_with_logging(
+        self,
+        args: Sequence[str | PathLike[str]],
+        *,
+        check: bool = True,
+        stdout_at_level: int | None = logging.DEBUG,
+        stderr_at_level: int | None = logging.ERROR,
+        collapse_repeated_lines: bool = True,
+        stdout_capture: Capture | None = None,
+        stderr_capture: Capture | None = None,
+        stall_timeout: float | None = None,
+    ) -> CapturedProcess:
+        """Async version of run_with_logging(), see arun()."""
+        with self._line_loggers(
+            stdout_at_level, stderr_at_level, collapse_repeated_lines
+        ) as (stdout_callback, stderr_callback):
+            return await self.arun(
+                args,
+                check=check,
+                stdout_callback=stdout_callback,
+                stderr_callback=stderr_callback,
+                stdout_capture=stdout_capture,
+                stderr_capture=stderr_capture,
+                stall_timeout=stall_timeout,
+            )
+
+    def _wait(
+        self,
+        child: _Child,
+        attrs: dict[str, Any],
+    ) -> tuple[int, ResourceUsage | None]:
+        """Wait for the process, measure and record the resources it used."""
+        with tracing.span("cli_tool.wait"):
+            returncode, usage = child.wait()
+        self._record_usage(returncode, usage, attrs)
+        return returncode, usage
+
+    def _record_usage(
+        self, returncode: int, usage: ResourceUsage | None, attrs: dict[str, Any]
+    ) -> None:
+        attrs["returncode"] = returncode
+        log.debug("%s exited with %d: %s", self._tool_name, returncode, usage)
+        if usage:
+            attrs["resource_usage"] = dataclasses.asdict(usage)
+            record_usage(self._tool_name, usage)
 
-        def log_line(level: int | None, log_format: str, line: str) -> None:
-            if level is not None:
+    @contextlib.contextmanager
+    def _line_loggers(
+        self,
+        stdout_at_level: int | None,
+        stderr_at_level: int | None,
+        collapse_repeated_lines: bool,
+    ) -> Generator[tuple[Callable[[str], None], Callable[[str], None]]]:
+        """Yield the stdout and stderr callbacks for *run_with_logging()."""
+        tool_name = self._tool_name
+        collapsers: list[RepeatedLinesCollapser] = []
+
+        def line_logger(level: int | None, log_format: str) -> Callable[[str], None]:
+            if level is None or not log.isEnabledFor(level):
+                return lambda _: None
+
+            def log_line(line: str) -> None:
                 log.log(level, log_format, line.rstrip("\n"))
 
-        return self.run(
-            args,
-            check=check,
-            stdout_callback=lambda line: log_line(stdout_at_level, stdout_format, line),
-            stderr_callback=lambda line: log_line(stderr_at_level, stderr_format, line),
+            # Not based on the logger level, which says nothing about the level
+            # of the output (e.g. per request in server mode). DEBUG lines are
+            # only shown for debugging, don't hide anything there.
+            if collapse_repeated_lines and level > logging.DEBUG:
+                collapser = RepeatedLinesCollapser(log_line)
+                collapsers.append(collapser)
+                return collapser
+            else:
+                return log_line
+
+        callbacks = (
+            line_logger(stdout_at_level, f"{tool_name} stdout> %s"),
+            line_logger(stderr_at_level, f"{tool_name} stderr> %s"),
         )
+        try:
+            # Show the summaries of hidden lines even if the tool goes quiet
+            with flushing_periodically(collapsers):
+                yield callbacks
+        finally:
+            for collapser in collapsers:
+                collapser.flush()
+
+
+class _Child:
+    """A running CLI tool process. Kills the process when the deadline passes.
+
+    If there is a deadline (see konfusion.lib.deadline), starts the process in a new
+    process group and kills the whole group, including any processes it started.
+    No timer thread does the killing, the reads and the wait time out at the deadline
+    (see _drain_iter() and wait()).
+    """
+
+    def __init__(
+        self, cmd: Sequence[str | PathLike[str]], *, stdin: IO[bytes] | None = None
+    ) -> None:
+        deadline.check(str(cmd[0]))
+        self._cmd = cmd
+        self._killed_at_deadline = False
+        left = deadline.remaining()
+        self._deadline_at = None if left is None else time.monotonic() + left
+
+        self._own_process_group = left is not None
+        self.process = subprocess.Popen(  # noqa: S603
+            cmd,
+            stdin=stdin,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            process_group=0 if self._own_process_group else None,
+        )
+        self.started_at = time.monotonic()
+
+    def time_left(self) -> float | None:
+        """Seconds until the deadline (0 if it passed), None without a deadline."""
+        if self._deadline_at is None:
+            return None
+        return max(self._deadline_at - time.monotonic(), 0)
+
+    def wait(self) -> tuple[int, ResourceUsage | None]:
+        """Wait for the process to exit, return the returncode and resource usage."""
+        try:
+            return wait_with_rusage(self.process, self.started_at, self.time_left())
+        except subprocess.TimeoutExpired:
+            self.kill_at_deadline()
+            return wait_with_rusage(self.process, self.started_at)
+
+    def kill(self) -> None:
+        """Kill the process (and its process group, if it has its own)."""
+        if self.process.returncode is None:
+            _kill(self.process, process_group=self._own_process_group)
+
+    def kill_at_deadline(self) -> None:
+        """Kill the process, make check_deadline() raise DeadlineExceededError."""
+        if self.process.returncode is not None:
+            return
+        log.warning("Deadline exceeded, killing %s", self._cmd)
+        self._killed_at_deadline = True
+        self.kill()
+
+    def check_deadline(self) -> None:
+        """Raise DeadlineExceededError if the process got killed at the deadline."""
+        if self._killed_at_deadline:
+            raise DeadlineExceededError(f"Killed {self._cmd} at the deadline")
+
+
+def _drain_iter(
+    pipes: Iterable[Pipe],
+    children: Sequence[_Child],
+    *,
+    idle_timeout: float | None = None,
+) -> Generator[None]:
+    """drain_iter(), but kill the processes if the pipes are still open at the deadline.
+
+    The killed processes close their pipes, the caller then waits for them as usual
+    and check_deadline() raises DeadlineExceededError.
+    """
+    time_left = children[0].time_left()  # They all have the same deadline
+    try:
+        yield from drain_iter(pipes, idle_timeout=idle_timeout, timeout=time_left)
+    except PipesTimeoutError:
+        for child in children:
+            child.kill_at_deadline()
+
+
+def _drain(
+    pipes: Iterable[Pipe],
+    children: Sequence[_Child],
+    *,
+    idle_timeout: float | None = None,
+) -> None:
+    """Read from all the pipes until EOF. See _drain_iter()."""
+    for _ in _drain_iter(pipes, children, idle_timeout=idle_timeout):
+        pass
+
+
+def _kill(process: subprocess.Popen[bytes], *, process_group: bool) -> None:
+    # Not Popen.kill(), it polls the process first. That would reap an exited process
+    # and the wait for its resource usage would fail. Until it gets reaped, the pid
+    # can't get reused, so sending the signal is safe.
+    with contextlib.suppress(ProcessLookupError):
+        if process_group:
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            os.kill(process.pid, signal.SIGKILL)
 
 
 def _cannot_be_none[T](obj: T | None) -> T:
@@ -114,32 +823,14 @@ def _cannot_be_none[T](obj: T | None) -> T:
     return obj
 
 
-class _PipeHandler:
-    def __init__(
-        self, pipe: IO[str], line_callback: Callable[[str], None] | None = None
-    ) -> None:
-        self._pipe = pipe
-        self._lines: list[str] = []
-        self._line_callback = line_callback
-
-    def run(self) -> None:
-        with self._pipe:
-            for line in self._pipe:
-                self.handle(line)
-
-    def handle(self, line: str) -> None:
-        self._lines.append(line)
-        if self._line_callback:
-            self._line_callback(line)
-
-    @property
-    def output(self) -> str:
-        return "".join(self._lines)
+def _line_handler(
+    capture: Capture, callback: Callable[[str], None] | None
+) -> Callable[[str], None]:
+    if not callback:
+        return capture.add
 
+    def handle(line: str) -> None:
+        capture.add(line)
+        callback(line)
 
-def _run_handlers(handlers: Iterable[_PipeHandler]) -> None:
-    threads = [threading.Thread(target=handler.run) for handler in handlers]
-    for thread in threads:
-        thread.start()
-    for thread in threads:
-        thread.join()
+    return handle
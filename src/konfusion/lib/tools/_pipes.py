@@ -0,0 +1,240 @@
+from __future__ import annotations
+
+import codecs
+import io
+import locale
+import os
+import selectors
+import time
+from typing import IO, TYPE_CHECKING, Protocol
+
+if TYPE_CHECKING:
+    import asyncio
+    from collections.abc import Callable, Generator, Iterable
+
+# Same as the default buffer size of subprocess pipes and io.BufferedReader
+_READ_SIZE = 64 * 1024
+# Longer lines get split, output with no newlines mustn't fill up the memory
+_MAX_LINE_LENGTH = 1024 * 1024
+
+
+class Pipe(Protocol):
+    """The read end of a pipe and the logic to process the data read from it."""
+
+    pipe: IO[bytes]
+
+    def read(self) -> bool:
+        """Read the available data and process it. Return False at EOF."""
+        ...
+
+
+class LineDecoder:
+    """Decodes bytes into lines incrementally, e.g. as they arrive from a pipe.
+
+    Decodes the same way as a text mode subprocess pipe: using the locale encoding
+    and translating all newlines (\\r\\n, \\r) to \\n. Calls on_line for each line
+    (with the trailing newline, except possibly the last).
+
+    >>> lines = []
+    >>> decoder = LineDecoder(lines.append)
+    >>> decoder.feed(b"one\\r\\ntw")
+    >>> decoder.feed(b"o", final=True)
+    >>> lines
+    ['one\\n', 'two']
+
+    Splits lines longer than max_line_length (in characters), the parts before
+    the last one come without a trailing newline:
+
+    >>> lines = []
+    >>> decoder = LineDecoder(lines.append, max_line_length=3)
+    >>> decoder.feed(b"abcdefg\\n", final=True)
+    >>> lines
+    ['abc', 'def', 'g\\n']
+    """
+
+    def __init__(
+        self,
+        on_line: Callable[[str], None],
+        *,
+        max_line_length: int = _MAX_LINE_LENGTH,
+    ) -> None:
+        self._on_line = on_line
+        self._max_line_length = max_line_length
+        self._decoder = io.IncrementalNewlineDecoder(
+            codecs.getincrementaldecoder(locale.getpreferredencoding(False))(),
+            translate=True,
+        )
+        self._partial_line: list[str] = []
+        self._partial_length = 0
+
+    def feed(self, data: bytes, *, final: bool = False) -> None:
+        """Decode the data, process the complete lines (all the lines if final)."""
+        text = self._decoder.decode(data, final=final)
+
+        *lines, rest = text.split("\n")
+        if lines and self._partial_line:
+            self._partial_line.append(lines[0])
+            lines[0] = "".join(self._partial_line)
+            self._partial_line.clear()
+            self._partial_length = 0
+
+        on_line = self._on_line
+        max_length = self._max_line_length
+        for line in lines:
+            if len(line) > max_length:
+                on_line(self._split_long_line(line) + "\n")
+            else:
+                on_line(line + "\n")
+
+        if rest:
+            self._partial_line.append(rest)
+            self._partial_length += len(rest)
+            if self._partial_length > max_length:
+                rest = self._split_long_line("".join(self._partial_line))
+                self._partial_line = [rest]
+                self._partial_length = len(rest)
+
+        if final and self._partial_line:
+            self._on_line("".join(self._partial_line))
+            self._partial_line.clear()
+            self._partial_length = 0
+
+    def _split_long_line(self, line: str) -> str:
+        """Process the max_line_length parts of a long line, return the rest."""
+        max_length = self._max_line_length
+        start = 0
+        while len(line) - start > max_length:
+            self._on_line(line[start : start + max_length])
+            start += max_length
+        return line[start:]
+
+
+class LinePipe:
+    """Reads lines from the read end of a pipe (e.g. the stdout of a subprocess).
+
+    See LineDecoder for the decoding.
+    """
+
+    def __init__(self, pipe: IO[bytes], on_line: Callable[[str], None]) -> None:
+        self.pipe = pipe
+        self._decoder = LineDecoder(on_line)
+
+    def read(self) -> bool:
+        """Read the available data, process the complete lines. Return False at EOF."""
+        data = os.read(self.pipe.fileno(), _READ_SIZE)
+        eof = not data
+        self._decoder.feed(data, final=eof)
+        return not eof
+
+
+class ChunkPipe:
+    """Reads raw chunks of bytes from the read end of a pipe.
+
+    Reads into a reusable buffer and passes a memoryview of the data to on_chunk,
+    without copying. The memoryview is only valid until on_chunk returns,
+    the next read overwrites the buffer.
+    """
+
+    def __init__(self, pipe: IO[bytes], on_chunk: Callable[[memoryview], None]) -> None:
+        self.pipe = pipe
+        self._on_chunk = on_chunk
+        self._buffer = bytearray(_READ_SIZE)
+        self._view = memoryview(self._buffer)
+
+    def read(self) -> bool:
+        """Read the available data, process it. Return False at EOF."""
+        n = os.readv(self.pipe.fileno(), [self._buffer])
+        if n:
+            self._on_chunk(self._view[:n])
+        return n > 0
+
+
+def write_all(fd: int, data: memoryview) -> None:
+    """Write all the data to a file descriptor (os.write() may write only a part)."""
+    while data:
+        written = os.write(fd, data)
+        data = data[written:]
+
+
+class PipesIdleError(TimeoutError):
+    """None of the pipes had any data for too long."""
+
+
+class PipesTimeoutError(TimeoutError):
+    """The pipes didn't all reach EOF in time."""
+
+
+def drain_iter(
+    pipes: Iterable[Pipe],
+    *,
+    idle_timeout: float | None = None,
+    timeout: float | None = None,
+) -> Generator[None]:
+    """Read from all the pipes until EOF, in the current thread.
+
+    Uses a selector to wait until any of the pipes has data available. Yields after
+    each batch of reads, so that the caller can e.g. consume the lines in between.
+    Closes the pipes at EOF (or if the caller stops iterating).
+
+    If none of the pipes has any data for idle_timeout seconds, raises PipesIdleError.
+    If the pipes don't all reach EOF in timeout seconds, raises PipesTimeoutError.
+    """
+    end = None if timeout is None else time.monotonic() + timeout
+    with selectors.DefaultSelector() as selector:
+        for pipe in pipes:
+            selector.register(pipe.pipe, selectors.EVENT_READ, pipe)
+
+        try:
+            while selector.get_map():
+                select_timeout = idle_timeout
+                if end is not None:
+                    left = max(end - time.monotonic(), 0)
+                    if select_timeout is None or left < select_timeout:
+                        select_timeout = left
+                ready = selector.select(select_timeout)
+                if not ready:
+                    if end is not None and time.monotonic() >= end:
+                        raise PipesTimeoutError(f"The pipes didn't close in {timeout}s")
+                    if select_timeout == idle_timeout:
+                        raise PipesIdleError(
+                            f"No data in the pipes for {idle_timeout}s"
+                        )
+                    continue
+                for key, _ in ready:
+                    pipe: Pipe = key.data
+                    if not pipe.read():
+                        selector.unregister(key.fileobj)
+                        pipe.pipe.close()
+                yield
+        finally:
+            for key in list(selector.get_map().values()):
+                selector.unregister(key.fileobj)
+                key.data.pipe.close()
+
+
+def drain(
+    pipes: Iterable[Pipe],
+    *,
+    idle_timeout: float | None = None,
+    timeout: float | None = None,
+) -> None:
+    """Read from all the pipes until EOF, in the current thread. See drain_iter()."""
+    for _ in drain_iter(pipes, idle_timeout=idle_timeout, timeout=timeout):
+        pass
+
+
+async def read_lines_async(
+    stream: asyncio.StreamReader,
+    on_line: Callable[[str], None],
+    on_data: Callable[[], None] | None = None,
+) -> None:
+    """Read lines from an asyncio stream until EOF. See LineDecoder for the decoding.
+
+    Calls on_data (if specified) whenever any data arrives, even a partial line.
+    """
+    decoder = LineDecoder(on_line)
+    while data := await stream.read(_READ_SIZE):
+        if on_data:
+            on_data()
+        decoder.feed(data)
+    decoder.feed(b"", final=True)
@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import dataclasses
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from konfusion.lib.cache import cache_dir, write_atomically
+
+if TYPE_CHECKING:
+    from konfusion.lib.tools._cli_tool import CliTool
+
+log = logging.getLogger(__name__)
+
+# Bump when the format of the cache file changes
+_CACHE_FORMAT_VERSION = 1
+
+# A long option in --help output, e.g. '--multi-arch' in '  --multi-arch string'
+_FLAG_RE = re.compile(r"(?<![\w-])--[a-zA-Z0-9][\w-]*")
+
+
+@dataclasses.dataclass(frozen=True, kw_only=True)
+class ToolInfo:
+    """What an installed CLI tool is and what it supports.
+
+    The version is the first line the tool printed for its version_args (or None
+    if the tool failed). The flags are the long options each of the probed
+    subcommands lists in its --help output ('' is the tool itself).
+
+    >>> info = ToolInfo(
+    ...     path="/usr/bin/skopeo",
+    ...     version="skopeo version 1.18.0",
+    ...     flags={"copy": frozenset({"--multi-arch", "--dest-precompute-digests"})},
+    ... )
+    >>> info.supports("--multi-arch", subcommand="copy")
+    True
+    """
+
+    path: str
+    version: str | None
+    flags: dict[str, frozenset[str]]
+
+    def supports(self, flag: str, *, subcommand: str = "") -> bool:
+        """Check if the (sub)command accepts the flag."""
+        if subcommand not in self.flags:
+            raise ValueError(
+                f"{self.path} {subcommand} --help was not probed, see probe_help_for"
+            )
+        return flag in self.flags[subcommand]
+
+
+class ToolRegistry:
+    """Finds CLI tools and probes what they support, remembering the results.
+
+    Looks up each executable in PATH only once per process. Probes the version and
+    the flags of each binary only once and caches the results on disk, keyed by
+    the path, size and mtime of the binary (so upgrading the tool invalidates them).
+    Failure to read or write the cache is not fatal.
+    """
+
+    def __init__(self, cache_path: Path | None = None) -> None:
+        self._cache_path = cache_path or cache_dir() / "tool-info.json"
+        self._lock = threading.Lock()
+        self._which: dict[tuple[str, str], str | None] = {}
+        self._entries: dict[str, dict[str, Any]] | None = None
+
+    def which(self, name: str) -> str | None:
+        """Find an executable in PATH, like shutil.which()."""
+        key = (name, os.getenv("PATH", os.defpath))
+        with self._lock:
+            if key not in self._which:
+                self._which[key] = shutil.which(name)
+            return self._which[key]
+
+    def info(self, tool: CliTool) -> ToolInfo:
+        """Get the version and flags of the tool, probe them if not cached.
+
+        Probing runs the tool with its version_args and each of its probe_help_for
+        subcommands with --help. Blocks, but only for the first use of a binary.
+        """
+        path = str(tool.executable_path)
+        stat = Path(path).stat()
+        fingerprint = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+        with self._lock:
+            cached = self._load().get(path)
+            if cached and _fingerprint(cached) != fingerprint:
+                log.debug("%s changed since it was probed, probing again", path)
+                cached = None
+            version = cached["version"] if cached else None
+            flags: dict[str, list[str]] = dict(cached["flags"]) if cached else {}
+
+        # Probe without holding the lock, a slow tool shouldn't block the others.
+        # Another thread may probe the same tool at the same time, that's harmless.
+        probed: dict[str, Any] = {}
+        if cached is None:
+            version = probed["version"] = _probe_version(tool)
+        for subcommand in tool.probe_help_for:
+            if subcommand not in flags:
+                flags[subcommand] = _probe_flags(tool, subcommand)
+                probed.setdefault("flags", {})[subcommand] = flags[subcommand]
+
+        if probed:
+            with self._lock:
+                self._publish(path, fingerprint, probed)
+
+        return ToolInfo(
+            path=path,
+            version=version,
+            flags={sub: frozenset(sub_flags) for sub, sub_flags in flags.items()},
+        )
+
+    def _publish(
+        self, path: str, fingerprint: dict[str, int], probed: dict[str, Any]
+    ) -> None:
+        """Add the probe results to the cache and save it. Call with the lock."""
+        entries = self._load()
+        entry = entries.get(path)
+        if entry is None or _fingerprint(entry) != fingerprint:
+            entry = entries[path] = {**fingerprint, "version": None, "flags": {}}
+        if "version" in probed:
+            entry["version"] = probed["version"]
+        entry["flags"].update(probed.get("flags", {}))
+        self._save()
+
+    def _load(self) -> dict[str, dict[str, Any]]:
+        if self._entries is not None:
+            return self._entries
+
+        entries: dict[str, dict[str, Any]] = {}
+        try:
+            with self._cache_path.open() as f:
+                data = json.load(f)
+            if data["format_version"] == _CACHE_FORMAT_VERSION:
+                entries = data["tools"]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.debug("Failed to read tool info cache %s: %r", self._cache_path, e)
+
+        self._entries = entries
+        return entries
+
+    def _save(self) -> None:
+        data = {"format_version": _CACHE_FORMAT_VERSION, "tools": self._entries}
+        try:
+            write_atomically(self._cache_path, json.dumps(data))
+        except OSError as e:
+            log.debug("Failed to write tool info cache %s: %r", self._cache_path, e)
+
+
+def _fingerprint(entry: dict[str, Any]) -> dict[str, int]:
+    return {"mtime_ns": entry["mtime_ns"], "size": entry["size"]}
+
+
+def _probe_version(tool: CliTool) -> str | None:
+    log.debug("Probing the version of %s", tool.executable_path)
+    proc = tool.run(tool.version_args, check=False)
+    if proc.returncode != 0:
+        return None
+    output = proc.stdout + proc.stderr
+    return next((line.strip() for line in output.splitlines() if line.strip()), None)
+
+
+def _probe_flags(tool: CliTool, subcommand: str) -> list[str]:
+    log.debug("Probing the flags of %s %s", tool.executable_path, subcommand)
+    proc = tool.run([*subcommand.split(), "--help"], check=False)
+    # Some tools print the help to stderr
+    return sorted(set(_FLAG_RE.findall(proc.stdout + proc.stderr)))
+
+
+_registry: ToolRegistry | None = None
+_registry_lock = threading.Lock()
+
+
+def get_tool_registry() -> ToolRegistry:
+    """Get the registry shared by all the CLI tools in this process."""
+    global _registry  # noqa: PLW0603
+
+    with _registry_lock:
+        if _registry is None:
+            _registry = ToolRegistry()
+        return _registry
+
+
+def set_tool_registry(registry: ToolRegistry | None) -> None:
+    """Replace the shared registry (e.g. to use a different cache file).
+
+    Set to None to go back to the default, created on first use.
+    """
+    global _registry  # noqa: PLW0603
+
+    with _registry_lock:
+        _registry = registry
@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+import contextlib
+import contextvars
+import dataclasses
+import re
+import threading
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Generator, Iterable
+
+# Numbers and hex strings (digests, IDs), the parts that typically vary between
+# otherwise identical progress lines, e.g. "Copying blob sha256:1a2b3c..."
+_VARYING_PARTS_RE = re.compile(r"[0-9a-fA-F]{8,}|\d+")
+
+
+def line_pattern(line: str) -> str:
+    """Get the pattern of a line, i.e. the line with the varying parts masked.
+
+    >>> line_pattern("Copying blob sha256:9b2a1f0e5c7d")
+    'Copying blob sha#:#'
+
+    >>> line_pattern("Copying 3 of 10 blobs")
+    'Copying # of # blobs'
+    """
+    return _VARYING_PARTS_RE.sub("#", line.strip())
+
+
+@dataclasses.dataclass(kw_only=True)
+class _PatternWindow:
+    start: float
+    shown: int = 0
+    hidden: int = 0
+    last_hidden_line: str = ""
+
+
+class RepeatedLinesCollapser:
+    """Rate-limits repetitive lines (e.g. progress output of a CLI tool).
+
+    Passes lines through to the output callback, but shows at most max_lines
+    lines of the same pattern (see line_pattern()) per interval seconds. Instead
+    of the rest, shows a summary with the last hidden line and the number of
+    hidden lines once the interval passes. The summaries are shown when the next
+    line comes or when flush_expired() is called (see flushing_periodically(), if
+    the output can go quiet). Call flush() at the end to show the rest of the summaries.
+
+    Thread-safe.
+
+    >>> collapser = RepeatedLinesCollapser(print, max_lines=2)
+    >>> for i in range(5):
+    ...     collapser(f"Copying blob {i}")
+    Copying blob 0
+    Copying blob 1
+    >>> collapser("Writing manifest")
+    Writing manifest
+    >>> collapser.flush()
+    Copying blob 4 (last of 3 similar lines hidden in 0.0s)
+    """
+
+    def __init__(
+        self,
+        output: Callable[[str], None],
+        *,
+        max_lines: int = 5,
+        interval: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self._output = output
+        self._max_lines = max_lines
+        self._interval = interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        # Ordered by the start of the window, a pattern gets a new window (at the end)
+        # only after its old one expires
+        self._windows: dict[str, _PatternWindow] = {}
+
+    def __call__(self, line: str) -> None:
+        line = line.rstrip("\n")
+        pattern = line_pattern(line)
+        now = self._clock()
+
+        with self._lock:
+            self._flush_expired(now)
+            window = self._windows.get(pattern)
+            if window is None:
+                window = self._windows[pattern] = _PatternWindow(start=now)
+
+            if window.shown < self._max_lines:
+                window.shown += 1
+                self._output(line)
+            else:
+                window.hidden += 1
+                window.last_hidden_line = line
+
+    def flush_expired(self) -> None:
+        """Show the summaries for the patterns whose interval has passed."""
+        with self._lock:
+            self._flush_expired(self._clock())
+
+    def flush(self) -> None:
+        """Show the summaries of all the hidden lines."""
+        with self._lock:
+            now = self._clock()
+            for window in self._windows.values():
+                self._show_summary(window, now)
+            self._windows.clear()
+
+    def _flush_expired(self, now: float) -> None:
+        while self._windows:
+            pattern, window = next(iter(self._windows.items()))
+            if now - window.start < self._interval:
+                break
+            del self._windows[pattern]
+            self._show_summary(window, now)
+
+    def _show_summary(self, window: _PatternWindow, now: float) -> None:
+        if window.hidden:
+            elapsed = now - window.start
+            self._output(
+                f"{window.last_hidden_line} "
+                f"(last of {window.hidden} similar lines hidden in {elapsed:.1f}s)"
+            )
+
+
+# How often flushing_periodically() checks for expired summaries
+_FLUSH_EVERY = 1.0
+
+_flushed: dict[RepeatedLinesCollapser, contextvars.Context] = {}
+_flushed_lock = threading.Lock()
+_flusher: threading.Thread | None = None
+
+
+@contextlib.contextmanager
+def flushing_periodically(
+    collapsers: Iterable[RepeatedLinesCollapser],
+) -> Generator[None]:
+    """Call flush_expired() of the collapsers periodically, while in this context.
+
+    One background thread does that for all the collapsers in the process. It calls
+    them in (a copy of) the current context, so that e.g. the summaries get logged
+    where the rest of the lines go.
+    """
+    collapsers = list(collapsers)
+    if not collapsers:
+        yield
+        return
+
+    global _flusher  # noqa: PLW0603
+
+    context = contextvars.copy_context()
+    with _flushed_lock:
+        _flushed.update(dict.fromkeys(collapsers, context))
+        if _flusher is None:
+            _flusher = threading.Thread(
+                target=_flush_periodically, name="konfusion-flusher", daemon=True
+            )
+            _flusher.start()
+    try:
+        yield
+    finally:
+        with _flushed_lock:
+            for collapser in collapsers:
+                del _flushed[collapser]
+
+
+def _flush_periodically() -> None:
+    while True:
+        time.sleep(_FLUSH_EVERY)
+        with _flushed_lock:
+            flushed = list(_flushed.items())
+        for collapser, context in flushed:
+            context.run(collapser.flush_expired)
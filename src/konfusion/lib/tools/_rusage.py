@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import dataclasses
+import logging
+import os
+import subprocess
+import sys
+import time
+from typing import TYPE_CHECKING, Any, Self
+
+if TYPE_CHECKING:
+    import resource
+    from collections.abc import Sequence
+
+log = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass(frozen=True, kw_only=True)
+class ResourceUsage:
+    """Resources used by a finished subprocess.
+
+    Times are in seconds, max_rss in bytes. The block I/O counts are the number
+    of 512-byte blocks the process read from or wrote to disk (not the page cache).
+
+    >>> print(ResourceUsage(
+    ...     wall_time=2.5,
+    ...     user_time=0.75,
+    ...     system_time=0.25,
+    ...     max_rss=50 * 1024 * 1024,
+    ...     block_reads=0,
+    ...     block_writes=16,
+    ... ))
+    2.50s wall, 0.75s user, 0.25s sys, max RSS 50.0 MiB, 0/16 blocks read/written
+    """
+
+    wall_time: float
+    user_time: float
+    system_time: float
+    max_rss: int
+    block_reads: int
+    block_writes: int
+
+    @classmethod
+    def from_rusage(cls, wall_time: float, rusage: resource.struct_rusage) -> Self:
+        return cls(
+            wall_time=wall_time,
+            user_time=rusage.ru_utime,
+            system_time=rusage.ru_stime,
+            # In kilobytes on Linux
+            max_rss=rusage.ru_maxrss * 1024,
+            block_reads=rusage.ru_inblock,
+            block_writes=rusage.ru_oublock,
+        )
+
+    def __str__(self) -> str:
+        return (
+            f"{self.wall_time:.2f}s wall, {self.user_time:.2f}s user, "
+            f"{self.system_time:.2f}s sys, max RSS {self.max_rss / 1024 / 1024:.1f} MiB, "
+            f"{self.block_reads}/{self.block_writes} blocks read/written"
+        )
+
+
+class MeasuredProcess[T](subprocess.CompletedProcess[T]):
+    """A CompletedProcess with the resources used by the process.
+
+    The resource_usage is None if the process was not measured.
+    """
+
+    def __init__(
+        self,
+        args: Sequence[Any],
+        returncode: int,
+        stdout: T | None = None,
+        stderr: T | None = None,
+        *,
+        resource_usage: ResourceUsage | None = None,
+    ) -> None:
+        super().__init__(args, returncode, stdout, stderr)
+        self.resource_usage = resource_usage
+
+
+def wait_with_rusage(
+    process: subprocess.Popen[bytes], started_at: float, timeout: float | None = None
+) -> tuple[int, ResourceUsage | None]:
+    """Wait for the process to exit, return the returncode and the resource usage.
+
+    The started_at time is the time.monotonic() value from when the process started.
+    If something else already reaped the process (e.g. Popen.poll()), the resource
+    usage is lost, returns None for it. If the process doesn't exit in timeout
+    seconds, raises subprocess.TimeoutExpired.
+    """
+    try:
+        if timeout is None:
+            _, status, rusage = os.wait4(process.pid, 0)
+        else:
+            status, rusage = _poll_wait4(process, timeout)
+    except ChildProcessError:
+        log.debug("Process %d was already reaped, no resource usage", process.pid)
+        return process.wait(), None
+    wall_time = time.monotonic() - started_at
+    # We reaped the process, let Popen know
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, ResourceUsage.from_rusage(wall_time, rusage)
+
+
+def _poll_wait4(
+    process: subprocess.Popen[bytes], timeout: float
+) -> tuple[int, resource.struct_rusage]:
+    # wait4() has no timeout, poll it with increasing delays like Popen.wait() does
+    end = time.monotonic() + timeout
+    delay = 0.0005
+    while True:
+        pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            return status, rusage
+        left = end - time.monotonic()
+        if left <= 0:
+            raise subprocess.TimeoutExpired(process.args, timeout)
+        delay = min(delay * 2, left, 0.05)
+        time.sleep(delay)
+
+
+async def await_with_rusage(
+    process: subprocess.Popen[bytes], started_at: float
+) -> tuple[int, ResourceUsage | None]:
+    """Async version of wait_with_rusage().
+
+    Waits for a pidfd to become readable (i.e. for the process to exit) in the event
+    loop. Where there are no pidfds, waits in a thread.
+    """
+    # Imported lazily, only async code should pay for importing asyncio
+    import asyncio
+
+    if sys.platform != "linux":
+        return await asyncio.to_thread(wait_with_rusage, process, started_at)
+
+    loop = asyncio.get_running_loop()
+    exited = loop.create_future()
+
+    def on_exit() -> None:
+        if not exited.done():
+            exited.set_result(None)
+
+    try:
+        pidfd = os.pidfd_open(process.pid)
+    except ProcessLookupError:
+        # Already reaped, see wait_with_rusage()
+        return wait_with_rusage(process, started_at)
+    try:
+        loop.add_reader(pidfd, on_exit)
+        try:
+            await exited
+        finally:
+            loop.remove_reader(pidfd)
+    finally:
+        os.close(pidfd)
+
+    # Exited, doesn't block
+    return wait_with_rusage(process, started_at)
@@ -0,0 +1,339 @@
+from __future__ import annotations
+
+import contextlib
+import contextvars
+import dataclasses
+import itertools
+import logging
+import math
+import os
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from konfusion.lib import deadline, tracing
+from konfusion.lib.deadline import DeadlineExceededError
+
+if TYPE_CHECKING:
+    import asyncio
+    from collections.abc import AsyncGenerator, Callable, Generator, Sequence
+    from contextlib import AbstractContextManager
+
+log = logging.getLogger(__name__)
+
+_priority: contextvars.ContextVar[int] = contextvars.ContextVar("_priority", default=0)
+
+
+@contextlib.contextmanager
+def scheduling_priority(priority: int) -> Generator[None]:
+    """Set the priority of the CLI tools started inside this context (and thread/task).
+
+    Lower values go first (like nice values), the default priority is 0.
+
+    >>> with scheduling_priority(-1):
+    ...     pass  # e.g. skopeo.copy(...) for a step that blocks everything else
+    """
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def available_cpus() -> float:
+    """Get the number of CPUs this process can use, respecting cgroup CPU limits.
+
+    In a container (e.g. a Kubernetes pod with a CPU limit), os.cpu_count() reports
+    all the CPUs of the node, but the cgroup quota allows using only a fraction
+    of them.
+    """
+    cpus = len(os.sched_getaffinity(0))
+    quota = _cgroup_cpu_quota()
+    if quota is None:
+        return cpus
+    return min(cpus, quota)
+
+
+def _cgroup_cpu_quota() -> float | None:
+    # cgroup v2: "$MAX $PERIOD", $MAX may be "max"
+    with contextlib.suppress(OSError, ValueError):
+        max_, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()
+        return None if max_ == "max" else int(max_) / int(period)
+
+    # cgroup v1: a negative quota means no limit
+    with contextlib.suppress(OSError, ValueError):
+        cpu_dir = Path("/sys/fs/cgroup/cpu")
+        quota = int((cpu_dir / "cpu.cfs_quota_us").read_text())
+        period = int((cpu_dir / "cpu.cfs_period_us").read_text())
+        return None if quota < 0 else quota / period
+
+    return None
+
+
+def default_max_running() -> int:
+    """Get the default limit of CLI tool processes running at once.
+
+    Twice the number of available CPUs (the tools typically spend much of their time
+    waiting for the network), at least 2.
+    """
+    return max(2, math.ceil(2 * available_cpus()))
+
+
+@dataclasses.dataclass(kw_only=True)
+class QueueStats:
+    """Statistics of waiting for a slot to run a CLI tool."""
+
+    started: int = 0
+    queued: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+
+
+@dataclasses.dataclass(order=True, kw_only=True)
+class _Waiter:
+    priority: int
+    seq: int
+    queued_at: float = dataclasses.field(compare=False)
+    # The number of slots for each tool and the limits of the tools
+    tools: Counter[str] = dataclasses.field(compare=False)
+    tool_limits: dict[str, int | None] = dataclasses.field(compare=False)
+    wake: Callable[[], None] = dataclasses.field(compare=False)
+    granted: bool = dataclasses.field(default=False, compare=False)
+
+
+class Scheduler:
+    """Limits the number of CLI tool processes running at once.
+
+    Each CliTool process runs in a slot. There are max_running slots in total and
+    each tool can have its own limit (e.g. to limit the connections to a registry).
+    Callers that don't get a slot right away wait in a queue, ordered by priority
+    (see scheduling_priority()) and then by arrival. A caller waiting for a busy
+    tool doesn't block callers of other tools.
+
+    Both threads and asyncio tasks can wait for slots, see slot() and aslot().
+    To run several processes at once (e.g. a pipeline), wait for all the slots
+    together with slots(), so that two callers cannot deadlock each holding some.
+    Callers that need fewer slots can overtake such a caller, but only for
+    fairness_timeout seconds. Then the callers behind it wait until it gets its slots.
+
+    Waiting honors the deadline (see konfusion.lib.deadline), raises
+    DeadlineExceededError if the deadline passes before getting a slot.
+
+    >>> scheduler = Scheduler(max_running=1)
+    >>> with scheduler.slot("skopeo"):
+    ...     pass  # run skopeo
+    >>> scheduler.stats()
+    {'skopeo': QueueStats(started=1, queued=0, total_wait=0.0, max_wait=0.0)}
+    """
+
+    def __init__(
+        self, max_running: int | None = None, *, fairness_timeout: float = 10.0
+    ) -> None:
+        self.max_running = max_running or default_max_running()
+        self.fairness_timeout = fairness_timeout
+        self._lock = threading.Lock()
+        self._running: Counter[str] = Counter()
+        self._running_total = 0
+        self._queue: list[_Waiter] = []
+        self._seq = itertools.count()
+        self._stats: dict[str, QueueStats] = {}
+
+    def stats(self) -> dict[str, QueueStats]:
+        """Get the queue statistics for each tool."""
+        with self._lock:
+            return {
+                tool: dataclasses.replace(stats) for tool, stats in self._stats.items()
+            }
+
+    def slot(
+        self, tool: str, tool_limit: int | None = None
+    ) -> AbstractContextManager[None]:
+        """Wait for a slot to run the tool, in the current thread."""
+        return self.slots([(tool, tool_limit)])
+
+    @contextlib.contextmanager
+    def slots(self, tools: Sequence[tuple[str, int | None]]) -> Generator[None]:
+        """Wait for a slot for each of the (tool, tool_limit) pairs, all at once.
+
+        If there are more tools than max_running (or than a tool limit allows),
+        waits until nothing else is running and then takes all the slots.
+        """
+        event = threading.Event()
+        waiter = self._enqueue(tools, event.set)
+        queued, start = not waiter.granted, time.monotonic()
+        try:
+            if queued:
+                with tracing.span(
+                    "scheduler.wait",
+                    tool=", ".join(waiter.tools),
+                    priority=waiter.priority,
+                ):
+                    left = deadline.remaining()
+                    if not event.wait(None if left is None else max(left, 0)):
+                        raise _deadline_exceeded(waiter)
+        except BaseException:
+            self._abandon(waiter)
+            raise
+
+        self._record_start(waiter, queued, time.monotonic() - start)
+        try:
+            yield
+        finally:
+            self._release(waiter)
+
+    @contextlib.asynccontextmanager
+    async def aslot(
+        self, tool: str, tool_limit: int | None = None
+    ) -> AsyncGenerator[None]:
+        """Wait for a slot to run the tool, in the current asyncio task."""
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def wake() -> None:
+            # May get called from a different thread
+            loop.call_soon_threadsafe(_set_result, granted)
+
+        waiter = self._enqueue([(tool, tool_limit)], wake)
+        queued, start = not waiter.granted, time.monotonic()
+        try:
+            if queued:
+                with tracing.span(
+                    "scheduler.wait", tool=tool, priority=waiter.priority
+                ):
+                    try:
+                        async with asyncio.timeout(deadline.remaining()):
+                            await granted
+                    except TimeoutError as e:
+                        raise _deadline_exceeded(waiter) from e
+        except BaseException:
+            self._abandon(waiter)
+            raise
+
+        self._record_start(waiter, queued, time.monotonic() - start)
+        try:
+            yield
+        finally:
+            self._release(waiter)
+
+    def _enqueue(
+        self, tools: Sequence[tuple[str, int | None]], wake: Callable[[], None]
+    ) -> _Waiter:
+        waiter = _Waiter(
+            priority=_priority.get(),
+            seq=next(self._seq),
+            queued_at=time.monotonic(),
+            tools=Counter(tool for tool, _ in tools),
+            tool_limits=dict(tools),
+            wake=wake,
+        )
+        with self._lock:
+            self._queue.append(waiter)
+            self._dispatch()
+            if not waiter.granted:
+                log.debug(
+                    "Waiting for a slot to run %s: %d/%d processes running",
+                    ", ".join(waiter.tools),
+                    self._running_total,
+                    self.max_running,
+                )
+        return waiter
+
+    def _dispatch(self) -> None:
+        """Give the free slots to the waiters that can take them. Call with the lock."""
+        granted_any = False
+        now = time.monotonic()
+        for waiter in sorted(self._queue):
+            if self._running_total >= self.max_running:
+                break
+            if not self._fits_max_running(waiter):
+                if now - waiter.queued_at >= self.fairness_timeout:
+                    # Smaller requests kept taking the slots it needs, let the
+                    # running ones finish to make room for it
+                    break
+                continue
+            if not self._fits_tool_limits(waiter):
+                continue
+            waiter.granted = granted_any = True
+            self._running_total += waiter.tools.total()
+            self._running.update(waiter.tools)
+            waiter.wake()
+
+        if granted_any:
+            self._queue = [waiter for waiter in self._queue if not waiter.granted]
+
+    def _fits_max_running(self, waiter: _Waiter) -> bool:
+        # A request bigger than the limit can never fit, let it run alone instead
+        total = self._running_total
+        return not total or total + waiter.tools.total() <= self.max_running
+
+    def _fits_tool_limits(self, waiter: _Waiter) -> bool:
+        for tool, count in waiter.tools.items():
+            limit = waiter.tool_limits[tool]
+            running = self._running[tool]
+            if limit is not None and running and running + count > limit:
+                return False
+
+        return True
+
+    def _record_start(self, waiter: _Waiter, queued: bool, wait: float) -> None:
+        with self._lock:
+            for tool, count in waiter.tools.items():
+                stats = self._stats.setdefault(tool, QueueStats())
+                stats.started += count
+                if queued:
+                    stats.queued += count
+                    stats.total_wait += wait * count
+                    stats.max_wait = max(stats.max_wait, wait)
+
+    def _release(self, waiter: _Waiter) -> None:
+        with self._lock:
+            self._running_total -= waiter.tools.total()
+            self._running.subtract(waiter.tools)
+            self._dispatch()
+
+    def _abandon(self, waiter: _Waiter) -> None:
+        """Stop waiting (e.g. the task got cancelled), release the slot if granted."""
+        with self._lock:
+            if not waiter.granted:
+                self._queue.remove(waiter)
+                return
+        self._release(waiter)
+
+
+def _deadline_exceeded(waiter: _Waiter) -> DeadlineExceededError:
+    tools = ", ".join(waiter.tools)
+    return DeadlineExceededError(f"Deadline exceeded while waiting to run {tools}")
+
+
+def _set_result(future: asyncio.Future[None]) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+_scheduler: Scheduler | None = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> Scheduler:
+    """Get the scheduler shared by all the CLI tools in this process."""
+    global _scheduler  # noqa: PLW0603
+
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler()
+        return _scheduler
+
+
+def set_scheduler(scheduler: Scheduler | None) -> None:
+    """Replace the shared scheduler (e.g. to change the limits).
+
+    Set to None to go back to the default, created on first use.
+    """
+    global _scheduler  # noqa: PLW0603
+
+    with _scheduler_lock:
+        _scheduler = scheduler
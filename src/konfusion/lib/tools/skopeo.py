@@ -1,59 +1,357 @@
 from __future__ import annotations
 
+import contextlib
 import logging
+import re
 import subprocess
-from typing import TYPE_CHECKING, Self
+from typing import TYPE_CHECKING, Any, ClassVar, Self
 
+from konfusion.lib.circuit_breaker import CircuitOpenError, get_circuit_breaker
 from konfusion.lib.retry import retry
-from konfusion.lib.tools import CliTool
+from konfusion.lib.tools import CliTool, ToolStalledError
 
 if TYPE_CHECKING:
+    from collections.abc import Generator, Iterable, Sequence
+    from os import PathLike
+
     from konfusion.lib.imageref import ImageRef
 
 log = logging.getLogger(__name__)
 
+# e.g. 'received unexpected HTTP status: 503 Service Unavailable', 'StatusCode: 429'
+_HTTP_STATUS_RE = re.compile(r"(?i)\b(?:http status|status ?code|status):? *(\d{3})\b")
+_RETRY_AFTER_RE = re.compile(r"(?i)\bretry[- ]after:? *(\d+(?:\.\d+)?)")
+
+_RATE_LIMITED_RE = re.compile(r"(?i)toomanyrequests|too many requests|rate limit")
+_INVALID_REFERENCE_RE = re.compile(
+    r"(?i)invalid reference format|invalid image name|error parsing image name"
+)
+_NOT_FOUND_RE = re.compile(r"(?i)manifest unknown|name unknown|not found")
+_UNAUTHORIZED_RE = re.compile(
+    r"(?i)unauthorized|authentication required|denied|forbidden"
+)
+_TLS_RE = re.compile(r"(?i)x509:|certificate|tls: ")
+_TRANSIENT_RE = re.compile(
+    r"(?i)connection reset|connection refused|broken pipe|i/o timeout|\beof\b"
+    r"|tls handshake timeout|timeout awaiting response headers"
+    r"|temporary failure in name resolution|server misbehaving"
+)
+
+
+class SkopeoError(subprocess.CalledProcessError):
+    """skopeo failed, see the subclasses for the failures we can tell apart.
+
+    Failures we cannot classify are considered retriable, skopeo error messages
+    vary too much between versions to fail fast on anything unrecognized.
+    """
+
+    retriable: ClassVar[bool] = True
+
+    def __init__(
+        self,
+        returncode: int,
+        cmd: Sequence[Any],
+        output: str | None = None,
+        stderr: str | None = None,
+        *,
+        http_status: int | None = None,
+    ) -> None:
+        super().__init__(returncode, cmd, output, stderr)
+        self.http_status = http_status
+
+    def __str__(self) -> str:
+        reason = type(self).__doc__ or ""
+        return f"{super().__str__()} {reason.splitlines()[0]}"
+
+
+class RegistryUnavailableError(SkopeoError):
+    """The registry is unreachable or failing (5xx, connection reset, timeout)."""
+
+
+class RateLimitedError(SkopeoError):
+    """The registry rate-limits us (429, toomanyrequests)."""
+
+    def __init__(
+        self,
+        returncode: int,
+        cmd: Sequence[Any],
+        output: str | None = None,
+        stderr: str | None = None,
+        *,
+        http_status: int | None = None,
+        retry_after: float | None = None,
+    ) -> None:
+        super().__init__(returncode, cmd, output, stderr, http_status=http_status)
+        self.retry_after = retry_after
+
+
+class UnauthorizedError(SkopeoError):
+    """The registry rejected our credentials or we lack permissions (401, 403)."""
+
+    retriable: ClassVar[bool] = False
+
+
+class ImageNotFoundError(SkopeoError):
+    """The image (or the tag) does not exist (404, manifest unknown)."""
+
+    retriable: ClassVar[bool] = False
+
+
+class InvalidReferenceError(SkopeoError):
+    """The image reference is not valid."""
+
+    retriable: ClassVar[bool] = False
+
+
+class TLSVerificationError(SkopeoError):
+    """The registry's TLS certificate cannot be verified."""
+
+    retriable: ClassVar[bool] = False
+
+
+def classify_error(error: subprocess.CalledProcessError) -> SkopeoError:
+    """Turn a failed skopeo process into the matching SkopeoError subclass.
+
+    Looks at the exit code, the HTTP status and the error message in the stderr.
+
+    >>> error = subprocess.CalledProcessError(
+    ...     1,
+    ...     ["skopeo", "inspect", "docker://quay.io/foo/bar:latest"],
+    ...     stderr="Error: reading manifest latest in quay.io/foo/bar: "
+    ...     "toomanyrequests: slow down, Retry-After: 30",
+    ... )
+    >>> e = classify_error(error)
+    >>> type(e).__name__, e.retry_after
+    ('RateLimitedError', 30.0)
+    """
+    stderr = error.stderr if isinstance(error.stderr, str) else ""
+    status_match = _HTTP_STATUS_RE.search(stderr)
+    status = int(status_match.group(1)) if status_match else None
+
+    def make(cls: type[SkopeoError]) -> SkopeoError:
+        return cls(
+            error.returncode,
+            error.cmd,
+            error.output,
+            error.stderr,
+            http_status=status,
+        )
+
+    if status == 429 or _RATE_LIMITED_RE.search(stderr):
+        retry_after_match = _RETRY_AFTER_RE.search(stderr)
+        return RateLimitedError(
+            error.returncode,
+            error.cmd,
+            error.output,
+            error.stderr,
+            http_status=status,
+            retry_after=float(retry_after_match.group(1))
+            if retry_after_match
+            else None,
+        )
+    if _INVALID_REFERENCE_RE.search(stderr):
+        return make(InvalidReferenceError)
+    # https://www.mankier.com/1/skopeo#Exit_Status
+    #   1 => generic error
+    #   2 => image does not exist
+    if error.returncode == 2 or status == 404 or _NOT_FOUND_RE.search(stderr):
+        return make(ImageNotFoundError)
+    if status in (401, 403) or _UNAUTHORIZED_RE.search(stderr):
+        return make(UnauthorizedError)
+    if (status is not None and status >= 500) or _TRANSIENT_RE.search(stderr):
+        return make(RegistryUnavailableError)
+    if _TLS_RE.search(stderr):
+        return make(TLSVerificationError)
+    return make(SkopeoError)
+
+
+def _registries_in(cmd: Iterable[Any]) -> list[str]:
+    """Get the registry hosts of the docker:// references in a skopeo command."""
+    return [
+        arg.removeprefix("docker://").partition("/")[0]
+        for arg in map(str, cmd)
+        if arg.startswith("docker://")
+    ]
+
+
+def _failed_registries(exc: Exception) -> list[str]:
+    """Get the registries that the failure counts against (for the circuit breaker)."""
+    if isinstance(exc, SkopeoError) and exc.retriable:
+        registries = _registries_in(exc.cmd)
+        stderr = exc.stderr if isinstance(exc.stderr, str) else ""
+        # Blame the registry the error message mentions, if it's clear which one
+        mentioned = [registry for registry in registries if registry in stderr]
+        return mentioned or registries
+    if isinstance(exc, ToolStalledError):
+        return _registries_in(exc.cmd)
+    return []
+
+
+@contextlib.contextmanager
+def _calling_registries(*images: ImageRef) -> Generator[None]:
+    """Check the circuit breakers of the registries, classify errors."""
+    registries = {image.repo.partition("/")[0] for image in images}
+    with (
+        get_circuit_breaker().guard(registries, _failed_registries),
+        _classified_errors(),
+    ):
+        yield
+
+
+@contextlib.contextmanager
+def _classified_errors() -> Generator[None]:
+    try:
+        yield
+    except subprocess.CalledProcessError as e:
+        raise classify_error(e) from None
+
+
+def _is_retriable_skopeo_error(exc: Exception) -> bool:
+    return isinstance(exc, CircuitOpenError) or (
+        isinstance(exc, SkopeoError) and exc.retriable
+    )
+
+
+def _advertised_retry_after(exc: Exception) -> float | None:
+    if isinstance(exc, RateLimitedError | CircuitOpenError):
+        return exc.retry_after
+    return None
+
 
 class Skopeo(CliTool):
-    """Wrapper for calling skopeo in a subprocess."""
+    """Wrapper for calling skopeo in a subprocess.
+
+    Caches the results of inspecting digest-pinned images (which cannot change).
+    Share a Skopeo instance to share the cache, e.g. via konfusion.context.
+
+    Older skopeo versions lack some flags, check before passing them, e.g.
+    skopeo.supports("--no-tags", subcommand="inspect").
+    """
+
+    # Each skopeo process opens its own connections to the registries
+    max_concurrent: ClassVar[int | None] = 8
+    probe_help_for: ClassVar[Sequence[str]] = ("inspect",)
+
+    # skopeo can hang on a dead connection without ever exiting. Kill it if it
+    # doesn't print anything for this long and retry right away. A copy prints
+    # only a line per blob (no progress without a TTY), so allow big blobs more time.
+    copy_stall_timeout: ClassVar[float | None] = 600.0
+    inspect_stall_timeout: ClassVar[float | None] = 120.0
+
+    def __init__(self, executable_path: str | PathLike[str]) -> None:
+        super().__init__(executable_path)
+        self._inspect_cache: dict[tuple[ImageRef, str], str] = {}
 
     @classmethod
     def find_in_path(cls) -> Self:
         """Find skopeo in PATH."""
         return super().find_by_name("skopeo")
 
-    @staticmethod
-    def _is_retriable_skopeo_erorr(exc: Exception) -> bool:
-        if not isinstance(exc, subprocess.CalledProcessError):
-            return False
-        # https://www.mankier.com/1/skopeo#Exit_Status
-        #   1 => generic error
-        #   2 => image does not exist
-        return exc.returncode == 1
-
-    @retry(on=_is_retriable_skopeo_erorr)
+    @retry(
+        on=_is_retriable_skopeo_error,
+        immediately_on=ToolStalledError,
+        retry_after=_advertised_retry_after,
+        budget_keys=_failed_registries,
+    )
     def copy(self, source: ImageRef, dest: ImageRef, *additional_args: str) -> None:
         """Run 'skopeo copy ...'."""
-        self.run_with_logging(
-            [
-                "copy",
-                *additional_args,
-                f"docker://{self._adjust_image(source)}",
-                f"docker://{dest}",
-            ]
-        )
+        with _calling_registries(source, dest):
+            self.run_with_logging(
+                self._copy_args(source, dest, additional_args),
+                stall_timeout=self.copy_stall_timeout,
+            )
+
+    @retry(
+        on=_is_retriable_skopeo_error,
+        immediately_on=ToolStalledError,
+        retry_after=_advertised_retry_after,
+        budget_keys=_failed_registries,
+    )
+    async def acopy(
+        self, source: ImageRef, dest: ImageRef, *additional_args: str
+    ) -> None:
+        """Async version of copy()."""
+        with _calling_registries(source, dest):
+            await self.arun_with_logging(
+                self._copy_args(source, dest, additional_args),
+                stall_timeout=self.copy_stall_timeout,
+            )
 
-    @retry(on=_is_retriable_skopeo_erorr)
     def inspect_format(self, image: ImageRef, format: str) -> str:
         """Run 'skopeo inspect --format ...'."""
-        return self.run_with_logging(
-            [
-                "inspect",
-                "--no-tags",
-                "--format",
-                format,
-                f"docker://{self._adjust_image(image)}",
-            ]
-        ).stdout
+        if not image.digest:
+            return self._inspect_format(image, format)
+
+        key = (image.replace(tag=None), format)
+        if key not in self._inspect_cache:
+            self._inspect_cache[key] = self._inspect_format(image, format)
+        else:
+            log.debug("Using cached inspect result for %s", image)
+        return self._inspect_cache[key]
+
+    async def ainspect_format(self, image: ImageRef, format: str) -> str:
+        """Async version of inspect_format()."""
+        if not image.digest:
+            return await self._ainspect_format(image, format)
+
+        key = (image.replace(tag=None), format)
+        if key not in self._inspect_cache:
+            self._inspect_cache[key] = await self._ainspect_format(image, format)
+        else:
+            log.debug("Using cached inspect result for %s", image)
+        return self._inspect_cache[key]
+
+    @retry(
+        on=_is_retriable_skopeo_error,
+        immediately_on=ToolStalledError,
+        retry_after=_advertised_retry_after,
+        budget_keys=_failed_registries,
+    )
+    def _inspect_format(self, image: ImageRef, format: str) -> str:
+        with _calling_registries(image):
+            proc = self.run_with_logging(
+                self._inspect_args(image, format),
+                stall_timeout=self.inspect_stall_timeout,
+            )
+        return proc.stdout
+
+    @retry(
+        on=_is_retriable_skopeo_error,
+        immediately_on=ToolStalledError,
+        retry_after=_advertised_retry_after,
+        budget_keys=_failed_registries,
+    )
+    async def _ainspect_format(self, image: ImageRef, format: str) -> str:
+        with _calling_registries(image):
+            proc = await self.arun_with_logging(
+                self._inspect_args(image, format),
+                stall_timeout=self.inspect_stall_timeout,
+            )
+        return proc.stdout
+
+    def _copy_args(
+        self, source: ImageRef, dest: ImageRef, additional_args: Sequence[str]
+    ) -> list[str]:
+        return [
+            "copy",
+            *additional_args,
+            f"docker://{self._adjust_image(source)}",
+            f"docker://{dest}",
+        ]
+
+    def _inspect_args(self, image: ImageRef, format: str) -> list[str]:
+        # Listing all the tags of a big repository is slow (and the tags are not
+        # needed), but skopeo < 1.5 doesn't have --no-tags
+        no_tags = (
+            ["--no-tags"] if self.supports("--no-tags", subcommand="inspect") else []
+        )
+        return [
+            "inspect",
+            *no_tags,
+            "--format",
+            format,
+            f"docker://{self._adjust_image(image)}",
+        ]
 
     def _adjust_image(self, image: ImageRef) -> ImageRef:
         if image.digest:
@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+import contextlib
+import dataclasses
+import json
+import logging
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from collections.abc import Generator
+    from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass(frozen=True, kw_only=True)
+class Span:
+    """A named, timed operation. Times are in nanoseconds since the start of tracing."""
+
+    name: str
+    start_ns: int
+    duration_ns: int
+    thread_id: int
+    thread_name: str
+    attributes: dict[str, Any]
+
+
+class Tracer:
+    """Collects spans and exports them as a trace file."""
+
+    def __init__(self) -> None:
+        self._start_ns = time.perf_counter_ns()
+        self._spans: list[Span] = []
+        self._lock = threading.Lock()
+
+    @property
+    def spans(self) -> list[Span]:
+        with self._lock:
+            return list(self._spans)
+
+    def now_ns(self) -> int:
+        """Return the time elapsed since the start of tracing."""
+        return time.perf_counter_ns() - self._start_ns
+
+    def add_span(
+        self, name: str, start_ns: int, duration_ns: int, attributes: dict[str, Any]
+    ) -> None:
+        thread = threading.current_thread()
+        span = Span(
+            name=name,
+            start_ns=start_ns,
+            duration_ns=duration_ns,
+            thread_id=thread.ident or 0,
+            thread_name=thread.name,
+            attributes=attributes,
+        )
+        with self._lock:
+            self._spans.append(span)
+
+    def export_chrome_trace(self, path: Path) -> None:
+        """Export the spans in the Chrome trace event format.
+
+        View the trace in https://ui.perfetto.dev or chrome://tracing.
+        """
+        pid = os.getpid()
+        events: list[dict[str, Any]] = []
+        thread_names: dict[int, str] = {}
+
+        for span in self.spans:
+            thread_names[span.thread_id] = span.thread_name
+            events.append(
+                {
+                    "name": span.name,
+                    "ph": "X",
+                    "ts": span.start_ns / 1000,
+                    "dur": span.duration_ns / 1000,
+                    "pid": pid,
+                    "tid": span.thread_id,
+                    "args": span.attributes,
+                }
+            )
+
+        for thread_id, thread_name in thread_names.items():
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "tid": thread_id,
+                    "args": {"name": thread_name},
+                }
+            )
+
+        with path.open("w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, default=str)
+
+
+_tracer: Tracer | None = None
+
+
+def get_tracer() -> Tracer | None:
+    """Return the active tracer, None if tracing is not enabled."""
+    return _tracer
+
+
+@contextlib.contextmanager
+def record_trace(output: Path | None) -> Generator[Tracer | None]:
+    """Enable tracing inside this context, then write the trace file to output.
+
+    If output is None, does nothing.
+    """
+    global _tracer  # noqa: PLW0603
+
+    if output is None:
+        yield None
+        return
+
+    tracer = _tracer = Tracer()
+    try:
+        yield tracer
+    finally:
+        _tracer = None
+        tracer.export_chrome_trace(output)
+        log.info("Wrote trace to %s", output)
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes: Any) -> Generator[dict[str, Any]]:  # noqa: ANN401
+    """Record a span covering the code that runs inside this context.
+
+    Yields the attributes of the span, the code can add more attributes
+    (e.g. the results of the operation). If the code raises an exception,
+    the span gets an 'error' attribute.
+
+    Does nothing if tracing is not enabled.
+
+    >>> with span("example", foo="bar") as attrs:
+    ...     attrs["baz"] = 42
+    """
+    tracer = _tracer
+    if tracer is None:
+        yield attributes
+        return
+
+    start_ns = tracer.now_ns()
+    try:
+        yield attributes
+    except BaseException as e:
+        attributes["error"] = repr(e)
+        raise
+    finally:
+        tracer.add_span(name, start_ns, tracer.now_ns() - start_ns, attributes)
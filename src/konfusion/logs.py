@@ -1,28 +1,69 @@
 from __future__ import annotations
 
+import contextvars
 import datetime
 import logging
-from typing import TYPE_CHECKING
+import sys
+from typing import TYPE_CHECKING, TextIO
 
 if TYPE_CHECKING:
     from collections.abc import Iterable
+    from logging.handlers import QueueHandler, QueueListener
 
 
 class _ISOTimeFormatter(logging.Formatter):
+    def __init__(self, fmt: str | None = None) -> None:
+        super().__init__(fmt)
+        # (second, formatted time), formatting the same second over and over
+        # is a significant part of the cost of logging many lines
+        self._cached_time: tuple[int, str] | None = None
+
     def formatTime(  # noqa: N802 # blame the stdlib logging module for camelCase
         self,
         record: logging.LogRecord,
         datefmt: str | None = None,
     ) -> str:
-        dt = datetime.datetime.fromtimestamp(record.created).astimezone()
-        if not datefmt:
-            return dt.isoformat(sep=" ", timespec="seconds")
-        else:
+        if datefmt:
+            dt = datetime.datetime.fromtimestamp(record.created).astimezone()
             return dt.strftime(datefmt)
 
+        second = int(record.created)
+        cached_time = self._cached_time
+        if cached_time and cached_time[0] == second:
+            return cached_time[1]
+
+        dt = datetime.datetime.fromtimestamp(second).astimezone()
+        formatted = dt.isoformat(sep=" ", timespec="seconds")
+        self._cached_time = (second, formatted)
+        return formatted
+
+
+class _StderrHandler(logging.StreamHandler[TextIO]):
+    """Like StreamHandler(), but writes to the current sys.stderr, not the one at init.
+
+    So that replacing sys.stderr also redirects the logs (see konfusion.server).
+    """
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.stream = sys.stderr
+        super().emit(record)
+
+
+def setup_logging(
+    level: int | str,
+    additional_modules: Iterable[str] = (),
+    *,
+    background: bool = False,
+) -> None:
+    """Set up logging for default modules and the specified additional modules.
 
-def setup_logging(level: int, additional_modules: Iterable[str] = ()) -> None:
-    """Set up logging for default modules and the specified additional modules."""
+    If background is True, logging calls only put the records in a queue. Formatting
+    the records and writing them to stderr happens in a background thread, so that
+    logging doesn't slow down the code that logs (e.g. threads reading the output of
+    a chatty subprocess). Once enabled, background logging stays enabled for all
+    the subsequent calls. The queued records get written at exit.
+    """
+    background = background or _background is not None
 
     for module in ["konfusion", "stamina", *additional_modules]:
         if module == "stamina":
@@ -34,11 +75,114 @@ def setup_logging(level: int, additional_modules: Iterable[str] = ()) -> None:
         else:
             log_format = "%(asctime)s [%(levelname)-8s] %(message)s"
 
-        handler = logging.StreamHandler()
+        handler = _StderrHandler()
         handler.setFormatter(_ISOTimeFormatter(log_format))
 
         logger = logging.getLogger(module)
         logger.setLevel(level)
 
+        if background:
+            _start_background_logging()
+            _switch_to_background(logger)
+
         if not logger.hasHandlers():
-            logger.addHandler(handler)
+            if _background:
+                queue_handler, router, _ = _background
+                router.handlers[module] = handler
+                logger.addHandler(queue_handler)
+            else:
+                logger.addHandler(handler)
+
+
+class _ModuleRouter(logging.Handler):
+    """Passes each record to the handler of the module that logged it.
+
+    Runs in the background thread. Passes the record in the context of the thread
+    that logged it, so that context variables work the same as in the foreground.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.handlers: dict[str, logging.Handler] = {}
+
+    def handle(self, record: logging.LogRecord) -> bool:
+        # No need for locking and filtering, the handlers do that
+        self.emit(record)
+        return True
+
+    def emit(self, record: logging.LogRecord) -> None:
+        context: contextvars.Context | None = record.__dict__.pop(
+            "_konfusion_context", None
+        )
+        module = record.name
+        # Find the handler for the longest matching prefix, e.g. konfusion.lib.tools
+        # => konfusion.lib => konfusion
+        while module and module not in self.handlers:
+            module = module.rpartition(".")[0]
+
+        if handler := self.handlers.get(module):
+            if context:
+                context.run(handler.handle, record)
+            else:
+                handler.handle(record)
+
+
+_background: tuple[QueueHandler, _ModuleRouter, QueueListener] | None = None
+
+
+def _start_background_logging() -> None:
+    global _background  # noqa: PLW0603
+
+    if _background:
+        return
+
+    import atexit
+    import queue
+    from logging.handlers import QueueHandler, QueueListener
+
+    class _ContextQueueHandler(QueueHandler):
+        def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+            # The default prepare() merges the args (and the traceback) into the
+            # message, while the args still have the values from the logging call.
+            # The rest of the formatting happens in the background thread.
+            record = super().prepare(record)
+            record._konfusion_context = contextvars.copy_context()  # pyright: ignore[reportAttributeAccessIssue]
+            return record
+
+    log_queue: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    router = _ModuleRouter()
+    listener = QueueListener(log_queue, router)
+    listener.start()
+    _background = (_ContextQueueHandler(log_queue), router, listener)
+
+    atexit.register(_stop_background_logging)
+
+
+def _switch_to_background(logger: logging.Logger) -> None:
+    """Move the handlers that setup_logging() added to the logger to the background."""
+    if not _background:
+        return
+
+    queue_handler, router, _ = _background
+    for handler in list(logger.handlers):
+        if isinstance(handler, _StderrHandler):
+            router.handlers[logger.name] = handler
+            logger.removeHandler(handler)
+            logger.addHandler(queue_handler)
+
+
+def _stop_background_logging() -> None:
+    """Write all the queued records and go back to logging in the foreground."""
+    global _background  # noqa: PLW0603
+
+    if not _background:
+        return
+
+    queue_handler, router, listener = _background
+    listener.stop()
+    _background = None
+
+    for module, handler in router.handlers.items():
+        logger = logging.getLogger(module)
+        logger.removeHandler(queue_handler)
+        logger.addHandler(handler)
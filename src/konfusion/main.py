@@ -1,21 +1,34 @@
 from __future__ import annotations
 
 import argparse
-import importlib.metadata
 import io
 import logging
+import os
 import sys
+from pathlib import Path
 from types import ModuleType
-from typing import Any, TypeGuard
+from typing import TYPE_CHECKING, Any, TypeGuard
 
-from konfusion.cli import CliCommand
+from konfusion import context
+from konfusion.cli import CliCommand, run_command
+from konfusion.command_index import CommandIndex, IndexedCommand
+from konfusion.lib import deadline, tool_usage, tracing
 from konfusion.logs import setup_logging
+from konfusion.profiling import profile
+
+if TYPE_CHECKING:
+    from collections.abc import Sequence
 
 log = logging.getLogger(__name__)
 
 
-def load_commands() -> dict[str, type[CliCommand]]:
-    """Load CLI commands from packages that provide 'konfusion.commands' entrypoints."""
+def find_commands() -> dict[str, IndexedCommand]:
+    """Find the 'konfusion.commands' entrypoints without loading them."""
+    return CommandIndex.load().commands
+
+
+def load_command(entrypoint: IndexedCommand) -> type[CliCommand]:
+    """Load the CLI command referenced by a 'konfusion.commands' entrypoint."""
 
     def is_cli_command(obj: Any) -> TypeGuard[type[CliCommand]]:  # noqa: ANN401
         return (
@@ -24,29 +37,40 @@ def load_commands() -> dict[str, type[CliCommand]]:
             and obj is not CliCommand
         )
 
-    def get_command(entrypoint: importlib.metadata.EntryPoint) -> type[CliCommand]:
-        obj = entrypoint.load()
+    obj = entrypoint.load()
 
-        if is_cli_command(obj):
-            return obj
-        elif isinstance(obj, ModuleType):
-            commands = [attr for attr in vars(obj).values() if is_cli_command(attr)]
-            if len(commands) == 1:
-                return commands[0]
-            else:
-                msg = f"Expected to find 1 CliCommand subclass, found {len(commands)}"
-                raise ValueError(msg)
+    if is_cli_command(obj):
+        return obj
+    elif isinstance(obj, ModuleType):
+        commands = [attr for attr in vars(obj).values() if is_cli_command(attr)]
+        if len(commands) == 1:
+            return commands[0]
         else:
-            raise ValueError(f"Unsupported object type: {obj!r}")
+            msg = f"Expected to find 1 CliCommand subclass, found {len(commands)}"
+            raise ValueError(msg)
+    else:
+        raise ValueError(f"Unsupported object type: {obj!r}")
+
+
+def load_commands(
+    entrypoints: dict[str, IndexedCommand] | None = None,
+) -> dict[str, type[CliCommand]]:
+    """Load CLI commands from packages that provide 'konfusion.commands' entrypoints.
+
+    By default, loads all the commands. Pass a subset of the entrypoints returned
+    by find_commands() to load only those.
+    """
+    if entrypoints is None:
+        entrypoints = find_commands()
 
     commands: dict[str, type[CliCommand]] = {}
-    for entrypoint in importlib.metadata.entry_points(group="konfusion.commands"):
+    for name, entrypoint in entrypoints.items():
         try:
-            commands[entrypoint.name] = get_command(entrypoint)
+            commands[name] = load_command(entrypoint)
         except Exception as e:
             log.warning(
                 "Failed to load command %s from %s: %r",
-                entrypoint.name,
+                name,
                 entrypoint.value,
                 e,
             )
@@ -54,53 +78,187 @@ def load_commands() -> dict[str, type[CliCommand]]:
     return commands
 
 
-def version_str(loaded_commands: dict[str, type[CliCommand]]) -> str:
+def version_str(command_index: CommandIndex) -> str:
     f = io.StringIO()
-    print("konfusion", importlib.metadata.version("konfusion"), file=f)
+    print("konfusion", command_index.konfusion_version, file=f)
     print("\nsubcommands:", file=f)
 
-    if loaded_commands:
-        for cmd_name, cmd_type in loaded_commands.items():
-            module, _, _ = cmd_type.__module__.partition(".")
-            version = importlib.metadata.version(module)
-            print(f"  {cmd_name} ({module} {version})", file=f)
+    if command_index.commands:
+        for cmd_name, entrypoint in command_index.commands.items():
+            print(
+                f"  {cmd_name} ({entrypoint.dist_name} {entrypoint.dist_version})",
+                file=f,
+            )
     else:
-        print("  <none loaded>", file=f)
+        print("  <none found>", file=f)
 
     return f.getvalue()
 
 
-def get_parser(loaded_commands: dict[str, type[CliCommand]]) -> argparse.ArgumentParser:
-    """Build the CLI parser."""
-    parser = argparse.ArgumentParser()
-    parser.formatter_class = argparse.RawDescriptionHelpFormatter
-
+def _add_global_arguments(
+    parser: argparse.ArgumentParser, command_index: CommandIndex
+) -> None:
     parser.add_argument(
         "--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="INFO"
     )
     parser.add_argument(
-        "--version", action="version", version=version_str(loaded_commands)
+        "--version", action="version", version=version_str(command_index)
+    )
+    parser.add_argument(
+        "--log-in-background",
+        action="store_true",
+        help="format and write logs in a background thread (helps with chatty tools)",
+    )
+    parser.add_argument(
+        "--trace",
+        type=Path,
+        metavar="PATH",
+        help="record a trace of the subcommand, write it to PATH (Chrome trace format)",
+    )
+    parser.add_argument(
+        "--profile-cpu",
+        type=Path,
+        metavar="PATH",
+        help=(
+            "profile CPU usage of the subcommand, write the pstats file to PATH. "
+            "cProfile instruments only the calling thread, so it captures almost "
+            "none of the work of subcommands that use threads (e.g. batch, serve)"
+        ),
+    )
+    parser.add_argument(
+        "--profile-memory",
+        type=Path,
+        metavar="PATH",
+        help="trace memory allocations of the subcommand, write a summary to PATH",
+    )
+    parser.add_argument(
+        "--profile-memory-top",
+        type=int,
+        default=20,
+        metavar="N",
+        help="include the top N allocations in the memory summary (default: 20)",
+    )
+    parser.add_argument(
+        "--result-cache",
+        type=Path,
+        metavar="DIR",
+        default=os.getenv("KONFUSION_RESULT_CACHE"),
+        help=(
+            "skip cacheable subcommands that already succeeded with the same inputs, "
+            "keep the records in DIR (default: $KONFUSION_RESULT_CACHE)"
+        ),
+    )
+    parser.add_argument(
+        "--force-rerun",
+        action="store_true",
+        help="with --result-cache, run the subcommand even if the cache says it succeeded",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        metavar="SECONDS",
+        # Read after the parsing, so that an invalid value cannot break e.g. --help
+        # (see resolve_deadline())
+        help=(
+            "give up if the subcommand doesn't finish in SECONDS, cut retries short "
+            "and kill the CLI tools at the deadline (default: $KONFUSION_DEADLINE)"
+        ),
     )
 
-    def add_subcommand(name: str, cmd: type[CliCommand]) -> None:
-        cmd.setup_parser(subcommands.add_parser(name, help=cmd.help()))
 
-    if loaded_commands:
-        subcommands = parser.add_subparsers(title="subcommands", required=True)
-        for name, cmd_type in loaded_commands.items():
-            add_subcommand(name, cmd_type)
+def get_parser(
+    command_index: CommandIndex, loaded_commands: dict[str, type[CliCommand]]
+) -> argparse.ArgumentParser:
+    """Build the CLI parser.
+
+    Only the loaded commands get a fully set up subparser. The rest are listed
+    as subcommands, but cannot parse any arguments.
+    """
+    parser = argparse.ArgumentParser()
+    parser.formatter_class = argparse.RawDescriptionHelpFormatter
+    _add_global_arguments(parser, command_index)
+
+    if command_index.commands:
+        subcommands = parser.add_subparsers(
+            title="subcommands", dest="konfusion_command", required=True
+        )
+        for name in command_index.commands:
+            if cmd_type := loaded_commands.get(name):
+                cmd_type.setup_parser(
+                    subcommands.add_parser(name, help=cmd_type.help())
+                )
+            else:
+                subcommands.add_parser(name, add_help=False)
 
     return parser
 
 
-def main() -> None:
+def _peek_args(
+    command_index: CommandIndex, argv: Sequence[str] | None
+) -> argparse.Namespace:
+    """Parse the global arguments and the subcommand name without loading any commands.
+
+    The subcommand name is in the 'konfusion_command' attribute, None if no subcommand
+    was selected. If the arguments are invalid, returns the defaults and leaves
+    the error reporting to the real parser.
+    """
+    parser = argparse.ArgumentParser(add_help=False, exit_on_error=False)
+    parser.formatter_class = argparse.RawDescriptionHelpFormatter
+    _add_global_arguments(parser, command_index)
+
+    subcommands = parser.add_subparsers(dest="konfusion_command")
+    for name in command_index.commands:
+        subcommands.add_parser(name, add_help=False)
+
+    try:
+        args, _ = parser.parse_known_args(argv)
+    except argparse.ArgumentError:
+        args, _ = parser.parse_known_args([])
+
+    return args
+
+
+def main(argv: Sequence[str] | None = None) -> None:
     """Run Konfusion."""
-    # Setup logging first so that we can log messages when we fail to load a command
-    setup_logging(logging.INFO)
-    loaded_commands = load_commands()
+    command_index = CommandIndex.load()
+    peeked_args = _peek_args(command_index, argv)
+    # Setup logging before loading commands so that we can log messages when we fail
+    # to load a command
+    setup_logging(logging.INFO, background=peeked_args.log_in_background)
+
+    # Start tracing and profiling early to include the loading of the plugin
+    with (
+        tracing.record_trace(peeked_args.trace),
+        tracing.span("konfusion.main", argv=sys.argv[1:] if argv is None else argv),
+        profile(
+            cpu_output=peeked_args.profile_cpu,
+            memory_output=peeked_args.profile_memory,
+            memory_top=peeked_args.profile_memory_top,
+        ),
+        context.new(),
+    ):
+        _run(command_index, peeked_args.konfusion_command, argv)
 
-    parser = get_parser(loaded_commands)
-    args = parser.parse_args()
+
+def _run(
+    command_index: CommandIndex, selected: str | None, argv: Sequence[str] | None
+) -> None:
+    available_commands = command_index.commands
+
+    # Import only the plugin that provides the selected subcommand. If there is no
+    # subcommand (e.g. 'konfusion --help'), load all of them to show the full help.
+    with tracing.span("konfusion.load_commands", selected=selected):
+        if selected:
+            loaded_commands = load_commands({selected: available_commands[selected]})
+        else:
+            loaded_commands = load_commands(available_commands)
+
+    if selected and not loaded_commands:
+        sys.exit(f"Failed to load subcommand {selected}")
+
+    parser = get_parser(command_index, loaded_commands)
+    args = parser.parse_args(argv)
+    resolve_deadline(args, parser)
 
     if not loaded_commands:
         sys.exit("No subcommands loaded")
@@ -113,4 +271,38 @@ def main() -> None:
 
     cmd_type: type[CliCommand] = args.__konfusion_cmd__
     cmd = cmd_type.from_parsed_args(args)
-    cmd.run()
+    with tracing.span("konfusion.run_command", command=selected):
+        run_parsed_command(cmd, args, command_index)
+
+
+def resolve_deadline(args: argparse.Namespace, parser: argparse.ArgumentParser) -> None:
+    """Default args.deadline to $KONFUSION_DEADLINE, report an invalid value."""
+    value = os.getenv("KONFUSION_DEADLINE")
+    if args.deadline is not None or not value:
+        return
+    try:
+        args.deadline = float(value)
+    except ValueError:
+        parser.error(f"invalid $KONFUSION_DEADLINE value: {value!r}")
+
+
+def run_parsed_command(
+    cmd: CliCommand, args: argparse.Namespace, command_index: CommandIndex
+) -> None:
+    """Run a command instantiated from args, honor the --result-cache and --deadline.
+
+    Logs a summary of the resources used by the CLI tools the command ran.
+    """
+    with deadline.within(args.deadline), tool_usage.tracking():
+        try:
+            if args.result_cache:
+                from konfusion.result_cache import ResultCache
+
+                result_cache = ResultCache(
+                    directory=args.result_cache, force_rerun=args.force_rerun
+                )
+                result_cache.run(cmd, command_index.commands[args.konfusion_command])
+            else:
+                run_command(cmd)
+        finally:
+            tool_usage.log_usage_summary()
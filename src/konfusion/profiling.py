@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import contextlib
+import logging
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Generator
+    from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+
+@contextlib.contextmanager
+def profile(
+    *,
+    cpu_output: Path | None = None,
+    memory_output: Path | None = None,
+    memory_top: int = 20,
+) -> Generator[None]:
+    """Profile the code that runs inside this context.
+
+    If cpu_output is set, profile CPU usage using cProfile and write the stats
+    to cpu_output (in the pstats format, use e.g. 'python -m pstats' to view them).
+    cProfile only instruments the calling thread, the work done in other threads
+    doesn't show up in the profile.
+
+    If memory_output is set, trace memory allocations using tracemalloc and write
+    a summary of the memory_top biggest allocations (grouped by source line)
+    to memory_output.
+
+    Note that tracing memory allocations slows down the code, which will skew
+    the CPU profile if both are enabled.
+    """
+    with contextlib.ExitStack() as stack:
+        if cpu_output:
+            stack.enter_context(_profile_cpu(cpu_output))
+        if memory_output:
+            stack.enter_context(_profile_memory(memory_output, memory_top))
+        yield
+
+
+@contextlib.contextmanager
+def _profile_cpu(output: Path) -> Generator[None]:
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(output)
+        log.info("Wrote CPU profile to %s", output)
+
+
+@contextlib.contextmanager
+def _profile_memory(output: Path, top: int) -> Generator[None]:
+    import tracemalloc
+
+    tracemalloc.start()
+    try:
+        yield
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        snapshot = snapshot.filter_traces(
+            [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+            ]
+        )
+        statistics = snapshot.statistics("lineno")
+
+        with output.open("w") as f:
+            print(f"Current traced memory: {current / 1024:.1f} KiB", file=f)
+            print(f"Peak traced memory: {peak / 1024:.1f} KiB", file=f)
+            print(f"\nTop {top} allocations by source line:", file=f)
+            for stat in statistics[:top]:
+                print(f"  {stat}", file=f)
+
+        log.info("Wrote memory allocation summary to %s", output)
@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import dataclasses
+import datetime
+import hashlib
+import json
+import logging
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, cast
+
+from konfusion.cli import run_command
+from konfusion.lib.cache import write_atomically
+from konfusion.lib.imageref import ImageRef
+
+if TYPE_CHECKING:
+    from konfusion.cli import CliCommand
+    from konfusion.command_index import IndexedCommand
+
+log = logging.getLogger(__name__)
+
+
+class _NotCacheableError(Exception):
+    pass
+
+
+@dataclasses.dataclass(frozen=True, kw_only=True)
+class ResultCache:
+    """Remembers successful command runs, skips running them again with the same inputs.
+
+    Only applies to commands that set 'cacheable = True' and only if all the images
+    in their arguments are pinned by digest. The cache key is the command name, the
+    version of the plugin that provides it and the (normalized) parsed arguments.
+    Because the images are pinned, the key identifies the content the command worked
+    with, not just the names.
+
+    Keep the directory on persistent storage (e.g. a Tekton workspace) to skip
+    the repeated work in pipeline re-runs.
+    """
+
+    directory: Path
+    force_rerun: bool = False
+
+    def run(self, cmd: CliCommand, entrypoint: IndexedCommand) -> None:
+        """Run the command, unless it previously succeeded with the same inputs."""
+        try:
+            record = self._record(cmd, entrypoint)
+        except _NotCacheableError as e:
+            log.debug("Not using the result cache: %s", e)
+            run_command(cmd)
+            return
+
+        record_json = json.dumps(record, sort_keys=True)
+        key = hashlib.sha256(record_json.encode()).hexdigest()
+        path = self.directory / f"{key}.json"
+
+        if path.exists() and not self.force_rerun:
+            log.info(
+                "Skipping %s, it already succeeded with the same inputs (see %s)",
+                entrypoint.name,
+                path,
+            )
+            return
+
+        run_command(cmd)
+
+        finished_at = datetime.datetime.now(datetime.UTC).isoformat()
+        # The command already succeeded, failing to record that is not fatal
+        try:
+            write_atomically(path, json.dumps(record | {"finished_at": finished_at}))
+        except OSError as e:
+            log.warning("Failed to write the result cache record %s: %r", path, e)
+
+    @staticmethod
+    def _record(cmd: CliCommand, entrypoint: IndexedCommand) -> dict[str, Any]:
+        if not cmd.cacheable:
+            raise _NotCacheableError(f"{entrypoint.name} is not cacheable")
+
+        arguments = {
+            field.name: _normalize(getattr(cmd, field.name))
+            for field in dataclasses.fields(cmd)
+        }
+        return {
+            "command": entrypoint.name,
+            "dist_name": entrypoint.dist_name,
+            "dist_version": entrypoint.dist_version,
+            "arguments": arguments,
+        }
+
+
+def _normalize(value: object) -> Any:  # noqa: ANN401
+    """Convert a command argument to a JSON-serializable value.
+
+    >>> _normalize(ImageRef.parse("quay.io/foo/bar:v1@sha256:abcd"))
+    'quay.io/foo/bar:v1@sha256:abcd'
+
+    >>> _normalize({"tags": ("v1", "v2"), "path": Path("/tmp")})
+    {'tags': ['v1', 'v2'], 'path': '/tmp'}
+    """
+    match value:
+        case ImageRef():
+            if not value.digest:
+                raise _NotCacheableError(f"{value} is not pinned by digest")
+            return str(value)
+        case str() | int() | float() | bool() | None:
+            return value
+        case Path():
+            return str(value)
+        case list() | tuple():
+            return [_normalize(item) for item in cast("list[object]", value)]
+        case dict():
+            items = cast("dict[object, object]", value).items()
+            return {str(k): _normalize(v) for k, v in items}
+        case _:
+            raise _NotCacheableError(f"unsupported argument type: {type(value)}")
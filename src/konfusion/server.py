@@ -0,0 +1,289 @@
+from __future__ import annotations
+
+import contextlib
+import contextvars
+import dataclasses
+import io
+import json
+import logging
+import os
+import signal
+import socketserver
+import sys
+import threading
+import traceback
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, TextIO, cast
+
+from konfusion.cli import CliCommand
+from konfusion.client import SOCKET_ENV_VAR
+from konfusion.command_index import CommandIndex
+from konfusion.lib import tracing
+from konfusion.logs import setup_logging
+from konfusion.main import (
+    get_parser,
+    load_commands,
+    resolve_deadline,
+    run_parsed_command,
+)
+
+if TYPE_CHECKING:
+    import argparse
+    from collections.abc import Generator, Sequence
+
+log = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass(frozen=True, kw_only=True)
+class Serve(CliCommand):
+    """Run subcommands sent by clients over a Unix socket.
+
+    Loads all the subcommands once, then keeps running and serving requests.
+    Each request runs one subcommand, the output and the exit status go back
+    to the client. Use the 'konfusion-client' command as the client, e.g.:
+
+      konfusion serve --socket /tmp/konfusion.sock &
+      export KONFUSION_SOCKET=/tmp/konfusion.sock
+      konfusion-client apply-tags --to-image ... --tags v1
+
+    Requests run concurrently, each in its own thread. The subcommands share
+    the server process, so anything they cache in memory stays warm between
+    requests. They also share the working directory and the environment variables
+    of the server, relative paths resolve against the server's working directory.
+
+    The --trace and --profile-* options are not supported per request.
+    Pass them to 'konfusion serve' to trace or profile the whole server instead.
+    """
+
+    socket_path: Path
+
+    @classmethod
+    def setup_parser(cls, parser: argparse.ArgumentParser) -> None:
+        super().setup_parser(parser)
+        default_socket = os.environ.get(SOCKET_ENV_VAR)
+        parser.add_argument(
+            "--socket",
+            dest="socket_path",
+            type=Path,
+            default=default_socket,
+            required=default_socket is None,
+            help=f"the path of the socket to listen on (default: ${SOCKET_ENV_VAR})",
+        )
+
+    def run(self) -> None:
+        with serve(self.socket_path) as server:
+            if threading.current_thread() is threading.main_thread():
+                # Shut down cleanly when the container gets stopped
+                signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+            log.info("Listening on %s", self.socket_path)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                log.info("Shutting down")
+
+
+@contextlib.contextmanager
+def serve(socket_path: Path) -> Generator[Server]:
+    """Load all the subcommands and create a server listening on socket_path.
+
+    Call serve_forever() on the yielded server to start serving requests.
+    Removes the socket file on exit.
+    """
+    command_index = CommandIndex.load()
+    loaded_commands = {
+        name: cmd_type
+        for name, cmd_type in load_commands(command_index.commands).items()
+        if not issubclass(cmd_type, Serve)
+    }
+    served_index = dataclasses.replace(
+        command_index,
+        commands={name: command_index.commands[name] for name in loaded_commands},
+    )
+    parser = get_parser(served_index, loaded_commands)
+
+    # Each request can set its own --log-level, so let all the records through
+    # the loggers and filter them in the handlers instead
+    default_level = logging.getLogger("konfusion").getEffectiveLevel()
+    modules = [cmd_type.__module__ for cmd_type in loaded_commands.values()]
+    setup_logging(logging.DEBUG, modules)
+    level_filter = _RequestLogLevelFilter(default_level)
+    handlers = {
+        handler
+        for module in ["konfusion", "stamina", *modules]
+        for handler in logging.getLogger(module).handlers
+    }
+
+    with contextlib.ExitStack() as stack:
+        for handler in handlers:
+            handler.addFilter(level_filter)
+            stack.callback(handler.removeFilter, level_filter)
+
+        stack.enter_context(_redirect_stdio_to_requests())
+        server = stack.enter_context(Server(socket_path, served_index, parser))
+        stack.callback(socket_path.unlink, missing_ok=True)
+        yield server
+
+
+class Server(socketserver.ThreadingUnixStreamServer):
+    """Serves konfusion requests over a Unix socket.
+
+    The protocol is newline-delimited JSON. The client sends one request:
+
+      {"argv": ["apply-tags", "--tags", "v1"]}
+
+    The server sends back the output of the subcommand as it happens, then
+    the exit status:
+
+      {"stream": "stderr", "data": "2025-01-01 00:00:00 [INFO    ] ...\\n"}
+      {"stream": "stdout", "data": "..."}
+      {"exit": 0}
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        socket_path: Path,
+        command_index: CommandIndex,
+        parser: argparse.ArgumentParser,
+    ) -> None:
+        self.command_index = command_index
+        self.parser = parser
+        super().__init__(str(socket_path), _RequestHandler)
+
+    def run_command(self, argv: Sequence[str]) -> int:
+        """Run the subcommand specified by argv, return the exit status."""
+        try:
+            args = self.parser.parse_args(argv)
+            resolve_deadline(args, self.parser)
+            if args.trace or args.profile_cpu or args.profile_memory:
+                self.parser.error(
+                    "--trace and --profile-* are not supported in server mode"
+                )
+
+            request = _current_request.get()
+            if request:
+                request.log_level = logging.getLevelNamesMapping()[args.log_level]
+
+            cmd_type: type[CliCommand] = args.__konfusion_cmd__
+            cmd = cmd_type.from_parsed_args(args)
+            with tracing.span("konfusion.run_command", command=cmd_type.__name__):
+                run_parsed_command(cmd, args, self.command_index)
+        except SystemExit as e:
+            return _exit_status(e.code)
+        except Exception:
+            traceback.print_exc()
+            return 1
+
+        return 0
+
+
+def _exit_status(code: str | int | None) -> int:
+    """Convert a sys.exit() argument to an exit status, the same way Python does.
+
+    >>> _exit_status(None), _exit_status(2)
+    (0, 2)
+    """
+    if code is None:
+        return 0
+    elif isinstance(code, int):
+        return code
+    else:
+        print(code, file=sys.stderr)
+        return 1
+
+
+class _Request:
+    def __init__(self, wfile: io.BufferedIOBase) -> None:
+        self.log_level = logging.INFO
+        self._wfile = wfile
+        self._lock = threading.Lock()
+        self._disconnected = False
+
+    def send(self, message: dict[str, Any]) -> None:
+        data = json.dumps(message).encode() + b"\n"
+        with self._lock:
+            if self._disconnected:
+                return
+            try:
+                self._wfile.write(data)
+                self._wfile.flush()
+            except OSError:
+                # The client went away, let the subcommand finish anyway
+                self._disconnected = True
+
+
+_current_request: contextvars.ContextVar[_Request | None] = contextvars.ContextVar(
+    "_current_request", default=None
+)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        request = _Request(self.wfile)
+
+        try:
+            argv = json.loads(self.rfile.readline())["argv"]
+            if not isinstance(argv, list):
+                raise TypeError("'argv' must be a list")
+            argv = [str(arg) for arg in cast("list[Any]", argv)]
+        except (ValueError, KeyError, TypeError) as e:
+            request.send({"stream": "stderr", "data": f"Invalid request: {e!r}\n"})
+            request.send({"exit": 2})
+            return
+
+        token = _current_request.set(request)
+        try:
+            with tracing.span("konfusion.serve.request", argv=argv):
+                exit_status = cast("Server", self.server).run_command(argv)
+        finally:
+            _current_request.reset(token)
+
+        request.send({"exit": exit_status})
+
+
+class _RequestLogLevelFilter(logging.Filter):
+    """Filter log records by the --log-level of the current request."""
+
+    def __init__(self, default_level: int) -> None:
+        super().__init__()
+        self._default_level = default_level
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        request = _current_request.get()
+        level = request.log_level if request else self._default_level
+        return record.levelno >= level
+
+
+class _RequestStream(io.TextIOBase):
+    """Sends the output to the client of the current request.
+
+    Writes to the original stream if there is no current request.
+    """
+
+    def __init__(self, name: str, original: TextIO) -> None:
+        self._name = name
+        self._original = original
+
+    def write(self, s: str) -> int:
+        if request := _current_request.get():
+            request.send({"stream": self._name, "data": s})
+        else:
+            self._original.write(s)
+        return len(s)
+
+    def flush(self) -> None:
+        if not _current_request.get():
+            self._original.flush()
+
+
+@contextlib.contextmanager
+def _redirect_stdio_to_requests() -> Generator[None]:
+    original_stdout, original_stderr = sys.stdout, sys.stderr
+    sys.stdout = cast("TextIO", _RequestStream("stdout", original_stdout))
+    sys.stderr = cast("TextIO", _RequestStream("stderr", original_stderr))
+    try:
+        yield
+    finally:
+        sys.stdout, sys.stderr = original_stdout, original_stderr
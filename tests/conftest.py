@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import sys
+import textwrap
+from typing import TYPE_CHECKING
+
+import pytest
+
+from konfusion.command_index import CommandIndex, IndexedCommand
+
+if TYPE_CHECKING:
+    from collections.abc import Generator
+    from pathlib import Path
+
+PLUGIN_TEMPLATE = textwrap.dedent(
+    """
+    from __future__ import annotations
+
+    import argparse
+    import dataclasses
+    import logging
+    import sys
+
+    from konfusion.cli import CliCommand
+
+
+    @dataclasses.dataclass(frozen=True, kw_only=True)
+    class Command(CliCommand):
+        \"\"\"Run {name}.\"\"\"
+
+        value: str
+        fail: bool
+        exit_code: int | None
+
+        @classmethod
+        def setup_parser(cls, parser: argparse.ArgumentParser) -> None:
+            super().setup_parser(parser)
+            parser.add_argument("--value", default="default")
+            parser.add_argument("--fail", action="store_true")
+            parser.add_argument("--exit-code", type=int)
+
+        def run(self) -> None:
+            logging.getLogger(__name__).debug("Running {name}")
+            if self.fail:
+                raise RuntimeError("{name} failed")
+            print("{name}:", self.value)
+            if self.exit_code is not None:
+                sys.exit(self.exit_code)
+    """
+)
+
+PLUGINS = {
+    "cmd-a": "fake_konfusion_plugin_a",
+    "cmd-b": "fake_konfusion_plugin_b",
+}
+
+
+@pytest.fixture
+def fake_plugins(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> Generator[dict[str, str]]:
+    """Make fake plugins available to konfusion.main, return {command: module}."""
+    for name, module in PLUGINS.items():
+        tmp_path.joinpath(f"{module}.py").write_text(PLUGIN_TEMPLATE.format(name=name))
+
+    command_index = CommandIndex(
+        konfusion_version="1.0",
+        commands={
+            name: IndexedCommand(
+                name=name, value=module, dist_name=module, dist_version="1.0"
+            )
+            for name, module in PLUGINS.items()
+        },
+    )
+
+    def load_index(*_: object) -> CommandIndex:
+        return command_index
+
+    monkeypatch.setattr(sys, "path", [str(tmp_path), *sys.path])
+    monkeypatch.setattr(CommandIndex, "load", load_index)
+
+    yield PLUGINS
+
+    for module in PLUGINS.values():
+        sys.modules.pop(module, None)
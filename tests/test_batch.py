@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+import dataclasses
+import json
+from typing import TYPE_CHECKING, Any
+
+import pytest
+
+from konfusion.command_index import CommandIndex, IndexedCommand
+from konfusion.main import main
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+@pytest.fixture
+def fake_plugins_with_batch(
+    fake_plugins: dict[str, str], monkeypatch: pytest.MonkeyPatch
+) -> dict[str, str]:
+    index = CommandIndex.load()
+    batch = IndexedCommand(
+        name="batch", value="konfusion.batch", dist_name="konfusion", dist_version="1.0"
+    )
+    index_with_batch = dataclasses.replace(
+        index, commands=index.commands | {"batch": batch}
+    )
+
+    def load_index(*_: object) -> CommandIndex:
+        return index_with_batch
+
+    monkeypatch.setattr(CommandIndex, "load", load_index)
+    return fake_plugins | {"batch": "konfusion.batch"}
+
+
+pytestmark = pytest.mark.usefixtures("fake_plugins_with_batch")
+
+
+def run_batch(tmp_path: Path, steps: list[dict[str, Any]], *args: str) -> None:
+    batch_file = tmp_path / "batch.json"
+    batch_file.write_text(json.dumps(steps))
+    main(["batch", str(batch_file), *args])
+
+
+def test_batch(tmp_path: Path, capsys: pytest.CaptureFixture[str]) -> None:
+    steps = [
+        {"name": "last", "argv": ["cmd-a", "--value", "3"], "needs": ["b"]},
+        {"name": "b", "argv": ["cmd-b", "--value", "2"], "needs": ["a"]},
+        {"name": "a", "argv": ["cmd-a", "--value", "1"]},
+    ]
+    run_batch(tmp_path, steps)
+
+    assert capsys.readouterr().out == "cmd-a: 1\ncmd-b: 2\ncmd-a: 3\n"
+
+
+def test_batch_runs_independent_steps(
+    tmp_path: Path, capsys: pytest.CaptureFixture[str]
+) -> None:
+    steps = [
+        {"argv": ["cmd-a", "--value", "1"]},
+        {"argv": ["cmd-b", "--value", "2"]},
+        {"argv": ["cmd-a", "--value", "3"]},
+    ]
+    run_batch(tmp_path, steps, "--workers", "2")
+
+    assert sorted(capsys.readouterr().out.splitlines()) == [
+        "cmd-a: 1",
+        "cmd-a: 3",
+        "cmd-b: 2",
+    ]
+
+
+def test_batch_skips_steps_that_need_failed_steps(
+    tmp_path: Path,
+    capsys: pytest.CaptureFixture[str],
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    steps = [
+        {"name": "fail", "argv": ["cmd-a", "--fail"]},
+        {"name": "skip", "argv": ["cmd-b"], "needs": ["fail"]},
+        {"name": "skip-too", "argv": ["cmd-b"], "needs": ["skip"]},
+        {"name": "succeed", "argv": ["cmd-b", "--value", "ok"]},
+    ]
+    with pytest.raises(SystemExit) as exc_info:
+        run_batch(tmp_path, steps, "--workers", "1")
+
+    assert exc_info.value.code == (
+        "Batch did not succeed. Failed steps: ['fail']. "
+        "Skipped steps: ['skip', 'skip-too']."
+    )
+    assert capsys.readouterr().out == "cmd-b: ok\n"
+    assert "[fail] Failed: RuntimeError: cmd-a failed" in caplog.messages
+
+
+def test_batch_step_exit_code(tmp_path: Path, caplog: pytest.LogCaptureFixture) -> None:
+    steps = [
+        {"name": "exit-0", "argv": ["cmd-a", "--exit-code", "0"]},
+        {"name": "exit-3", "argv": ["cmd-b", "--exit-code", "3"]},
+    ]
+    with pytest.raises(SystemExit) as exc_info:
+        run_batch(tmp_path, steps)
+
+    assert exc_info.value.code == (
+        "Batch did not succeed. Failed steps: ['exit-3']. Skipped steps: []."
+    )
+    assert "[exit-0] Finished in " in "\n".join(caplog.messages)
+
+
+INVALID_BATCHES: list[tuple[list[dict[str, Any]], str]] = [
+    (
+        [{"name": "a", "argv": ["cmd-a"], "needs": ["a"]}],
+        "Steps have a circular dependency: ['a', 'a']",
+    ),
+    (
+        [{"name": "a", "argv": ["cmd-a"], "needs": ["b"]}],
+        "[a] Needs unknown steps: ['b']",
+    ),
+    (
+        [{"name": "a", "argv": ["cmd-a"]}, {"name": "a", "argv": ["cmd-b"]}],
+        "{batch_file}: duplicate step names: ['a']",
+    ),
+    (
+        [{"argv": []}],
+        "{batch_file}: Step #0: 'argv' must be a non-empty list of strings",
+    ),
+    (
+        [{"argv": ["cmd-c"]}],
+        "Unknown subcommands: ['cmd-c']",
+    ),
+]
+
+
+@pytest.mark.parametrize(("steps", "expect_error"), INVALID_BATCHES)
+def test_invalid_batch(
+    steps: list[dict[str, Any]],
+    expect_error: str,
+    tmp_path: Path,
+    capsys: pytest.CaptureFixture[str],
+) -> None:
+    with pytest.raises(SystemExit) as exc_info:
+        run_batch(tmp_path, steps)
+
+    assert exc_info.value.code == expect_error.format(
+        batch_file=tmp_path / "batch.json"
+    )
+    assert capsys.readouterr().out == ""
+
+
+def test_batch_with_invalid_arguments(
+    tmp_path: Path, capsys: pytest.CaptureFixture[str]
+) -> None:
+    steps = [
+        {"argv": ["cmd-a"]},
+        {"argv": ["cmd-b", "--no-such-option"]},
+    ]
+    with pytest.raises(SystemExit) as exc_info:
+        run_batch(tmp_path, steps)
+
+    assert exc_info.value.code == 2
+    captured = capsys.readouterr()
+    assert captured.out == ""
+    assert "unrecognized arguments: --no-such-option" in captured.err
+
+
+def test_batch_with_invalid_workers(
+    tmp_path: Path, capsys: pytest.CaptureFixture[str]
+) -> None:
+    with pytest.raises(SystemExit) as exc_info:
+        run_batch(tmp_path, [{"argv": ["cmd-a"]}], "--workers", "0")
+
+    assert exc_info.value.code == 2
+    assert "--workers: must be a positive integer: '0'" in capsys.readouterr().err
+
+
+def test_unreadable_batch_file(tmp_path: Path) -> None:
+    batch_file = tmp_path / "batch.json"
+    with pytest.raises(SystemExit) as exc_info:
+        main(["batch", str(batch_file)])
+    assert exc_info.value.code == (
+        f"Failed to read the steps: [Errno 2] No such file or directory: '{batch_file}'"
+    )
+
+    batch_file.write_text("[{")
+    with pytest.raises(SystemExit) as exc_info:
+        main(["batch", str(batch_file)])
+    assert str(exc_info.value.code).startswith(f"{batch_file}: invalid JSON: ")
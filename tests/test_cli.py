@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import os
+import signal
+
+import pytest
+
+from konfusion.cli import CliCommand, run_command
+
+
+@dataclasses.dataclass(frozen=True, kw_only=True)
+class SleepForever(CliCommand):
+    events: list[str]
+
+    async def run(self) -> None:
+        async def sleep(name: str) -> None:
+            try:
+                await asyncio.sleep(3600)
+            except asyncio.CancelledError:
+                self.events.append(f"{name} cancelled")
+                raise
+
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(sleep("task 1"))
+            tg.create_task(sleep("task 2"))
+            asyncio.get_running_loop().call_soon(os.kill, os.getpid(), signal.SIGTERM)
+
+
+def test_sigterm_cancels_async_command() -> None:
+    original_handler = signal.getsignal(signal.SIGTERM)
+    events: list[str] = []
+
+    with pytest.raises(SystemExit) as exc_info:
+        run_command(SleepForever(events=events))
+
+    assert exc_info.value.code == 128 + signal.SIGTERM
+    assert sorted(events) == ["task 1 cancelled", "task 2 cancelled"]
+    assert signal.getsignal(signal.SIGTERM) == original_handler
+
+
+@dataclasses.dataclass(frozen=True, kw_only=True)
+class Fail(CliCommand):
+    async def run(self) -> None:
+        await asyncio.sleep(0)
+        raise ValueError("failed")
+
+
+def test_async_command_exception_propagates() -> None:
+    with pytest.raises(ValueError, match="failed"):
+        run_command(Fail())
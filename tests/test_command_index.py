@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import importlib.metadata
+import os
+import sys
+import textwrap
+from typing import TYPE_CHECKING
+
+import pytest
+
+from konfusion.command_index import CommandIndex, IndexedCommand
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+def install_fake_distribution(site_dir: Path, name: str, commands: list[str]) -> None:
+    dist_info = site_dir / f"{name}-1.2.3.dist-info"
+    dist_info.mkdir()
+    dist_info.joinpath("METADATA").write_text(
+        f"Metadata-Version: 2.1\nName: {name}\nVersion: 1.2.3\n"
+    )
+    dist_info.joinpath("entry_points.txt").write_text(
+        textwrap.dedent(
+            """
+            [konfusion.commands]
+            {}
+            """
+        ).format("\n".join(f"{cmd} = {name}.{cmd}" for cmd in commands))
+    )
+
+
+@pytest.fixture
+def site_dir(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    site_dir = tmp_path / "site-packages"
+    site_dir.mkdir()
+    # After the script directory, like the real site-packages
+    monkeypatch.setattr(sys, "path", [sys.path[0], str(site_dir), *sys.path[1:]])
+    return site_dir
+
+
+def test_load_builds_and_caches_index(
+    site_dir: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    index_dir = tmp_path / "cache"
+    install_fake_distribution(site_dir, "fake_plugin", ["foo", "bar"])
+
+    index = CommandIndex.load(index_dir)
+    assert index.commands["foo"] == IndexedCommand(
+        name="foo",
+        value="fake_plugin.foo",
+        dist_name="fake_plugin",
+        dist_version="1.2.3",
+    )
+    assert index.commands["bar"].module == "fake_plugin.bar"
+    assert len(list(index_dir.iterdir())) == 1
+
+    def no_scanning(**_: str) -> importlib.metadata.EntryPoints:
+        raise AssertionError("should have used the cached index")
+
+    monkeypatch.setattr(importlib.metadata, "entry_points", no_scanning)
+    assert CommandIndex.load(index_dir) == index
+
+
+def test_load_rebuilds_index_when_distributions_change(
+    site_dir: Path, tmp_path: Path
+) -> None:
+    index_dir = tmp_path / "cache"
+    install_fake_distribution(site_dir, "fake_plugin", ["foo"])
+
+    index = CommandIndex.load(index_dir)
+    assert "foo" in index.commands
+    assert "baz" not in index.commands
+
+    install_fake_distribution(site_dir, "another_fake_plugin", ["baz"])
+    # make sure the mtime changes even on filesystems with coarse timestamps
+    mtime = site_dir.stat().st_mtime_ns + 1_000_000_000
+    os.utime(site_dir, ns=(mtime, mtime))
+
+    index = CommandIndex.load(index_dir)
+    assert "foo" in index.commands
+    assert index.commands["baz"].dist_name == "another_fake_plugin"
+
+
+def test_load_ignores_the_script_directory(
+    site_dir: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    index_dir = tmp_path / "cache"
+    install_fake_distribution(site_dir, "fake_plugin", ["foo"])
+    for script_dir in ["first_dir", "second_dir"]:
+        (tmp_path / script_dir).mkdir()
+
+    monkeypatch.setattr(sys, "path", [str(tmp_path / "first_dir"), *sys.path[1:]])
+    index = CommandIndex.load(index_dir)
+
+    def no_scanning(**_: str) -> importlib.metadata.EntryPoints:
+        raise AssertionError("should have used the cached index")
+
+    # E.g. konfusion run from another directory
+    monkeypatch.setattr(sys, "path", [str(tmp_path / "second_dir"), *sys.path[1:]])
+    monkeypatch.setattr(importlib.metadata, "entry_points", no_scanning)
+    assert CommandIndex.load(index_dir) == index
+
+
+def test_load_ignores_broken_index(site_dir: Path, tmp_path: Path) -> None:
+    index_dir = tmp_path / "cache"
+    install_fake_distribution(site_dir, "fake_plugin", ["foo"])
+
+    index = CommandIndex.load(index_dir)
+    for index_file in index_dir.iterdir():
+        index_file.write_text("{not json")
+
+    assert CommandIndex.load(index_dir) == index
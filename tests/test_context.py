@@ -0,0 +1,46 @@
+from __future__ import annotations
+
+import contextlib
+from typing import TYPE_CHECKING
+
+import pytest
+
+from konfusion import context
+
+if TYPE_CHECKING:
+    from collections.abc import Generator
+
+
+def test_new_context() -> None:
+    with pytest.raises(RuntimeError):
+        context.current()
+    assert context.current_or_none() is None
+
+    with context.new() as ctx:
+        assert context.current() is ctx
+        assert context.current_or_none() is ctx
+        executor = ctx.executor()
+        assert ctx.executor() is executor
+
+    with pytest.raises(RuntimeError):
+        context.current()
+    assert context.current_or_none() is None
+    with pytest.raises(RuntimeError, match="after shutdown"):
+        executor.submit(print)
+
+
+def test_closes_resources_in_reverse_order() -> None:
+    events: list[str] = []
+
+    @contextlib.contextmanager
+    def resource(name: str) -> Generator[str]:
+        events.append(f"open {name}")
+        yield name
+        events.append(f"close {name}")
+
+    with context.new() as ctx:
+        ctx.managed_resource("a", lambda: resource("a"))
+        ctx.managed_resource("b", lambda: resource("b"))
+        ctx.managed_resource("a", lambda: resource("a"))
+
+    assert events == ["open a", "open b", "close b", "close a"]
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import os
+import re
+import subprocess
+import sys
+from typing import TYPE_CHECKING
+
+import pytest
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+pytest.importorskip("konfusion_build_commands")
+
+# Total import time budget for selected invocations, measured with -X importtime.
+# Set with plenty of headroom, the point is to catch regressions like unintentionally
+# importing all the plugins or a heavy dependency.
+IMPORT_TIME_BUDGETS_MS: dict[tuple[str, ...], int] = {
+    ("--version",): 150,
+    ("apply-tags", "--help"): 250,
+}
+
+# Modules that must not be imported during the selected invocations
+FORBIDDEN_IMPORTS: dict[tuple[str, ...], list[str]] = {
+    ("--version",): [
+        "importlib.metadata",
+        "konfusion_build_commands.apply_tags",
+        "stamina",
+    ],
+    ("apply-tags", "--help"): [
+        "asyncio",
+        "importlib.metadata",
+        "konfusion_build_commands.push_containerfile",
+    ],
+}
+
+_IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def run_konfusion_with_importtime(args: tuple[str, ...], tmp_path: Path) -> str:
+    cwd = tmp_path / "cwd"
+    cwd.mkdir(exist_ok=True)
+    env = os.environ | {"KONFUSION_CACHE_DIR": str(tmp_path / "cache")}
+    proc = subprocess.run(  # noqa: S603
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            "from konfusion.main import main; main()",
+            *args,
+        ],
+        cwd=cwd,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return proc.stderr
+
+
+@pytest.mark.parametrize("args", list(IMPORT_TIME_BUDGETS_MS))
+def test_import_time_budget(args: tuple[str, ...], tmp_path: Path) -> None:
+    # The first run builds the command index, we care about the subsequent runs
+    run_konfusion_with_importtime(args, tmp_path)
+    importtime_output = run_konfusion_with_importtime(args, tmp_path)
+
+    total_us = 0
+    imported_modules: set[str] = set()
+
+    for line in importtime_output.splitlines():
+        if match := _IMPORTTIME_RE.match(line):
+            _, cumulative_us, indent, module = match.groups()
+            imported_modules.add(module)
+            # Top-level imports include the time spent on their nested imports
+            if not indent:
+                total_us += int(cumulative_us)
+
+    assert imported_modules.isdisjoint(FORBIDDEN_IMPORTS[args])
+
+    total_ms = total_us / 1000
+    budget_ms = IMPORT_TIME_BUDGETS_MS[args]
+    assert total_ms <= budget_ms, (
+        f"'konfusion {' '.join(args)}' spent {total_ms:.1f}ms importing modules, "
+        f"over the budget of {budget_ms}ms"
+    )
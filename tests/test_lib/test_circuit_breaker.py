@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import time
+
+import pytest
+
+from konfusion.lib.circuit_breaker import CircuitBreaker, CircuitOpenError
+from konfusion.lib.deadline import DeadlineExceededError
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> FakeClock:
+    clock = FakeClock()
+    monkeypatch.setattr(time, "monotonic", clock.monotonic)
+    return clock
+
+
+def test_circuit_opens_and_closes(clock: FakeClock) -> None:
+    breaker = CircuitBreaker(min_calls=4, failure_ratio=0.5, open_for=5.0)
+
+    for ok in [True, True, False]:
+        breaker.record("quay.io", ok=ok)
+    breaker.check("quay.io")
+
+    breaker.record("quay.io", ok=False)
+    with pytest.raises(CircuitOpenError) as exc_info:
+        breaker.check("quay.io")
+    assert exc_info.value.retry_after == 5.0
+    # Other registries are not affected
+    breaker.check("registry.redhat.io")
+
+    # Half-open, one call probes the registry, the others keep waiting
+    clock.now += 5.0
+    breaker.check("quay.io")
+    with pytest.raises(CircuitOpenError):
+        breaker.check("quay.io")
+
+    # The probe failed, open again for longer
+    breaker.record("quay.io", ok=False)
+    with pytest.raises(CircuitOpenError) as exc_info:
+        breaker.check("quay.io")
+    assert exc_info.value.retry_after == 10.0
+
+    # The probe succeeded, closed
+    clock.now += 10.0
+    breaker.check("quay.io")
+    breaker.record("quay.io", ok=True)
+    breaker.check("quay.io")
+    breaker.check("quay.io")
+
+
+def test_old_failures_do_not_count(clock: FakeClock) -> None:
+    breaker = CircuitBreaker(window=60.0, min_calls=2, failure_ratio=0.5)
+
+    breaker.record("quay.io", ok=False)
+    clock.now += 61.0
+    breaker.record("quay.io", ok=False)
+    breaker.check("quay.io")
+
+
+def test_retry_budget(clock: FakeClock) -> None:
+    breaker = CircuitBreaker(retry_budget=2, refill_per_second=0.5)
+
+    assert breaker.try_retry(["quay.io"])
+    assert breaker.try_retry(["quay.io"])
+    assert not breaker.try_retry(["quay.io"])
+    # Takes from all the budgets or none of them
+    assert not breaker.try_retry(["registry.redhat.io", "quay.io"])
+    assert breaker.try_retry(["registry.redhat.io"])
+
+    clock.now += 2.0
+    assert breaker.try_retry(["quay.io"])
+    assert not breaker.try_retry(["quay.io"])
+
+
+def test_guard() -> None:
+    breaker = CircuitBreaker(min_calls=1, failure_ratio=1.0)
+
+    def failed_keys(exc: Exception) -> list[str]:
+        return [str(exc)]
+
+    with pytest.raises(ValueError), breaker.guard(["a", "b"], failed_keys):
+        raise ValueError("a")
+
+    with pytest.raises(CircuitOpenError):
+        breaker.check("a")
+    breaker.check("b")
+
+    with pytest.raises(CircuitOpenError), breaker.guard(["b", "a"], failed_keys):
+        raise AssertionError("should not be called")
+
+
+def open_circuit(breaker: CircuitBreaker, clock: FakeClock, key: str) -> None:
+    """Open the circuit for the key, then wait until it's half-open."""
+    breaker.record(key, ok=False)
+    with pytest.raises(CircuitOpenError):
+        breaker.check(key)
+    clock.now += breaker.open_for
+
+
+def test_guard_releases_the_probes_when_another_circuit_is_open(
+    clock: FakeClock,
+) -> None:
+    breaker = CircuitBreaker(min_calls=1, failure_ratio=1.0)
+    open_circuit(breaker, clock, "a")
+    breaker.record("b", ok=False)
+
+    with (
+        pytest.raises(CircuitOpenError, match="b has been failing"),
+        breaker.guard(["a", "b"], lambda _: []),
+    ):
+        raise AssertionError("should not be called")
+
+    # The guard didn't call "a", the next call can still probe it
+    breaker.check("a")
+
+
+def test_guard_does_not_record_deadline_exceeded(clock: FakeClock) -> None:
+    breaker = CircuitBreaker(min_calls=1, failure_ratio=1.0)
+    open_circuit(breaker, clock, "a")
+
+    with pytest.raises(DeadlineExceededError), breaker.guard(["a"], lambda _: []):
+        raise DeadlineExceededError("out of time")
+
+    # Neither closed (one failure would open it again) nor opened
+    breaker.check("a")
+    breaker.record("a", ok=False)
+    with pytest.raises(CircuitOpenError):
+        breaker.check("a")
@@ -0,0 +1,40 @@
+from __future__ import annotations
+
+import pytest
+
+from konfusion.lib import deadline
+from konfusion.lib.deadline import DeadlineExceededError
+
+
+def test_no_deadline() -> None:
+    assert deadline.remaining() is None
+    with deadline.within(None):
+        assert deadline.remaining() is None
+        deadline.check("anything")
+
+
+def test_nested_deadlines() -> None:
+    with deadline.within(10):
+        outer = deadline.remaining()
+        assert outer is not None
+        assert 9 < outer <= 10
+
+        with deadline.within(3600):
+            inner = deadline.remaining()
+            assert inner is not None
+            assert inner <= outer
+
+        with deadline.within(1):
+            inner = deadline.remaining()
+            assert inner is not None
+            assert inner <= 1
+
+        with deadline.within(None):
+            assert deadline.remaining() is not None
+
+    assert deadline.remaining() is None
+
+
+def test_check() -> None:
+    with deadline.within(-1), pytest.raises(DeadlineExceededError, match="skopeo"):
+        deadline.check("skopeo")
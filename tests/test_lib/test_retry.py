@@ -1,11 +1,18 @@
 from __future__ import annotations
 
+import asyncio
 import time
+from typing import TYPE_CHECKING
 
 import pytest
 
+from konfusion.lib import deadline, tracing
+from konfusion.lib.deadline import DeadlineExceededError
 from konfusion.lib.retry import retry
 
+if TYPE_CHECKING:
+    from pathlib import Path
+
 
 @pytest.fixture(scope="function", autouse=True)
 def disable_sleep(monkeypatch: pytest.MonkeyPatch) -> None:
@@ -37,3 +44,100 @@ def test_retry_logging(caplog: pytest.LogCaptureFixture) -> None:
         "test_retry.test_retry_logging.<locals>.always_fail: attempt 9 failed, retrying in 120.000000 seconds: ValueError: oh no",
     ]
     assert caplog.messages == expected_messages
+
+
+def test_retry_tracing(tmp_path: Path) -> None:
+    """Test that each attempt of a function decorated with @retry gets a span."""
+    attempts = 0
+
+    @retry(on=ValueError, wait_jitter=0.0)
+    def fail_twice() -> str:
+        nonlocal attempts
+        attempts += 1
+        if attempts < 3:
+            raise ValueError("oh no")
+        return "success"
+
+    with tracing.record_trace(tmp_path / "trace.json") as tracer:
+        assert fail_twice() == "success"
+
+    assert tracer is not None
+    spans = [
+        (span.name, span.attributes.get("attempt") or span.attributes["retry_num"])
+        for span in sorted(tracer.spans, key=lambda span: span.start_ns)
+    ]
+    assert spans == [
+        ("retry.attempt", 1),
+        ("retry.wait", 1),
+        ("retry.attempt", 2),
+        ("retry.wait", 2),
+        ("retry.attempt", 3),
+    ]
+
+
+def test_retry_async_function() -> None:
+    attempts = 0
+
+    @retry(on=ValueError, wait_jitter=0.0, wait_initial=0.0)
+    async def fail_once() -> str:
+        nonlocal attempts
+        attempts += 1
+        if attempts < 2:
+            raise ValueError("oh no")
+        return "success"
+
+    assert asyncio.run(fail_once()) == "success"
+    assert attempts == 2
+
+
+def test_retry_stops_when_the_next_attempt_would_miss_the_deadline(
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    attempts = 0
+
+    @retry(on=ValueError, wait_jitter=0.0, wait_initial=10.0)
+    def always_fail() -> None:
+        nonlocal attempts
+        attempts += 1
+        raise ValueError("oh no")
+
+    with deadline.within(15.0), pytest.raises(ValueError):
+        always_fail()
+
+    # Waits 10s for attempt 2, but attempt 3 would need another 20s
+    assert attempts == 2
+    assert caplog.messages[-1].startswith("Not retrying, ")
+
+
+def test_retry_does_not_start_attempts_after_the_deadline() -> None:
+    @retry(on=OSError)
+    def never_called() -> None:
+        raise AssertionError("should not be called")
+
+    # DeadlineExceededError is a TimeoutError, which is an OSError, but that
+    # doesn't make it retriable
+    with deadline.within(-1.0), pytest.raises(DeadlineExceededError):
+        never_called()
+
+
+def test_retry_immediately(caplog: pytest.LogCaptureFixture) -> None:
+    attempts = 0
+
+    @retry(on=ValueError, attempts=4, wait_jitter=0.0, immediately_on=TimeoutError)
+    def always_fail() -> None:
+        nonlocal attempts
+        attempts += 1
+        raise TimeoutError("stalled") if attempts % 2 else ValueError("oh no")
+
+    with pytest.raises(ValueError):
+        always_fail()
+
+    # The immediate retries count towards the attempts
+    assert attempts == 4
+    immediate_retries = [
+        msg for msg in caplog.messages if "retrying immediately" in msg
+    ]
+    assert immediate_retries == [
+        "test_retry.test_retry_immediately.<locals>.always_fail: attempt 1 failed, retrying immediately: TimeoutError: stalled",
+        "test_retry.test_retry_immediately.<locals>.always_fail: attempt 3 failed, retrying immediately: TimeoutError: stalled",
+    ]
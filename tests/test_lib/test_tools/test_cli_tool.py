@@ -1,13 +1,29 @@
 from __future__ import annotations
 
+import asyncio
 import logging
+import signal
 import subprocess
 import sys
 import textwrap
+import threading
+import time
+import tracemalloc
 from pathlib import Path
 
 import pytest
 
+from konfusion.lib import deadline, tool_usage, tracing
+from konfusion.lib.deadline import DeadlineExceededError
+from konfusion.lib.tools import (
+    Capture,
+    Discard,
+    HeadTail,
+    Scheduler,
+    SpillToDisk,
+    ToolStalledError,
+    set_scheduler,
+)
 from konfusion.lib.tools._cli_tool import CliTool
 
 
@@ -87,3 +103,599 @@ def test_run_with_logging(caplog: pytest.LogCaptureFixture) -> None:
         ("WARNING", f"{python_name} stderr> stderr line #1"),
         ("INFO", f"{python_name} stdout> stdout line #2"),
     ]
+
+
+def test_run_tracing(tmp_path: Path) -> None:
+    python_cli = CliTool(sys.executable)
+
+    with tracing.record_trace(tmp_path / "trace.json") as tracer:
+        python_cli.run(["-c", "import sys; sys.exit(3)"], check=False)
+
+    assert tracer is not None
+    spans = {span.name: span for span in tracer.spans}
+    assert spans.keys() == {"cli_tool.run", "cli_tool.read_output", "cli_tool.wait"}
+
+    run_attrs = spans["cli_tool.run"].attributes
+    assert run_attrs["argv"] == [sys.executable, "-c", "import sys; sys.exit(3)"]
+    assert run_attrs["returncode"] == 3
+    assert isinstance(run_attrs["pid"], int)
+
+
+def test_run_with_logging_collapses_repeated_lines(
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    python_cli = CliTool(sys.executable)
+    script_to_run = textwrap.dedent(
+        """
+        for i in range(100):
+            print(f"Copying blob sha256:{i:064x}")
+        print("Writing manifest to image destination")
+        """
+    )
+
+    caplog.set_level(logging.INFO)
+
+    proc = python_cli.run_with_logging(
+        ["-c", script_to_run], stdout_at_level=logging.INFO
+    )
+    assert len(proc.stdout.splitlines()) == 101
+
+    python_name = Path(sys.executable).name
+    messages = [record.message for record in caplog.records]
+    assert messages[:5] == [
+        f"{python_name} stdout> Copying blob sha256:{i:064x}" for i in range(5)
+    ]
+    assert messages[5] == f"{python_name} stdout> Writing manifest to image destination"
+    assert messages[6].startswith(
+        f"{python_name} stdout> Copying blob sha256:{99:064x} "
+        "(last of 95 similar lines hidden in "
+    )
+    assert len(messages) == 7
+
+
+def test_run_with_logging_collapses_only_above_debug_level(
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    python_cli = CliTool(sys.executable)
+    script_to_run = "for i in range(100): print(f'line {i}')"
+
+    # E.g. in server mode, the logger level is always DEBUG
+    caplog.set_level(logging.DEBUG, logger="konfusion")
+
+    python_cli.run_with_logging(["-c", script_to_run])
+    stdout_messages = [m for m in caplog.messages if "stdout>" in m]
+    assert len(stdout_messages) == 100
+
+    caplog.clear()
+    python_cli.run_with_logging(["-c", script_to_run], stdout_at_level=logging.INFO)
+    stdout_messages = [m for m in caplog.messages if "stdout>" in m]
+    assert len(stdout_messages) == 6
+
+
+def test_stream() -> None:
+    python_cli = CliTool(sys.executable)
+    script_to_run = textwrap.dedent(
+        """
+        import sys
+
+        print("line 1\\nline 2", flush=True)
+        print("some warning", file=sys.stderr, flush=True)
+        print("line 3", end="")
+        """
+    )
+
+    lines = python_cli.stream(["-c", script_to_run])
+    assert next(lines) == "line 1\n"
+    assert list(lines) == ["line 2\n", "line 3"]
+
+
+def test_stream_a_failing_process() -> None:
+    python_cli = CliTool(sys.executable)
+    script_to_run = "import sys; print('partial output'); sys.exit('goodbye world')"
+
+    lines: list[str] = []
+    with pytest.raises(subprocess.CalledProcessError) as exc_info:
+        lines.extend(python_cli.stream(["-c", script_to_run]))
+
+    assert lines == ["partial output\n"]
+    assert exc_info.value.returncode == 1
+    assert exc_info.value.stdout is None
+    assert exc_info.value.stderr == "goodbye world\n"
+
+
+def test_stream_kills_the_process_when_stopped_early(tmp_path: Path) -> None:
+    python_cli = CliTool(sys.executable)
+    script_to_run = "while True: print('y' * 100)"
+
+    with tracing.record_trace(tmp_path / "trace.json") as tracer:
+        lines = python_cli.stream(["-c", script_to_run])
+        assert next(lines) == "y" * 100 + "\n"
+        lines.close()
+
+    assert tracer is not None
+    [span] = [span for span in tracer.spans if span.name == "cli_tool.stream"]
+    assert span.attributes["returncode"] == -signal.SIGKILL
+
+
+PRINT_MANY_LINES = "for i in range(50_000): print(f'{i:099}')"
+
+
+@pytest.mark.parametrize(
+    ("capture", "expect_stdout_lines"),
+    [
+        (Discard(), 0),
+        (HeadTail(head_lines=10, tail_lines=10), 21),
+        (SpillToDisk(threshold=1024), 50_000),
+    ],
+)
+def test_run_with_bounded_capture(capture: Capture, expect_stdout_lines: int) -> None:
+    python_cli = CliTool(sys.executable)
+
+    tracemalloc.start()
+    try:
+        proc = python_cli.run(["-c", PRINT_MANY_LINES], stdout_capture=capture)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    # The output is 5MB, the memory usage shouldn't come anywhere close
+    assert peak_memory < 1024 * 1024
+    with proc:
+        assert len(proc.stdout.splitlines()) == expect_stdout_lines
+
+
+def test_spill_to_disk_gets_closed() -> None:
+    python_cli = CliTool(sys.executable)
+    script_to_run = "import sys; print('x' * 100); sys.exit(3)"
+
+    stdout_capture = SpillToDisk(threshold=10)
+    with python_cli.run(
+        ["-c", script_to_run], check=False, stdout_capture=stdout_capture
+    ) as proc:
+        assert stdout_capture.spilled
+        assert proc.stdout == "x" * 100 + "\n"
+    with pytest.raises(ValueError, match="closed file"):
+        stdout_capture.output()
+
+    stdout_capture = SpillToDisk(threshold=10)
+    with pytest.raises(subprocess.CalledProcessError) as exc_info:
+        python_cli.run(["-c", script_to_run], stdout_capture=stdout_capture)
+    assert exc_info.value.stdout == "x" * 100 + "\n"
+    with pytest.raises(ValueError, match="closed file"):
+        stdout_capture.output()
+
+
+def test_spill_to_disk_error_gets_only_the_end_of_the_output() -> None:
+    python_cli = CliTool(sys.executable)
+    script_to_run = f"{PRINT_MANY_LINES}\nraise SystemExit(3)"
+
+    with pytest.raises(subprocess.CalledProcessError) as exc_info:
+        python_cli.run(
+            ["-c", script_to_run], stdout_capture=SpillToDisk(threshold=1024)
+        )
+
+    lines = exc_info.value.stdout.splitlines()
+    assert lines[0] == "[... 49900 lines omitted ...]"
+    assert lines[1:] == [f"{i:099}" for i in range(49_900, 50_000)]
+
+
+WRITE_BINARY_OUTPUT = (
+    "import sys; sys.stdout.buffer.write(bytes(range(256)) * 1000); sys.exit(3)"
+)
+
+
+def test_run_bytes() -> None:
+    python_cli = CliTool(sys.executable)
+
+    proc = python_cli.run_bytes(["-c", WRITE_BINARY_OUTPUT], check=False)
+    assert proc.returncode == 3
+    assert proc.stdout == bytes(range(256)) * 1000
+    assert proc.stderr == b""
+
+    with pytest.raises(subprocess.CalledProcessError):
+        python_cli.run_bytes(["-c", WRITE_BINARY_OUTPUT])
+
+
+def test_run_bytes_to_callback_and_file(tmp_path: Path) -> None:
+    python_cli = CliTool(sys.executable)
+    chunks: list[bytes] = []
+    output_file = tmp_path / "output.bin"
+
+    with output_file.open("wb") as f:
+        proc = python_cli.run_bytes(
+            ["-c", WRITE_BINARY_OUTPUT],
+            check=False,
+            stdout_callback=lambda chunk: chunks.append(bytes(chunk)),
+            stdout_to=f,
+        )
+
+    assert proc.stdout == b""
+    assert b"".join(chunks) == bytes(range(256)) * 1000
+    assert output_file.read_bytes() == bytes(range(256)) * 1000
+
+
+def test_arun() -> None:
+    python_cli = CliTool(sys.executable)
+    script_to_run = textwrap.dedent(
+        r"""
+        import sys
+
+        print("hello\nthere", end="")
+        print("general\nkenobi", end="", file=sys.stderr)
+        sys.exit(3)
+        """
+    )
+
+    async def run_concurrently() -> list[subprocess.CompletedProcess[str]]:
+        return await asyncio.gather(
+            *(python_cli.arun(["-c", script_to_run], check=False) for _ in range(10))
+        )
+
+    for proc in asyncio.run(run_concurrently()):
+        assert proc.returncode == 3
+        assert proc.stdout == "hello\nthere"
+        assert proc.stderr == "general\nkenobi"
+
+    with pytest.raises(subprocess.CalledProcessError):
+        asyncio.run(python_cli.arun(["-c", script_to_run]))
+
+
+def test_arun_with_logging(caplog: pytest.LogCaptureFixture) -> None:
+    python_cli = CliTool(sys.executable)
+    script_to_run = "for i in range(100): print(f'line {i}')"
+
+    caplog.set_level(logging.INFO)
+
+    proc = asyncio.run(
+        python_cli.arun_with_logging(
+            ["-c", script_to_run], stdout_at_level=logging.INFO
+        )
+    )
+    assert len(proc.stdout.splitlines()) == 100
+
+    python_name = Path(sys.executable).name
+    assert caplog.messages[:5] == [f"{python_name} stdout> line {i}" for i in range(5)]
+    assert caplog.messages[5].startswith(
+        f"{python_name} stdout> line 99 (last of 95 similar lines hidden in "
+    )
+    assert len(caplog.messages) == 6
+
+
+def test_arun_with_logging_does_not_start_threads() -> None:
+    python_cli = CliTool(sys.executable)
+
+    async def run_concurrently() -> int:
+        runs = [
+            asyncio.create_task(
+                python_cli.arun_with_logging(
+                    ["-c", "import time; time.sleep(0.5)"],
+                    stdout_at_level=logging.INFO,
+                )
+            )
+            for _ in range(20)
+        ]
+        await asyncio.sleep(0.2)
+        threads_while_running = threading.active_count()
+        await asyncio.gather(*runs)
+        return threads_while_running
+
+    threads_before = threading.active_count()
+    set_scheduler(Scheduler(max_running=20))
+    try:
+        threads_while_running = asyncio.run(run_concurrently())
+    finally:
+        set_scheduler(None)
+    # At most the one thread that flushes the summaries for all the runs
+    assert threads_while_running <= threads_before + 1
+
+
+def test_arun_cancellation_kills_the_process(tmp_path: Path) -> None:
+    python_cli = CliTool(sys.executable)
+    script_to_run = "import time; print('started', flush=True); time.sleep(3600)"
+
+    async def cancel_when_started() -> None:
+        started = asyncio.Event()
+
+        def on_line(_: str) -> None:
+            started.set()
+
+        task = asyncio.create_task(
+            python_cli.arun(["-c", script_to_run], stdout_callback=on_line)
+        )
+        await started.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    with tracing.record_trace(tmp_path / "trace.json") as tracer:
+        asyncio.run(cancel_when_started())
+
+    assert tracer is not None
+    [arun_span] = [span for span in tracer.spans if span.name == "cli_tool.arun"]
+    assert arun_span.attributes["returncode"] == -signal.SIGKILL
+
+
+def test_resource_usage(caplog: pytest.LogCaptureFixture) -> None:
+    python_cli = CliTool(sys.executable)
+    python_name = Path(sys.executable).name
+    script_to_run = textwrap.dedent(
+        """
+        import time
+
+        start = time.process_time()
+        data = bytearray(64 * 1024 * 1024)
+        while time.process_time() - start < 0.2:
+            pass
+        """
+    )
+
+    caplog.set_level(logging.DEBUG, logger="konfusion")
+    with tool_usage.tracking():
+        proc = python_cli.run(["-c", script_to_run])
+
+        usage = proc.resource_usage
+        assert usage is not None
+        assert usage.user_time + usage.system_time >= 0.2
+        assert usage.wall_time >= usage.user_time
+        assert usage.max_rss >= 64 * 1024 * 1024
+        assert f"{python_name} exited with 0: {usage}" in caplog.messages
+
+        bytes_proc = python_cli.run_bytes(["-c", "pass"])
+        assert bytes_proc.resource_usage is not None
+
+        async_proc = asyncio.run(python_cli.arun(["-c", script_to_run]))
+        assert async_proc.resource_usage is not None
+        assert async_proc.resource_usage.max_rss >= 64 * 1024 * 1024
+
+        totals = tool_usage.usage_totals()[python_name]
+        assert totals.processes == 3
+        assert totals.max_rss >= 64 * 1024 * 1024
+
+    # Each scope starts from zero
+    with tool_usage.tracking():
+        assert tool_usage.usage_totals() == {}
+
+
+def test_run_pipeline(caplog: pytest.LogCaptureFixture) -> None:
+    python_cli = CliTool(sys.executable)
+    python_name = Path(sys.executable).name
+    generate = textwrap.dedent(
+        """
+        import sys
+
+        for i in range(10_000):
+            print(f"line {i}")
+        print("generated", file=sys.stderr)
+        """
+    )
+    uppercase = textwrap.dedent(
+        """
+        import sys
+
+        for line in sys.stdin:
+            sys.stdout.write(line.upper())
+        print("uppercased", file=sys.stderr)
+        """
+    )
+    count = "import sys; print(sum(1 for _ in sys.stdin if _.startswith('LINE')))"
+
+    caplog.set_level(logging.INFO)
+
+    stages = CliTool.run_pipeline(
+        [
+            (python_cli, ["-c", generate]),
+            (python_cli, ["-c", uppercase]),
+            (python_cli, ["-c", count]),
+        ],
+        stdout_at_level=logging.INFO,
+        stderr_at_level=logging.WARNING,
+    )
+
+    assert [stage.returncode for stage in stages] == [0, 0, 0]
+    assert [stage.stdout for stage in stages] == ["", "", "10000\n"]
+    assert [stage.stderr for stage in stages] == ["generated\n", "uppercased\n", ""]
+    assert all(stage.resource_usage for stage in stages)
+    assert sorted(caplog.messages) == [
+        f"{python_name} stderr> generated",
+        f"{python_name} stderr> uppercased",
+        f"{python_name} stdout> 10000",
+    ]
+
+
+def test_run_pipeline_failure() -> None:
+    python_cli = CliTool(sys.executable)
+    stages = [
+        (python_cli, ["-c", "import sys; sys.exit('first')"]),
+        (python_cli, ["-c", "import sys; sys.stdin.read(); sys.exit('second')"]),
+        (python_cli, ["-c", "import sys; sys.stdin.read()"]),
+    ]
+
+    results = CliTool.run_pipeline(stages, check=False)
+    assert [result.returncode for result in results] == [1, 1, 0]
+
+    # Like 'set -o pipefail', the last stage that failed determines the error
+    with pytest.raises(subprocess.CalledProcessError) as exc_info:
+        CliTool.run_pipeline(stages)
+
+    assert exc_info.value.cmd == [sys.executable, *stages[1][1]]
+    assert exc_info.value.stderr == "second\n"
+
+
+def test_run_pipeline_reader_exits_early() -> None:
+    python_cli = CliTool(sys.executable)
+    write_forever = "while True: print('y' * 1000)"
+    read_one_line = "import sys; print(sys.stdin.readline(), end='')"
+
+    writer, reader = CliTool.run_pipeline(
+        [(python_cli, ["-c", write_forever]), (python_cli, ["-c", read_one_line])],
+        check=False,
+    )
+
+    # The writer doesn't hang, it fails to write to the closed pipe
+    assert writer.returncode != 0
+    assert reader.returncode == 0
+    assert reader.stdout == "y" * 1000 + "\n"
+
+
+# Starts a grandchild that writes its pid to a file, then hangs
+HANG_WITH_A_GRANDCHILD = textwrap.dedent(
+    """
+    import subprocess
+    import sys
+    import time
+
+    grandchild = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+    with open(sys.argv[1], "w") as f:
+        f.write(str(grandchild.pid))
+    time.sleep(60)
+    """
+)
+
+
+def assert_killed(pid_file: Path) -> None:
+    grandchild_pid = int(pid_file.read_text())
+    stat_file = Path(f"/proc/{grandchild_pid}/stat")
+    # The grandchild is not our child, we cannot wait for it, poll instead. It may
+    # stay a zombie if nothing reaps orphans (e.g. in a container).
+    for _ in range(100):
+        try:
+            state = stat_file.read_text().rpartition(")")[2].split()[0]
+        except FileNotFoundError:
+            return
+        if state == "Z":
+            return
+        time.sleep(0.01)
+    raise AssertionError(f"Process {grandchild_pid} is still running")
+
+
+def test_run_kills_the_process_group_at_the_deadline(tmp_path: Path) -> None:
+    python_cli = CliTool(sys.executable)
+    pid_file = tmp_path / "grandchild.pid"
+
+    start = time.monotonic()
+    with deadline.within(1.0), pytest.raises(DeadlineExceededError):
+        python_cli.run(["-c", HANG_WITH_A_GRANDCHILD, pid_file])
+
+    assert time.monotonic() - start < 5
+    assert_killed(pid_file)
+
+    with deadline.within(-1.0), pytest.raises(DeadlineExceededError):
+        python_cli.run(["-c", "raise AssertionError('should not start')"])
+
+
+def test_run_with_a_deadline_does_not_start_threads() -> None:
+    python_cli = CliTool(sys.executable)
+    threads_while_running: list[int] = []
+
+    threads_before = threading.active_count()
+    with deadline.within(60.0):
+        python_cli.run(
+            ["-c", "print('hi')"],
+            stdout_callback=lambda _: threads_while_running.append(
+                threading.active_count()
+            ),
+        )
+
+    assert threads_while_running == [threads_before]
+
+
+def test_run_kills_the_process_at_the_deadline_after_closing_its_pipes() -> None:
+    python_cli = CliTool(sys.executable)
+    script_to_run = "import os, time; os.close(1); os.close(2); time.sleep(3600)"
+
+    start = time.monotonic()
+    with deadline.within(0.5), pytest.raises(DeadlineExceededError):
+        python_cli.run(["-c", script_to_run])
+
+    assert time.monotonic() - start < 5
+
+
+def test_arun_kills_the_process_group_at_the_deadline(tmp_path: Path) -> None:
+    python_cli = CliTool(sys.executable)
+    pid_file = tmp_path / "grandchild.pid"
+
+    async def run_with_deadline() -> None:
+        with deadline.within(1.0):
+            await python_cli.arun(["-c", HANG_WITH_A_GRANDCHILD, pid_file])
+
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceededError):
+        asyncio.run(run_with_deadline())
+
+    assert time.monotonic() - start < 5
+    assert_killed(pid_file)
+
+
+STALL_AFTER_OUTPUT = textwrap.dedent(
+    """
+    import sys, time
+
+    for _ in range(5):
+        print("progress", flush=True)
+        time.sleep(0.1)
+    print("stalling", file=sys.stderr, flush=True)
+    time.sleep(60)
+    """
+)
+
+
+def test_run_kills_a_stalled_process() -> None:
+    python_cli = CliTool(sys.executable)
+
+    start = time.monotonic()
+    with pytest.raises(ToolStalledError) as exc_info:
+        python_cli.run(["-c", STALL_AFTER_OUTPUT], stall_timeout=0.3)
+
+    # Regular output keeps the process alive for longer than the stall_timeout
+    assert 0.7 < time.monotonic() - start < 5
+    assert exc_info.value.stdout == "progress\n" * 5
+    assert exc_info.value.stderr == "stalling\n"
+    assert str(exc_info.value).endswith("produced no output for 0.3 seconds")
+
+
+def test_arun_kills_a_stalled_process() -> None:
+    python_cli = CliTool(sys.executable)
+
+    start = time.monotonic()
+    with pytest.raises(ToolStalledError) as exc_info:
+        asyncio.run(python_cli.arun(["-c", STALL_AFTER_OUTPUT], stall_timeout=0.3))
+
+    assert 0.7 < time.monotonic() - start < 5
+    assert exc_info.value.stdout == "progress\n" * 5
+    assert exc_info.value.stderr == "stalling\n"
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_stalled_after_the_process_exited(use_async: bool) -> None:
+    # The process exits right away, but its child keeps the pipes open
+    sh = CliTool("sh")
+    args = ["-c", "sleep 2 & echo hi"]
+
+    with pytest.raises(ToolStalledError) as exc_info:
+        if use_async:
+            asyncio.run(sh.arun(args, stall_timeout=0.3))
+        else:
+            sh.run(args, stall_timeout=0.3)
+
+    assert exc_info.value.stdout == "hi\n"
+
+
+@pytest.mark.parametrize("deadline_seconds", [None, 60.0])
+def test_run_kills_the_process_when_a_callback_fails(
+    deadline_seconds: float | None,
+) -> None:
+    python_cli = CliTool(sys.executable)
+    pids: list[int] = []
+
+    def fail_on_pid(line: str) -> None:
+        pids.append(int(line))
+        raise ValueError("callback failed")
+
+    script = "import os, time; print(os.getpid(), flush=True); time.sleep(60)"
+    start = time.monotonic()
+    with deadline.within(deadline_seconds), pytest.raises(ValueError):
+        python_cli.run(["-c", script], stdout_callback=fail_on_pid)
+
+    assert time.monotonic() - start < 5
+    # Killed and reaped
+    assert not Path(f"/proc/{pids[0]}").exists()
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import os
+
+import pytest
+
+from konfusion.lib.tools._pipes import (
+    ChunkPipe,
+    LineDecoder,
+    LinePipe,
+    PipesIdleError,
+    PipesTimeoutError,
+    drain,
+)
+
+
+def read_lines(*chunks: bytes) -> list[str]:
+    """Write the chunks to a pipe one by one, return the lines read by LinePipe."""
+    read_fd, write_fd = os.pipe()
+    lines: list[str] = []
+    pipe = LinePipe(os.fdopen(read_fd, "rb"), lines.append)
+
+    with os.fdopen(write_fd, "wb") as write_end:
+        for chunk in chunks:
+            write_end.write(chunk)
+            write_end.flush()
+            assert pipe.read()
+
+    drain([pipe])
+    return lines
+
+
+@pytest.mark.parametrize(
+    ("chunks", "expect_lines"),
+    [
+        ([b"one\ntwo\n"], ["one\n", "two\n"]),
+        ([b"no newline at the end"], ["no newline at the end"]),
+        ([b"split ", b"line\nand ", b"another"], ["split line\n", "and another"]),
+        ([b"windows\r\nold mac\rline\r", b"\n"], ["windows\n", "old mac\n", "line\n"]),
+        (["čau\n".encode()[:2], "čau\n".encode()[2:]], ["čau\n"]),
+        ([b"\n\n"], ["\n", "\n"]),
+    ],
+)
+def test_line_pipe(chunks: list[bytes], expect_lines: list[str]) -> None:
+    assert read_lines(*chunks) == expect_lines
+
+
+def test_line_decoder_splits_long_lines() -> None:
+    lines: list[str] = []
+    decoder = LineDecoder(lines.append, max_line_length=10)
+
+    # No newline in sight, the partial line must not grow without bounds
+    for _ in range(100):
+        decoder.feed(b"x" * 7)
+        assert all(len(line) <= 10 for line in lines)
+    decoder.feed(b"\n" + b"y" * 25 + b"\nz", final=True)
+
+    assert "".join(lines) == "x" * 700 + "\n" + "y" * 25 + "\nz"
+    assert all(len(line.rstrip("\n")) <= 10 for line in lines)
+    assert lines[-4:] == ["y" * 10, "y" * 10, "y" * 5 + "\n", "z"]
+
+
+def test_chunk_pipe_reuses_the_buffer() -> None:
+    read_fd, write_fd = os.pipe()
+    views: list[memoryview] = []
+    chunks: list[bytes] = []
+
+    def on_chunk(chunk: memoryview) -> None:
+        views.append(chunk)
+        chunks.append(bytes(chunk))
+
+    pipe = ChunkPipe(os.fdopen(read_fd, "rb"), on_chunk)
+    with os.fdopen(write_fd, "wb") as write_end:
+        for chunk in [b"first", b"second"]:
+            write_end.write(chunk)
+            write_end.flush()
+            assert pipe.read()
+
+    drain([pipe])
+    assert chunks == [b"first", b"second"]
+    # Both views point to the same buffer, the second read overwrote the first
+    assert views[0].obj is views[1].obj
+    assert bytes(views[0]) == b"secon"
+
+
+@pytest.mark.parametrize(
+    ("idle_timeout", "timeout", "expect_error"),
+    [
+        (0.1, 10.0, PipesIdleError),
+        (10.0, 0.1, PipesTimeoutError),
+        (None, 0.1, PipesTimeoutError),
+    ],
+)
+def test_drain_times_out(
+    idle_timeout: float | None,
+    timeout: float | None,
+    expect_error: type[TimeoutError],
+) -> None:
+    read_fd, write_fd = os.pipe()
+    pipe = LinePipe(os.fdopen(read_fd, "rb"), lambda _: None)
+
+    with os.fdopen(write_fd, "wb"), pytest.raises(expect_error):
+        drain([pipe], idle_timeout=idle_timeout, timeout=timeout)
+    assert pipe.pipe.closed
@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import os
+import textwrap
+import threading
+import time
+from typing import TYPE_CHECKING, ClassVar
+
+import pytest
+
+from konfusion.lib.tools import CliTool, ToolRegistry, set_tool_registry
+
+if TYPE_CHECKING:
+    from collections.abc import Generator, Sequence
+    from pathlib import Path
+
+FAKE_TOOL = textwrap.dedent(
+    """\
+    #!/bin/sh
+    echo "$@" >> "$(dirname "$0")/calls.log"
+    case "$*" in
+        --version) echo "faketool version 1.2.3" ;;
+        "copy --help") printf 'Usage:\\n  --multi-arch string\\n  --dest-compress\\n' ;;
+        *) exit 1 ;;
+    esac
+    """
+)
+
+
+class FakeTool(CliTool):
+    probe_help_for: ClassVar[Sequence[str]] = ("copy",)
+
+
+@pytest.fixture
+def fake_tool(tmp_path: Path) -> Path:
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    tool_path = bin_dir / "faketool"
+    tool_path.write_text(FAKE_TOOL)
+    tool_path.chmod(0o755)
+    return tool_path
+
+
+@pytest.fixture
+def registry(tmp_path: Path) -> Generator[ToolRegistry]:
+    registry = ToolRegistry(tmp_path / "cache" / "tool-info.json")
+    set_tool_registry(registry)
+    try:
+        yield registry
+    finally:
+        set_tool_registry(None)
+
+
+def probe_calls(tool_path: Path) -> list[str]:
+    calls_log = tool_path.parent / "calls.log"
+    if not calls_log.exists():
+        return []
+    return calls_log.read_text().splitlines()
+
+
+@pytest.mark.usefixtures("registry")
+def test_probe_once_per_binary(tmp_path: Path, fake_tool: Path) -> None:
+    tool = FakeTool(fake_tool)
+    assert tool.info.version == "faketool version 1.2.3"
+    assert tool.supports("--multi-arch", subcommand="copy")
+    assert not tool.supports("--image-parallel-copies", subcommand="copy")
+    with pytest.raises(ValueError, match="was not probed"):
+        tool.supports("--help")
+    assert probe_calls(fake_tool) == ["--version", "copy --help"]
+
+    # A new process (registry) reads the results from the disk cache
+    new_registry = ToolRegistry(tmp_path / "cache" / "tool-info.json")
+    assert new_registry.info(FakeTool(fake_tool)) == tool.info
+    assert len(probe_calls(fake_tool)) == 2
+
+    # Probes only the new subcommands
+    class OtherFakeTool(CliTool):
+        probe_help_for: ClassVar[Sequence[str]] = ("copy", "sync")
+
+    assert new_registry.info(OtherFakeTool(fake_tool)).flags["sync"] == frozenset()
+    assert probe_calls(fake_tool)[2:] == ["sync --help"]
+
+    # Upgrading the tool invalidates the cache
+    stat = fake_tool.stat()
+    os.utime(fake_tool, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    new_registry.info(FakeTool(fake_tool))
+    assert probe_calls(fake_tool)[3:] == ["--version", "copy --help"]
+
+
+@pytest.mark.usefixtures("registry")
+def test_corrupted_cache(fake_tool: Path) -> None:
+    cache_path = fake_tool.parent.parent / "cache" / "tool-info.json"
+    cache_path.parent.mkdir()
+    cache_path.write_text("{not json")
+
+    assert FakeTool(fake_tool).info.version == "faketool version 1.2.3"
+    assert "faketool version 1.2.3" in cache_path.read_text()
+
+
+def test_find_by_name(
+    monkeypatch: pytest.MonkeyPatch, fake_tool: Path, registry: ToolRegistry
+) -> None:
+    monkeypatch.setenv("PATH", str(fake_tool.parent))
+    assert FakeTool.find_by_name("faketool").executable_path == str(fake_tool)
+
+    # Resolved only once (for the same PATH)
+    fake_tool.unlink()
+    assert FakeTool.find_by_name("faketool").executable_path == str(fake_tool)
+    assert registry.which("faketool") == str(fake_tool)
+
+    monkeypatch.setenv("PATH", f"{fake_tool.parent}:{os.defpath}")
+    with pytest.raises(ValueError, match="not found in PATH"):
+        FakeTool.find_by_name("faketool")
+
+
+def test_probe_does_not_block_the_registry(
+    fake_tool: Path, registry: ToolRegistry
+) -> None:
+    fake_tool.write_text(FAKE_TOOL.replace("--version)", "--version) sleep 1;"))
+    probing = threading.Thread(target=lambda: FakeTool(fake_tool).info)
+    probing.start()
+    while not probe_calls(fake_tool):
+        time.sleep(0.01)
+
+    started_at = time.monotonic()
+    registry.which("faketool")
+    assert time.monotonic() - started_at < 0.5
+    probing.join()
@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import contextvars
+import time
+from typing import TYPE_CHECKING
+
+from konfusion.lib.tools import _repeated_lines
+from konfusion.lib.tools._repeated_lines import (
+    RepeatedLinesCollapser,
+    flushing_periodically,
+)
+
+if TYPE_CHECKING:
+    import pytest
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+def test_summaries_after_each_interval() -> None:
+    clock = FakeClock()
+    output: list[str] = []
+    collapser = RepeatedLinesCollapser(
+        output.append, max_lines=1, interval=10.0, clock=clock.monotonic
+    )
+
+    for i in range(3):
+        collapser(f"Copying blob {i}")
+    assert output == ["Copying blob 0"]
+
+    # Not yet
+    clock.now += 5.0
+    collapser.flush_expired()
+    assert output == ["Copying blob 0"]
+
+    # Shown even if no more lines of the same pattern come
+    clock.now += 5.0
+    collapser("Writing manifest")
+    assert output[1:] == [
+        "Copying blob 2 (last of 2 similar lines hidden in 10.0s)",
+        "Writing manifest",
+    ]
+
+    # Or no lines at all
+    collapser("Writing manifest")
+    clock.now += 10.0
+    collapser.flush_expired()
+    assert output[3:] == ["Writing manifest (last of 1 similar lines hidden in 10.0s)"]
+
+    collapser.flush()
+    assert len(output) == 4
+
+
+def test_expired_patterns_are_forgotten() -> None:
+    clock = FakeClock()
+    collapser = RepeatedLinesCollapser(
+        lambda _: None, interval=10.0, clock=clock.monotonic
+    )
+
+    for word in ["foo", "bar", "baz"]:
+        collapser(word)
+        clock.now += 4.0
+
+    collapser("qux")
+    assert list(collapser._windows) == ["bar", "baz", "qux"]  # pyright: ignore[reportPrivateUsage]
+
+    clock.now += 10.0
+    collapser.flush_expired()
+    assert not collapser._windows  # pyright: ignore[reportPrivateUsage]
+
+
+def test_flushing_periodically(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(_repeated_lines, "_FLUSH_EVERY", 0.01)
+    request = contextvars.ContextVar("request", default="none")
+    output: list[str] = []
+    collapser = RepeatedLinesCollapser(
+        lambda line: output.append(f"{request.get()}: {line}"),
+        max_lines=1,
+        interval=0.1,
+    )
+
+    request.set("foo")
+    with flushing_periodically([collapser]):
+        collapser("line 1")
+        collapser("line 2")
+        deadline = time.monotonic() + 5
+        while len(output) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    assert output[0] == "foo: line 1"
+    assert output[1].startswith("foo: line 2 (last of 1 similar lines hidden in ")
@@ -0,0 +1,250 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import pytest
+
+from konfusion.lib import deadline
+from konfusion.lib.deadline import DeadlineExceededError
+from konfusion.lib.tools import (
+    CliTool,
+    Scheduler,
+    _scheduler,
+    get_scheduler,
+    scheduling_priority,
+    set_scheduler,
+)
+
+if TYPE_CHECKING:
+    from collections.abc import Generator
+
+
+@pytest.fixture
+def scheduler() -> Generator[Scheduler]:
+    scheduler = Scheduler(max_running=2)
+    set_scheduler(scheduler)
+    try:
+        yield scheduler
+    finally:
+        set_scheduler(None)
+
+
+def test_max_running(scheduler: Scheduler) -> None:
+    running: dict[str, int] = {"now": 0, "max": 0}
+    lock = threading.Lock()
+
+    def run_tool(tool: str) -> None:
+        with scheduler.slot(tool):
+            with lock:
+                running["now"] += 1
+                running["max"] = max(running["max"], running["now"])
+            time.sleep(0.01)
+            with lock:
+                running["now"] -= 1
+
+    threads = [
+        threading.Thread(target=run_tool, args=[tool]) for tool in ["a", "b"] * 5
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert running["max"] == 2
+    stats = scheduler.stats()
+    assert stats["a"].started == stats["b"].started == 5
+    assert stats["a"].queued + stats["b"].queued > 0
+    assert max(stats["a"].max_wait, stats["b"].max_wait) > 0
+
+
+def test_priorities_and_tool_limits(scheduler: Scheduler) -> None:
+    started: list[str] = []
+
+    async def run_tool(name: str, tool: str, tool_limit: int | None = None) -> None:
+        async with scheduler.aslot(tool, tool_limit):
+            started.append(name)
+            await asyncio.sleep(0.01)
+
+    async def main() -> None:
+        async with asyncio.TaskGroup() as tg, scheduler.aslot("skopeo", 1):
+            # Both slots are taken (one by the 'async with' above)
+            async with scheduler.aslot("oras"):
+                tg.create_task(run_tool("skopeo 1", "skopeo", 1))
+                tg.create_task(run_tool("oras 1", "oras"))
+                with scheduling_priority(-1):
+                    tg.create_task(run_tool("oras 2 (high priority)", "oras"))
+                await asyncio.sleep(0.01)
+
+            # The oras slot got released. 'skopeo 1' is first in the queue, but
+            # it has to wait for a skopeo slot, so the slot goes to the next waiter
+            await asyncio.sleep(0.01)
+            assert started == ["oras 2 (high priority)"]
+
+    asyncio.run(main())
+    assert started == ["oras 2 (high priority)", "skopeo 1", "oras 1"]
+
+
+def test_cancelled_waiter_leaves_the_queue(scheduler: Scheduler) -> None:
+    async def main() -> None:
+        async with scheduler.aslot("a"), scheduler.aslot("a"):
+            task = asyncio.create_task(scheduler.aslot("a").__aenter__())
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+        async with scheduler.aslot("a"), scheduler.aslot("a"):
+            pass
+
+    asyncio.run(asyncio.wait_for(main(), timeout=5))
+
+
+def test_slots(scheduler: Scheduler) -> None:
+    # More slots than max_running, runs alone
+    with scheduler.slots([("tar", None), ("gzip", None), ("oras", None)]):
+        assert scheduler.stats().keys() == {"tar", "gzip", "oras"}
+
+    acquired = threading.Event()
+
+    def acquire_two() -> None:
+        with scheduler.slots([("tar", None), ("gzip", None)]):
+            acquired.set()
+
+    with scheduler.slot("oras"):
+        thread = threading.Thread(target=acquire_two)
+        thread.start()
+        # Only one slot is free, the thread waits for both
+        assert not acquired.wait(0.05)
+
+    thread.join()
+    assert acquired.is_set()
+    assert scheduler.stats()["tar"].queued == 1
+
+
+def test_cli_tool_uses_the_scheduler() -> None:
+    set_scheduler(Scheduler(max_running=1))
+    try:
+        python_cli = CliTool(sys.executable)
+
+        async def run_concurrently() -> None:
+            await asyncio.gather(
+                python_cli.arun(["-c", "import time; time.sleep(0.1)"]),
+                python_cli.arun(["-c", "import time; time.sleep(0.1)"]),
+            )
+
+        asyncio.run(run_concurrently())
+        python_cli.run(["-c", "pass"])
+
+        stats = get_scheduler().stats()[Path(sys.executable).name]
+        assert stats.started == 3
+        assert stats.queued == 1
+        assert stats.max_wait >= 0.1
+    finally:
+        set_scheduler(None)
+
+
+@pytest.mark.parametrize(
+    ("cgroup_files", "expect_quota"),
+    [
+        ({"/sys/fs/cgroup/cpu.max": "150000 100000\n"}, 1.5),
+        ({"/sys/fs/cgroup/cpu.max": "max 100000\n"}, None),
+        (
+            {
+                "/sys/fs/cgroup/cpu/cpu.cfs_quota_us": "50000\n",
+                "/sys/fs/cgroup/cpu/cpu.cfs_period_us": "100000\n",
+            },
+            0.5,
+        ),
+        (
+            {
+                "/sys/fs/cgroup/cpu/cpu.cfs_quota_us": "-1\n",
+                "/sys/fs/cgroup/cpu/cpu.cfs_period_us": "100000\n",
+            },
+            None,
+        ),
+        ({}, None),
+    ],
+)
+def test_cgroup_cpu_quota(
+    monkeypatch: pytest.MonkeyPatch,
+    cgroup_files: dict[str, str],
+    expect_quota: float | None,
+) -> None:
+    def read_text(path: Path) -> str:
+        if str(path) not in cgroup_files:
+            raise FileNotFoundError(path)
+        return cgroup_files[str(path)]
+
+    monkeypatch.setattr(Path, "read_text", read_text)
+    assert _scheduler._cgroup_cpu_quota() == expect_quota  # pyright: ignore[reportPrivateUsage]
+
+
+def test_default_max_running(monkeypatch: pytest.MonkeyPatch) -> None:
+    def sched_getaffinity(_: int) -> set[int]:
+        return {0, 1, 2, 3}
+
+    monkeypatch.setattr(os, "sched_getaffinity", sched_getaffinity)
+
+    monkeypatch.setattr(_scheduler, "_cgroup_cpu_quota", lambda: None)
+    assert _scheduler.default_max_running() == 8
+
+    monkeypatch.setattr(_scheduler, "_cgroup_cpu_quota", lambda: 1.5)
+    assert _scheduler.default_max_running() == 3
+
+    monkeypatch.setattr(_scheduler, "_cgroup_cpu_quota", lambda: 0.1)
+    assert _scheduler.default_max_running() == 2
+
+
+def test_waiting_honors_the_deadline(scheduler: Scheduler) -> None:
+    async def main() -> None:
+        async with scheduler.aslot("a", 1):
+            with deadline.within(0.05), pytest.raises(DeadlineExceededError):
+                await asyncio.wait_for(scheduler.aslot("a", 1).__aenter__(), 5)
+
+    asyncio.run(main())
+
+    with (
+        scheduler.slot("a", 1),
+        deadline.within(0.05),
+        pytest.raises(DeadlineExceededError),
+        scheduler.slot("a", 1),
+    ):
+        pass
+
+    # The waiters left the queue
+    with scheduler.slots([("a", None), ("b", None)]):
+        pass
+
+
+def test_requests_for_more_slots_do_not_starve() -> None:
+    scheduler = Scheduler(max_running=2, fairness_timeout=0.1)
+    started: list[str] = []
+
+    def run(name: str, tools: list[str]) -> None:
+        with scheduler.slots([(tool, None) for tool in tools]):
+            started.append(name)
+
+    with scheduler.slot("oras"):
+        two = threading.Thread(target=run, args=["tar | gzip", ["tar", "gzip"]])
+        two.start()
+        time.sleep(0.01)
+        # One slot is free, single slot requests can take it
+        run("oras 1", ["oras"])
+
+        # But not after waiting for fairness_timeout, then they could keep
+        # taking it and never leave two slots free at once
+        time.sleep(0.1)
+        one = threading.Thread(target=run, args=["oras 2", ["oras"]])
+        one.start()
+        one.join(0.05)
+        assert started == ["oras 1"]
+
+    two.join()
+    one.join()
+    assert started == ["oras 1", "tar | gzip", "oras 2"]
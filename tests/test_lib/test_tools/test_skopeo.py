@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import dataclasses
+import subprocess
+import textwrap
+import time
+from typing import TYPE_CHECKING
+
+import pytest
+
+from konfusion.lib.circuit_breaker import (
+    CircuitBreaker,
+    CircuitOpenError,
+    set_circuit_breaker,
+)
+from konfusion.lib.imageref import ImageRef
+from konfusion.lib.tools import ToolRegistry, set_tool_registry
+from konfusion.lib.tools.skopeo import (
+    ImageNotFoundError,
+    InvalidReferenceError,
+    RateLimitedError,
+    RegistryUnavailableError,
+    Skopeo,
+    SkopeoError,
+    TLSVerificationError,
+    UnauthorizedError,
+    classify_error,
+)
+
+if TYPE_CHECKING:
+    from collections.abc import Generator
+    from pathlib import Path
+
+IMAGE = ImageRef.parse("quay.io/foo/bar:latest@sha256:deadbeef")
+
+
+@pytest.fixture(autouse=True)
+def breaker() -> Generator[CircuitBreaker]:
+    # Don't let the failures in one test open the circuit in another
+    breaker = CircuitBreaker(min_calls=100)
+    set_circuit_breaker(breaker)
+    try:
+        yield breaker
+    finally:
+        set_circuit_breaker(None)
+
+
+@pytest.mark.parametrize(
+    ("returncode", "stderr", "expect_type", "expect_status"),
+    [
+        (
+            1,
+            "reading manifest latest in quay.io/foo/bar: received unexpected HTTP status: 503 Service Unavailable",
+            RegistryUnavailableError,
+            503,
+        ),
+        (
+            1,
+            'Get "https://quay.io/v2/": read tcp 10.0.0.1:1234->1.2.3.4:443: read: connection reset by peer',
+            RegistryUnavailableError,
+            None,
+        ),
+        (
+            1,
+            'Get "https://quay.io/v2/": net/http: TLS handshake timeout',
+            RegistryUnavailableError,
+            None,
+        ),
+        (
+            1,
+            "reading manifest latest in docker.io/library/bar: toomanyrequests: You have reached your pull rate limit.",
+            RateLimitedError,
+            None,
+        ),
+        (
+            1,
+            "initializing source docker://quay.io/foo/bar:latest: reading manifest latest in quay.io/foo/bar: unauthorized: access to the requested resource is not authorized",
+            UnauthorizedError,
+            None,
+        ),
+        (
+            2,
+            "initializing source docker://quay.io/foo/bar:nope: reading manifest nope in quay.io/foo/bar: manifest unknown",
+            ImageNotFoundError,
+            None,
+        ),
+        (
+            1,
+            'Invalid image name "docker://quay.io/Foo", expected colon-separated transport:reference',
+            InvalidReferenceError,
+            None,
+        ),
+        (
+            1,
+            'Get "https://registry.local/v2/": tls: failed to verify certificate: x509: certificate signed by unknown authority',
+            TLSVerificationError,
+            None,
+        ),
+        (1, "something unexpected", SkopeoError, None),
+    ],
+)
+def test_classify_error(
+    returncode: int,
+    stderr: str,
+    expect_type: type[SkopeoError],
+    expect_status: int | None,
+) -> None:
+    error = subprocess.CalledProcessError(
+        returncode, ["skopeo", "inspect"], "", f"Error: {stderr}\n"
+    )
+    classified = classify_error(error)
+    assert type(classified) is expect_type
+    assert classified.http_status == expect_status
+    assert (classified.returncode, classified.stderr) == (returncode, error.stderr)
+
+
+@pytest.fixture(autouse=True)
+def registry(tmp_path: Path) -> Generator[ToolRegistry]:
+    registry = ToolRegistry(tmp_path / "tool-info.json")
+    set_tool_registry(registry)
+    try:
+        yield registry
+    finally:
+        set_tool_registry(None)
+
+
+def fake_skopeo(tmp_path: Path, stderr: str) -> Skopeo:
+    skopeo_path = tmp_path / "skopeo"
+    skopeo_path.write_text(
+        textwrap.dedent(
+            f"""\
+            #!/bin/sh
+            case "$*" in
+                --version) echo "skopeo version 1.18.0"; exit 0 ;;
+                "inspect --help") echo "  --no-tags"; exit 0 ;;
+            esac
+            echo "$@" >> "{tmp_path}/calls.log"
+            echo '{stderr}' >&2
+            exit 1
+            """
+        )
+    )
+    skopeo_path.chmod(0o755)
+    return Skopeo(skopeo_path)
+
+
+def test_fail_fast_on_permanent_errors(tmp_path: Path) -> None:
+    skopeo = fake_skopeo(tmp_path, "Error: unauthorized: authentication required")
+
+    with pytest.raises(UnauthorizedError):
+        skopeo.inspect_format(IMAGE, "{{.Digest}}")
+
+    assert len((tmp_path / "calls.log").read_text().splitlines()) == 1
+
+
+def test_retry_after_rate_limiting(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    waits: list[float] = []
+    monkeypatch.setattr(time, "sleep", waits.append)
+    skopeo = fake_skopeo(tmp_path, "Error: toomanyrequests: Retry-After: 42")
+
+    with pytest.raises(RateLimitedError) as exc_info:
+        skopeo.copy(IMAGE, IMAGE.replace(repo="quay.io/foo/baz"))
+
+    assert exc_info.value.retry_after == 42.0
+    assert waits == [42.0] * 9
+
+
+def test_circuit_breaker_and_retry_budget(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    now = [1000.0]
+    waits: list[float] = []
+
+    def sleep(seconds: float) -> None:
+        waits.append(seconds)
+        now[0] += seconds
+
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(time, "sleep", sleep)
+    breaker = CircuitBreaker(
+        min_calls=3, open_for=30.0, retry_budget=3, refill_per_second=0.001
+    )
+    set_circuit_breaker(breaker)
+    skopeo = fake_skopeo(
+        tmp_path, "Error: reading manifest in quay.io/foo/bar: connection reset by peer"
+    )
+
+    with pytest.raises(RegistryUnavailableError):
+        skopeo.inspect_format(IMAGE, "{{.Digest}}")
+
+    # The circuit opened after 3 failures, the 4th attempt waited for it to
+    # half-open. The probe failed and the retry budget ran out.
+    assert len((tmp_path / "calls.log").read_text().splitlines()) == 4
+    assert len(waits) == 4
+    assert 20.0 < waits[3] < 30.0
+
+    with pytest.raises(CircuitOpenError):
+        breaker.check("quay.io")
+
+
+def test_no_tags_if_supported(tmp_path: Path) -> None:
+    skopeo = fake_skopeo(tmp_path, "Error: manifest unknown")
+    with pytest.raises(ImageNotFoundError):
+        skopeo.inspect_format(IMAGE, "{{.Digest}}")
+    assert (tmp_path / "calls.log").read_text().startswith("inspect --no-tags ")
+
+    # An old skopeo
+    skopeo.info = dataclasses.replace(skopeo.info, flags={"inspect": frozenset()})
+    with pytest.raises(ImageNotFoundError):
+        skopeo.inspect_format(IMAGE, "{{.Digest}}")
+    assert "--no-tags" not in (tmp_path / "calls.log").read_text().splitlines()[1]
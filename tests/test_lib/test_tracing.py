@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+import json
+import threading
+from typing import TYPE_CHECKING
+
+import pytest
+
+from konfusion.lib import tracing
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+def test_span_does_nothing_without_tracing() -> None:
+    assert tracing.get_tracer() is None
+    with tracing.span("foo", bar="baz") as attrs:
+        attrs["spam"] = "eggs"
+    assert tracing.get_tracer() is None
+
+
+def test_record_trace(tmp_path: Path) -> None:
+    trace_path = tmp_path / "trace.json"
+
+    with tracing.record_trace(trace_path) as tracer:
+        assert tracer is tracing.get_tracer()
+
+        with tracing.span("outer", foo="bar") as attrs:
+            with tracing.span("inner"):
+                pass
+            attrs["result"] = 42
+
+        with pytest.raises(ValueError), tracing.span("failing"):
+            raise ValueError("oh no")
+
+    assert tracing.get_tracer() is None
+
+    trace = json.loads(trace_path.read_text())
+    events = {event["name"]: event for event in trace["traceEvents"]}
+
+    assert events["outer"]["ph"] == "X"
+    assert events["outer"]["args"] == {"foo": "bar", "result": 42}
+    assert events["inner"]["args"] == {}
+    assert events["failing"]["args"] == {"error": "ValueError('oh no')"}
+
+    # outer contains inner
+    outer, inner = events["outer"], events["inner"]
+    assert outer["ts"] <= inner["ts"]
+    assert inner["ts"] + inner["dur"] <= outer["ts"] + outer["dur"]
+
+    assert events["thread_name"]["ph"] == "M"
+    assert events["thread_name"]["tid"] == threading.get_ident()
+    assert events["thread_name"]["args"] == {"name": threading.current_thread().name}
+
+
+def test_record_trace_with_no_output() -> None:
+    with tracing.record_trace(None) as tracer:
+        assert tracer is None
+        assert tracing.get_tracer() is None
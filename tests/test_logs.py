@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import logging
+import threading
+
+import pytest
+
+from konfusion import logs
+
+
+@pytest.fixture
+def background_logging(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Set up background logging, restore the original log handlers afterwards."""
+    # Konfusion wouldn't add its handlers if pytest has handlers on the root logger.
+    # Also, this has to happen during the test setup, pytest adds more handlers
+    # for the test itself.
+    for name in ["", "konfusion", "stamina", "fake_module"]:
+        monkeypatch.setattr(logging.getLogger(name), "handlers", [])
+
+    logs.setup_logging(logging.INFO, ["fake_module"], background=True)
+
+
+@pytest.mark.usefixtures("background_logging")
+def test_background_logging(capsys: pytest.CaptureFixture[str]) -> None:
+
+    def log_lines(logger_name: str) -> None:
+        log = logging.getLogger(logger_name)
+        for i in range(100):
+            log.info("%s %d", logger_name, i)
+        log.debug("not logged")
+
+    logger_names = ["konfusion.lib.fake", "fake_module"]
+    threads = [threading.Thread(target=log_lines, args=[name]) for name in logger_names]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    logs._stop_background_logging()  # pyright: ignore[reportPrivateUsage]
+
+    messages = [line.split("] ")[1] for line in capsys.readouterr().err.splitlines()]
+    for name in logger_names:
+        assert [m for m in messages if m.startswith(name)] == [
+            f"{name} {i}" for i in range(100)
+        ]
+    assert len(messages) == 200
+
+    # After stopping, logging works in the foreground again
+    logging.getLogger("fake_module").info("foreground")
+    assert "foreground" in capsys.readouterr().err
+
+
+@pytest.mark.usefixtures("background_logging")
+def test_background_logging_formats_the_args_right_away(
+    capsys: pytest.CaptureFixture[str],
+) -> None:
+    tags = ["v1"]
+    log = logging.getLogger("fake_module")
+    log.info("Tags: %s", tags)
+    tags.append("v2")
+    try:
+        raise ValueError("oops")
+    except ValueError:
+        log.exception("Failed")
+
+    logs._stop_background_logging()  # pyright: ignore[reportPrivateUsage]
+
+    err = capsys.readouterr().err
+    assert "Tags: ['v1']\n" in err
+    assert "ValueError: oops" in err
+
+
+def test_iso_time_formatter_caches_per_second() -> None:
+    formatter = logs._ISOTimeFormatter("%(asctime)s %(message)s")  # pyright: ignore[reportPrivateUsage]
+
+    def format_at(created: float) -> str:
+        record = logging.makeLogRecord({"msg": "hello", "created": created})
+        return formatter.format(record)
+
+    assert format_at(1000.1) == format_at(1000.9)
+    assert format_at(1000.9) != format_at(1001.0)
+    assert format_at(1001.0).endswith(" hello")
@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import sys
+import textwrap
+from typing import TYPE_CHECKING
+
+import pytest
+
+from konfusion.main import main
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+def test_imports_only_selected_plugin(
+    fake_plugins: dict[str, str], capsys: pytest.CaptureFixture[str]
+) -> None:
+    main(["cmd-a", "--value", "foo"])
+
+    assert capsys.readouterr().out == "cmd-a: foo\n"
+    assert fake_plugins["cmd-a"] in sys.modules
+    assert fake_plugins["cmd-b"] not in sys.modules
+
+
+def test_subcommand_help_imports_only_selected_plugin(
+    fake_plugins: dict[str, str], capsys: pytest.CaptureFixture[str]
+) -> None:
+    with pytest.raises(SystemExit) as exc_info:
+        main(["--log-level", "DEBUG", "cmd-b", "--help"])
+
+    assert exc_info.value.code == 0
+    assert "Run cmd-b." in capsys.readouterr().out
+    assert fake_plugins["cmd-a"] not in sys.modules
+    assert fake_plugins["cmd-b"] in sys.modules
+
+
+def test_version_imports_no_plugins(
+    fake_plugins: dict[str, str], capsys: pytest.CaptureFixture[str]
+) -> None:
+    with pytest.raises(SystemExit) as exc_info:
+        main(["--version"])
+
+    assert exc_info.value.code == 0
+    assert capsys.readouterr().out == textwrap.dedent(
+        """\
+        konfusion 1.0
+
+        subcommands:
+          cmd-a (fake_konfusion_plugin_a 1.0)
+          cmd-b (fake_konfusion_plugin_b 1.0)
+        """
+    )
+    assert not any(module in sys.modules for module in fake_plugins.values())
+
+
+def test_help_lists_all_commands(
+    fake_plugins: dict[str, str], capsys: pytest.CaptureFixture[str]
+) -> None:
+    with pytest.raises(SystemExit) as exc_info:
+        main(["--help"])
+
+    assert exc_info.value.code == 0
+    out = capsys.readouterr().out
+    assert "cmd-a               Run cmd-a." in out
+    assert "cmd-b               Run cmd-b." in out
+    assert all(module in sys.modules for module in fake_plugins.values())
+
+
+@pytest.mark.usefixtures("fake_plugins")
+def test_profile_subcommand(tmp_path: Path, capsys: pytest.CaptureFixture[str]) -> None:
+    cpu_output = tmp_path / "profile.pstats"
+    memory_output = tmp_path / "allocations.txt"
+
+    main(
+        [
+            "--profile-cpu",
+            str(cpu_output),
+            "--profile-memory",
+            str(memory_output),
+            "cmd-a",
+        ]
+    )
+
+    assert capsys.readouterr().out == "cmd-a: default\n"
+    assert cpu_output.exists()
+    assert memory_output.exists()
+
+
+@pytest.mark.usefixtures("fake_plugins")
+def test_invalid_deadline_in_env(
+    monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]
+) -> None:
+    monkeypatch.setenv("KONFUSION_DEADLINE", "abc")
+
+    with pytest.raises(SystemExit) as exc_info:
+        main(["cmd-a", "--help"])
+    assert exc_info.value.code == 0
+    assert "Run cmd-a." in capsys.readouterr().out
+
+    with pytest.raises(SystemExit) as exc_info:
+        main(["cmd-a"])
+    assert exc_info.value.code == 2
+    assert "invalid $KONFUSION_DEADLINE value: 'abc'" in capsys.readouterr().err
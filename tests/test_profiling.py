@@ -0,0 +1,41 @@
+from __future__ import annotations
+
+import pstats
+from typing import TYPE_CHECKING
+
+from konfusion.profiling import profile
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+def allocate_a_lot() -> list[str]:
+    return [f"string #{i}" for i in range(10_000)]
+
+
+def test_profile_cpu(tmp_path: Path) -> None:
+    cpu_output = tmp_path / "profile.pstats"
+
+    with profile(cpu_output=cpu_output):
+        allocate_a_lot()
+
+    stats = pstats.Stats(str(cpu_output))
+    assert "allocate_a_lot" in stats.get_stats_profile().func_profiles
+
+
+def test_profile_memory(tmp_path: Path) -> None:
+    memory_output = tmp_path / "allocations.txt"
+
+    with profile(memory_output=memory_output, memory_top=3):
+        strings = allocate_a_lot()
+
+    summary = memory_output.read_text().splitlines()
+    assert summary[0].startswith("Current traced memory: ")
+    assert summary[1].startswith("Peak traced memory: ")
+    assert summary[3] == "Top 3 allocations by source line:"
+    assert len(summary) == 7
+    # The list comprehension, on the line after the def
+    allocating_line = allocate_a_lot.__code__.co_firstlineno + 1
+    assert f"test_profiling.py:{allocating_line}" in summary[4]
+
+    assert len(strings) == 10_000
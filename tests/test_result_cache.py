@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+import dataclasses
+from typing import TYPE_CHECKING
+
+import pytest
+
+from konfusion.cli import CliCommand
+from konfusion.command_index import IndexedCommand
+from konfusion.lib.imageref import ImageRef
+from konfusion.result_cache import ResultCache
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+PINNED_IMAGE = ImageRef.parse("quay.io/foo/bar:v1@sha256:abcd")
+UNPINNED_IMAGE = ImageRef.parse("quay.io/foo/bar:v1")
+
+RUNS: list[str] = []
+
+
+@pytest.fixture(autouse=True)
+def clear_runs() -> None:
+    RUNS.clear()
+
+
+ENTRYPOINT = IndexedCommand(
+    name="tag", value="fake.tag", dist_name="fake", dist_version="1.0"
+)
+
+
+@dataclasses.dataclass(frozen=True, kw_only=True)
+class Tag(CliCommand):
+    cacheable = True
+
+    image: ImageRef
+    tags: list[str]
+
+    def run(self) -> None:
+        RUNS.append(f"{self.image} -> {self.tags}")
+
+
+@dataclasses.dataclass(frozen=True, kw_only=True)
+class NotCacheableTag(Tag):
+    cacheable = False
+
+
+@dataclasses.dataclass(frozen=True, kw_only=True)
+class FailingTag(Tag):
+    def run(self) -> None:
+        super().run()
+        raise RuntimeError("failed")
+
+
+def test_skips_repeated_runs(tmp_path: Path) -> None:
+    cache = ResultCache(directory=tmp_path)
+    for _ in range(2):
+        cache.run(Tag(image=PINNED_IMAGE, tags=["v1"]), ENTRYPOINT)
+    assert len(RUNS) == 1
+
+    cache.run(Tag(image=PINNED_IMAGE, tags=["v2"]), ENTRYPOINT)
+    assert len(RUNS) == 2
+
+    newer_entrypoint = dataclasses.replace(ENTRYPOINT, dist_version="1.1")
+    cache.run(Tag(image=PINNED_IMAGE, tags=["v1"]), newer_entrypoint)
+    assert len(RUNS) == 3
+
+
+@pytest.mark.parametrize(
+    "cmd",
+    [
+        Tag(image=UNPINNED_IMAGE, tags=["v1"]),
+        NotCacheableTag(image=PINNED_IMAGE, tags=["v1"]),
+    ],
+)
+def test_does_not_cache(cmd: Tag, tmp_path: Path) -> None:
+    cache = ResultCache(directory=tmp_path)
+
+    for _ in range(2):
+        cache.run(cmd, ENTRYPOINT)
+
+    assert len(RUNS) == 2
+    assert not tmp_path.exists() or not any(tmp_path.iterdir())
+
+
+def test_does_not_cache_failures(tmp_path: Path) -> None:
+    cache = ResultCache(directory=tmp_path)
+    cmd = FailingTag(image=PINNED_IMAGE, tags=["v1"])
+
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            cache.run(cmd, ENTRYPOINT)
+
+    assert len(RUNS) == 2
+
+
+def test_force_rerun(tmp_path: Path) -> None:
+    cmd = Tag(image=PINNED_IMAGE, tags=["v1"])
+
+    ResultCache(directory=tmp_path).run(cmd, ENTRYPOINT)
+    ResultCache(directory=tmp_path, force_rerun=True).run(cmd, ENTRYPOINT)
+
+    assert len(RUNS) == 2
+
+
+def test_write_failure_is_not_fatal(
+    tmp_path: Path, caplog: pytest.LogCaptureFixture
+) -> None:
+    # Not a directory, writing the record fails
+    not_a_dir = tmp_path / "cache"
+    not_a_dir.touch()
+
+    ResultCache(directory=not_a_dir).run(
+        Tag(image=PINNED_IMAGE, tags=["v1"]), ENTRYPOINT
+    )
+
+    assert len(RUNS) == 1
+    assert "Failed to write the result cache record" in caplog.text
@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import json
+import logging
+import socket
+import threading
+from typing import TYPE_CHECKING
+
+import pytest
+
+from konfusion.client import request
+from konfusion.server import serve
+
+if TYPE_CHECKING:
+    from collections.abc import Generator
+    from pathlib import Path
+
+
+@pytest.fixture
+def socket_path(fake_plugins: dict[str, str], tmp_path: Path) -> Generator[Path]:
+    """Start a konfusion server, return the path to its socket."""
+    del fake_plugins  # only needed to have some commands to serve
+
+    socket_path = tmp_path / "konfusion.sock"
+    with serve(socket_path) as server:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        yield socket_path
+        server.shutdown()
+        thread.join()
+
+    assert not socket_path.exists()
+
+
+def test_runs_commands(socket_path: Path, capsys: pytest.CaptureFixture[str]) -> None:
+    assert request(socket_path, ["cmd-a", "--value", "foo"]) == 0
+    assert request(socket_path, ["cmd-b"]) == 0
+
+    assert capsys.readouterr().out == "cmd-a: foo\ncmd-b: default\n"
+
+
+def test_runs_concurrent_commands(
+    socket_path: Path, capsys: pytest.CaptureFixture[str]
+) -> None:
+    exit_statuses: list[int] = []
+
+    def make_request(value: str) -> None:
+        exit_statuses.append(request(socket_path, ["cmd-a", "--value", value]))
+
+    threads = [threading.Thread(target=make_request, args=[str(i)]) for i in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert exit_statuses == [0] * 5
+    assert sorted(capsys.readouterr().out.splitlines()) == [
+        f"cmd-a: {i}" for i in range(5)
+    ]
+
+
+@pytest.mark.parametrize(
+    ("argv", "expect_status", "expect_stderr"),
+    [
+        (["cmd-a", "--fail"], 1, "RuntimeError: cmd-a failed"),
+        (["cmd-a", "--no-such-option"], 2, "unrecognized arguments: --no-such-option"),
+        (["serve"], 2, "invalid choice: 'serve'"),
+        (["--trace", "trace.json", "cmd-a"], 2, "not supported in server mode"),
+    ],
+)
+def test_reports_failures(
+    argv: list[str],
+    expect_status: int,
+    expect_stderr: str,
+    socket_path: Path,
+    capsys: pytest.CaptureFixture[str],
+) -> None:
+    assert request(socket_path, argv) == expect_status
+
+    captured = capsys.readouterr()
+    assert captured.out == ""
+    assert expect_stderr in captured.err
+
+
+@pytest.fixture
+def no_pytest_log_handlers(
+    fake_plugins: dict[str, str], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Let konfusion set up its own log handlers.
+
+    By default, konfusion wouldn't add any, because pytest has handlers on the root logger.
+    """
+    for name in ["", "konfusion", "stamina", *fake_plugins.values()]:
+        monkeypatch.setattr(logging.getLogger(name), "handlers", [])
+
+
+@pytest.mark.usefixtures("no_pytest_log_handlers")
+def test_sends_logs_at_the_requested_level(
+    socket_path: Path, capsys: pytest.CaptureFixture[str]
+) -> None:
+    assert request(socket_path, ["cmd-a"]) == 0
+    assert "Running cmd-a" not in capsys.readouterr().err
+
+    assert request(socket_path, ["--log-level", "DEBUG", "cmd-a"]) == 0
+    assert "[DEBUG   ] Running cmd-a" in capsys.readouterr().err
+
+
+def test_rejects_invalid_requests(socket_path: Path) -> None:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(socket_path))
+        sock.sendall(b'{"argv": "cmd-a"}\n')
+        with sock.makefile("rb") as f:
+            responses = [json.loads(line) for line in f]
+
+    assert responses[-1] == {"exit": 2}
+    assert "Invalid request" in responses[0]["data"]